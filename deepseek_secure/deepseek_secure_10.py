@@ -1,5 +1,8 @@
+import bisect
 import json
+import math
 import pickle
+import struct
 import threading
 import time
 import uuid
@@ -10,7 +13,7 @@ from enum import Enum
 import sqlite3
 from contextlib import contextmanager
 import logging
-from queue import Queue as ThreadQueue
+from queue import Empty, Queue as ThreadQueue
 import heapq
 import asyncio
 
@@ -141,13 +144,274 @@ class MessageSerializer:
         return QueueMessage.from_dict(data_dict)
 
 
+# Границы гистограммы времени обработки (секунды), последний бакет — +Inf
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Счетчик очереди для каждого статуса сообщения в таблице messages
+STATUS_COUNTERS = {
+    MessageStatus.PENDING: 'pending_messages',
+    MessageStatus.PROCESSING: 'processing_messages',
+    MessageStatus.COMPLETED: 'completed_messages',
+    MessageStatus.FAILED: 'failed_messages',
+}
+
+
+@dataclass
+class QueueCounters:
+    """Инкрементально поддерживаемая статистика очереди."""
+    queue_name: str
+    total_messages: int = 0
+    pending_messages: int = 0
+    processing_messages: int = 0
+    completed_messages: int = 0
+    failed_messages: int = 0
+    dead_letters: int = 0
+    latency_sum: float = 0.0
+    latency_count: int = 0
+    latency_histogram: List[int] = field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1)
+    )
+    
+    def transition(
+        self,
+        old_status: Optional[MessageStatus],
+        new_status: Optional[MessageStatus]
+    ):
+        """
+        Учет смены статуса сообщения.
+        
+        None в old_status означает новое сообщение, в new_status — удаление.
+        """
+        if old_status == new_status:
+            return
+        if old_status is None:
+            self.total_messages += 1
+        elif old_status in STATUS_COUNTERS:
+            field_name = STATUS_COUNTERS[old_status]
+            setattr(self, field_name, getattr(self, field_name) - 1)
+        if new_status is None:
+            self.total_messages -= 1
+        elif new_status in STATUS_COUNTERS:
+            field_name = STATUS_COUNTERS[new_status]
+            setattr(self, field_name, getattr(self, field_name) + 1)
+    
+    def observe_latency(self, seconds: float):
+        """Учет времени от создания до завершения сообщения."""
+        self.latency_sum += seconds
+        self.latency_count += 1
+        self.latency_histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Сериализация в словарь."""
+        return {
+            'queue_name': self.queue_name,
+            'total_messages': self.total_messages,
+            'pending_messages': self.pending_messages,
+            'processing_messages': self.processing_messages,
+            'completed_messages': self.completed_messages,
+            'failed_messages': self.failed_messages,
+            'dead_letters': self.dead_letters,
+            'avg_processing_time': (
+                self.latency_sum / self.latency_count if self.latency_count else 0.0
+            ),
+            'latency_histogram': {
+                **{str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.latency_histogram)},
+                '+Inf': self.latency_histogram[-1]
+            }
+        }
+
+
+class LazyBodyMessage(QueueMessage):
+    """Сообщение, тело которого декодируется при первом обращении."""
+    
+    @property
+    def body(self) -> Any:
+        if self._body_raw is not None:
+            self._body = json.loads(self._body_raw)
+            self._body_raw = None
+        return self._body
+    
+    @body.setter
+    def body(self, value: Any):
+        self._body = value
+        self._body_raw = None
+
+
+class BinaryMessageSerializer:
+    """
+    Компактный бинарный сериализатор сообщений.
+    
+    Формат: заголовок фиксированной структуры с числовыми полями, затем
+    секции с префиксом длины (id, queue_name, metadata, error, result,
+    body) без имен полей. metadata, result и body кодируются компактным
+    JSON; тело декодируется лениво.
+    """
+    
+    MAGIC = b'QM\x01'
+    HEADER = struct.Struct('<3sBBHHdddd')
+    LENGTH = struct.Struct('<I')
+    NONE_LENGTH = 0xFFFFFFFF
+    STATUSES = list(MessageStatus)
+    
+    @staticmethod
+    def _encode_json(value: Any) -> bytes:
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    
+    @staticmethod
+    def _encode_time(value: Optional[datetime]) -> float:
+        return value.timestamp() if value else math.nan
+    
+    @staticmethod
+    def _decode_time(value: float) -> Optional[datetime]:
+        return None if math.isnan(value) else datetime.fromtimestamp(value)
+    
+    @classmethod
+    def serialize(cls, message: QueueMessage) -> bytes:
+        """
+        Сериализация сообщения.
+        
+        Args:
+            message: Сообщение для сериализации
+            
+        Returns:
+            Сериализованные байты
+        """
+        parts = [cls.HEADER.pack(
+            cls.MAGIC,
+            message.priority.value,
+            cls.STATUSES.index(message.status),
+            message.attempts,
+            message.max_attempts,
+            message.retry_delay,
+            cls._encode_time(message.created_at),
+            cls._encode_time(message.scheduled_for),
+            cls._encode_time(message.processed_at)
+        )]
+        
+        sections = (
+            message.id.encode('utf-8'),
+            message.queue_name.encode('utf-8'),
+            cls._encode_json(message.metadata) if message.metadata else None,
+            message.error.encode('utf-8') if message.error is not None else None,
+            cls._encode_json(message.result) if message.result is not None else None,
+            cls._encode_json(message.body)
+        )
+        for section in sections:
+            if section is None:
+                parts.append(cls.LENGTH.pack(cls.NONE_LENGTH))
+            else:
+                parts.append(cls.LENGTH.pack(len(section)))
+                parts.append(section)
+        
+        return b''.join(parts)
+    
+    @classmethod
+    def deserialize(cls, data: bytes) -> QueueMessage:
+        """
+        Десериализация сообщения.
+        
+        Args:
+            data: Сериализованные данные
+            
+        Returns:
+            Сообщение с ленивым телом
+        """
+        (magic, priority, status, attempts, max_attempts, retry_delay,
+         created_at, scheduled_for, processed_at) = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError("Not a binary queue message")
+        
+        offset = cls.HEADER.size
+        sections = []
+        for _ in range(6):
+            (length,) = cls.LENGTH.unpack_from(data, offset)
+            offset += cls.LENGTH.size
+            if length == cls.NONE_LENGTH:
+                sections.append(None)
+            else:
+                sections.append(data[offset:offset + length])
+                offset += length
+        
+        message_id, queue_name, metadata, error, result, body = sections
+        message = LazyBodyMessage(
+            id=message_id.decode('utf-8'),
+            queue_name=queue_name.decode('utf-8'),
+            body=None,
+            priority=MessagePriority(priority),
+            created_at=cls._decode_time(created_at),
+            scheduled_for=cls._decode_time(scheduled_for),
+            status=cls.STATUSES[status],
+            attempts=attempts,
+            max_attempts=max_attempts,
+            retry_delay=retry_delay,
+            metadata=json.loads(metadata) if metadata is not None else {},
+            processed_at=cls._decode_time(processed_at),
+            result=json.loads(result) if result is not None else None,
+            error=error.decode('utf-8') if error is not None else None
+        )
+        message._body_raw = body
+        return message
+
+
+class StorageChangeWatcher:
+    """
+    Наблюдатель за изменениями БД через PRAGMA data_version.
+    
+    Значение меняется, когда другое соединение (из этого или другого
+    процесса) фиксирует транзакцию, поэтому публикации из чужих
+    процессов замечаются без чтения таблиц.
+    """
+    
+    def __init__(self, db_path: str):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._version = self._read_version()
+    
+    def _read_version(self) -> int:
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+    
+    def changed(self) -> bool:
+        """Проверка, были ли коммиты с момента прошлого вызова."""
+        version = self._read_version()
+        if version != self._version:
+            self._version = version
+            return True
+        return False
+    
+    def close(self):
+        """Закрытие соединения наблюдателя."""
+        self._conn.close()
+
+
 class QueueStorage:
     """Хранилище очередей."""
     
     def __init__(self, db_path: str = "message_queue.db"):
+        """
+        Инициализация хранилища.
+        
+        Args:
+            db_path: Путь к файлу БД
+        """
         self.db_path = db_path
+        # Сериализаторы, выбранные для отдельных очередей
+        self._serializers: Dict[str, Any] = {}
         self._init_database()
     
+    def set_serializer(self, queue_name: str, serializer: Any):
+        """Выбор сериализатора для новых сообщений очереди."""
+        self._serializers[queue_name] = serializer
+    
+    def _serialize(self, message: QueueMessage) -> bytes:
+        serializer = self._serializers.get(message.queue_name, MessageSerializer)
+        return serializer.serialize(message)
+    
+    @staticmethod
+    def _deserialize(data: bytes) -> QueueMessage:
+        """Десериализация с определением формата по сигнатуре."""
+        if data[:len(BinaryMessageSerializer.MAGIC)] == BinaryMessageSerializer.MAGIC:
+            return BinaryMessageSerializer.deserialize(data)
+        return MessageSerializer.deserialize(data)
+    
     def _init_database(self):
         """Инициализация структуры базы данных."""
         with self._get_connection() as conn:
@@ -170,15 +434,25 @@ class QueueStorage:
                     processed_at TIMESTAMP,
                     result BLOB,
                     error TEXT,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    visible_until REAL
                 )
             """)
             
+            # Миграция баз, созданных до появления таймаута видимости
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(messages)")}
+            if 'visible_until' not in columns:
+                cursor.execute("ALTER TABLE messages ADD COLUMN visible_until REAL")
+            
             # Индексы для быстрого поиска
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_queue_status ON messages(queue_name, status)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_for ON messages(scheduled_for)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_priority ON messages(priority DESC)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON messages(created_at)")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_visible_until
+                ON messages(queue_name, visible_until) WHERE status = 'processing'
+            """)
             
             # Таблица мертвых сообщений (dead letter queue)
             cursor.execute("""
@@ -209,6 +483,29 @@ class QueueStorage:
                 )
             """)
             
+            # Колонки инкрементальных счетчиков
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(queue_stats)")}
+            for column, column_type in (
+                ('processing_messages', 'INTEGER DEFAULT 0'),
+                ('latency_sum', 'REAL DEFAULT 0'),
+                ('latency_count', 'INTEGER DEFAULT 0'),
+                # 1 — строка пересчитана по таблицам и с тех пор обновляется приращениями
+                ('counters_ready', 'INTEGER DEFAULT 0'),
+            ):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE queue_stats ADD COLUMN {column} {column_type}")
+            
+            # Гистограмма времени обработки: строка на бакет, чтобы ее тоже
+            # можно было обновлять приращениями
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS queue_latency_histogram (
+                    queue_name TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (queue_name, bucket)
+                )
+            """)
+            
             conn.commit()
     
     @contextmanager
@@ -221,108 +518,286 @@ class QueueStorage:
         finally:
             conn.close()
     
+    _SAVE_SQL = """
+        INSERT OR REPLACE INTO messages 
+        (id, queue_name, body, priority, created_at, scheduled_for, 
+         status, attempts, max_attempts, retry_delay, metadata, 
+         processed_at, result, error, last_updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    
+    def _message_row(self, message: QueueMessage) -> tuple:
+        """Параметры строки messages для сообщения."""
+        return (
+            message.id,
+            message.queue_name,
+            self._serialize(message),
+            message.priority.value,
+            message.created_at,
+            message.scheduled_for,
+            message.status.value,
+            message.attempts,
+            message.max_attempts,
+            message.retry_delay,
+            pickle.dumps(message.metadata) if message.metadata else None,
+            message.processed_at,
+            pickle.dumps(message.result) if message.result is not None else None,
+            message.error,
+            datetime.now()
+        )
+    
+    def save_messages(self, messages: List[QueueMessage]) -> int:
+        """
+        Сохранение пачки сообщений одной транзакцией.
+        
+        Args:
+            messages: Сообщения для сохранения
+            
+        Returns:
+            Количество сохраненных сообщений
+        """
+        if not messages:
+            return 0
+        
+        try:
+            rows = [self._message_row(message) for message in messages]
+            
+            with self._get_connection() as conn:
+                # Блокировка на запись сразу: статусы не должны измениться до REPLACE
+                conn.execute("BEGIN IMMEDIATE")
+                old_statuses = self._fetch_statuses(conn, [message.id for message in messages])
+                conn.executemany(self._SAVE_SQL, rows)
+                
+                deltas: Dict[str, QueueCounters] = {}
+                for message in messages:
+                    self._record_save(deltas, message, old_statuses.get(message.id))
+                self._apply_stats(conn, deltas)
+                conn.commit()
+            
+            return len(messages)
+            
+        except Exception as e:
+            logger.error(f"Error saving {len(messages)} messages: {e}")
+            return 0
+    
     def save_message(self, message: QueueMessage) -> bool:
         """Сохранение сообщения."""
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 
-                cursor.execute("""
-                    INSERT OR REPLACE INTO messages 
-                    (id, queue_name, body, priority, created_at, scheduled_for, 
-                     status, attempts, max_attempts, retry_delay, metadata, 
-                     processed_at, result, error, last_updated)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    message.id,
-                    message.queue_name,
-                    MessageSerializer.serialize(message),
-                    message.priority.value,
-                    message.created_at,
-                    message.scheduled_for,
-                    message.status.value,
-                    message.attempts,
-                    message.max_attempts,
-                    message.retry_delay,
-                    pickle.dumps(message.metadata) if message.metadata else None,
-                    message.processed_at,
-                    pickle.dumps(message.result) if message.result is not None else None,
-                    message.error,
-                    datetime.now()
-                ))
-                
-                conn.commit()
+                conn.execute("BEGIN IMMEDIATE")
+                old_status = self._fetch_statuses(conn, [message.id]).get(message.id)
+                cursor.execute(self._SAVE_SQL, self._message_row(message))
                 
-                # Обновляем статистику
-                self._update_queue_stats(message.queue_name)
+                # Обновляем статистику в той же транзакции
+                deltas: Dict[str, QueueCounters] = {}
+                self._record_save(deltas, message, old_status)
+                self._apply_stats(conn, deltas)
                 
-                return True
+                conn.commit()
+            
+            return True
                 
         except Exception as e:
             logger.error(f"Error saving message {message.id}: {e}")
             return False
     
+    @staticmethod
+    def _row_to_message(row: sqlite3.Row) -> QueueMessage:
+        """
+        Восстановление сообщения из строки.
+        
+        Статус и число попыток берутся из колонок: claim_messages меняет
+        их одним UPDATE, не переписывая сериализованное тело.
+        """
+        message = QueueStorage._deserialize(row['body'])
+        message.status = MessageStatus(row['status'])
+        message.attempts = row['attempts']
+        return message
+    
     def get_message(self, message_id: str) -> Optional[QueueMessage]:
         """Получение сообщения по ID."""
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
-                    "SELECT body FROM messages WHERE id = ?",
+                    "SELECT body, status, attempts FROM messages WHERE id = ?",
                     (message_id,)
                 )
                 row = cursor.fetchone()
                 
                 if row:
-                    return MessageSerializer.deserialize(row['body'])
+                    return self._row_to_message(row)
                 return None
                 
         except Exception as e:
             logger.error(f"Error getting message {message_id}: {e}")
             return None
     
-    def get_next_message(self, queue_name: str) -> Optional[QueueMessage]:
+    def claim_messages(
+        self,
+        queue_name: str,
+        n: int = 1,
+        visibility_timeout: float = 30.0
+    ) -> List[QueueMessage]:
         """
-        Получение следующего сообщения для обработки.
+        Атомарный захват до n сообщений для обработки.
+        
+        Одним UPDATE ... RETURNING сообщения переводятся в processing и
+        скрываются от других воркеров на visibility_timeout секунд. Если
+        за это время обработка не завершилась, в той же транзакции сообщение
+        возвращается в pending и снова доступно.
         
         Args:
             queue_name: Имя очереди
+            n: Максимальное количество сообщений
+            visibility_timeout: Время невидимости захваченных сообщений
             
         Returns:
-            Следующее сообщение или None
+            Захваченные сообщения в порядке приоритета
         """
+        if n <= 0:
+            return []
+        
         try:
+            now = datetime.now()
+            now_ts = time.time()
+            
             with self._get_connection() as conn:
                 cursor = conn.cursor()
+                conn.execute("BEGIN IMMEDIATE")
                 
-                # Ищем pending сообщение с наивысшим приоритетом и подходящее по времени
+                # Сообщения с истекшей видимостью снова становятся pending
                 cursor.execute("""
-                    SELECT body FROM messages 
-                    WHERE queue_name = ? 
-                    AND status = 'pending'
-                    AND (scheduled_for IS NULL OR scheduled_for <= ?)
-                    ORDER BY priority DESC, created_at ASC
-                    LIMIT 1
-                """, (queue_name, datetime.now()))
+                    UPDATE messages
+                    SET status = 'pending', visible_until = NULL, last_updated = ?
+                    WHERE queue_name = ? AND status = 'processing' AND visible_until < ?
+                    RETURNING id
+                """, (now, queue_name, now_ts))
+                expired = len(cursor.fetchall())
                 
-                row = cursor.fetchone()
+                cursor.execute("""
+                    UPDATE messages
+                    SET status = 'processing',
+                        attempts = attempts + 1,
+                        visible_until = ?,
+                        last_updated = ?
+                    WHERE id IN (
+                        SELECT id FROM messages
+                        WHERE queue_name = ?
+                        AND status = 'pending'
+                        AND (scheduled_for IS NULL OR scheduled_for <= ?)
+                        ORDER BY priority DESC, created_at ASC
+                        LIMIT ?
+                    )
+                    RETURNING body, status, attempts, priority, created_at
+                """, (now_ts + visibility_timeout, now, queue_name, now, n))
                 
-                if row:
-                    message = MessageSerializer.deserialize(row['body'])
-                    
-                    # Обновляем статус на processing
-                    message.status = MessageStatus.PROCESSING
-                    message.attempts += 1
-                    self.save_message(message)
-                    
-                    return message
+                rows = cursor.fetchall()
                 
-                return None
+                if expired or rows:
+                    delta = QueueCounters(queue_name=queue_name)
+                    delta.processing_messages = len(rows) - expired
+                    delta.pending_messages = expired - len(rows)
+                    self._apply_stats(conn, {queue_name: delta})
+                conn.commit()
+            
+            if not rows:
+                return []
+            
+            # RETURNING не гарантирует порядок строк
+            rows.sort(key=lambda row: (-row['priority'], row['created_at']))
+            return [self._row_to_message(row) for row in rows]
+            
+        except Exception as e:
+            logger.error(f"Error claiming messages for queue {queue_name}: {e}")
+            return []
+    
+    def get_next_message(
+        self,
+        queue_name: str,
+        visibility_timeout: float = 30.0
+    ) -> Optional[QueueMessage]:
+        """
+        Получение следующего сообщения для обработки.
+        
+        Args:
+            queue_name: Имя очереди
+            visibility_timeout: Время невидимости захваченного сообщения
+            
+        Returns:
+            Следующее сообщение или None
+        """
+        messages = self.claim_messages(queue_name, 1, visibility_timeout)
+        return messages[0] if messages else None
+    
+    def extend_visibility(self, message: QueueMessage, visibility_timeout: float) -> bool:
+        """
+        Продление видимости захваченного сообщения от текущего момента.
+        
+        Args:
+            message: Сообщение, полученное из claim_messages
+            visibility_timeout: Новое время невидимости
+        
+        Returns:
+            True если захват еще действует (сообщение не вернулось в
+            pending и не было захвачено заново)
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.execute("""
+                    UPDATE messages SET visible_until = ?
+                    WHERE id = ? AND status = 'processing' AND attempts = ?
+                """, (time.time() + visibility_timeout, message.id, message.attempts))
+                conn.commit()
+                return cursor.rowcount > 0
+        
+        except Exception as e:
+            logger.error(f"Error extending visibility of message {message.id}: {e}")
+            return False
+    
+    def get_next_due_time(self, queue_name: str) -> Optional[float]:
+        """
+        Ближайший момент, когда в очереди появится сообщение для захвата.
+        
+        Учитываются отложенные pending сообщения и processing сообщения,
+        у которых истечет таймаут видимости.
+        
+        Returns:
+            Unix-время или None, если ждать нечего
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute("""
+                    SELECT MIN(scheduled_for) AS next_scheduled FROM messages
+                    WHERE queue_name = ? AND status = 'pending' AND scheduled_for IS NOT NULL
+                """, (queue_name,))
+                next_scheduled = cursor.fetchone()['next_scheduled']
                 
+                cursor.execute("""
+                    SELECT MIN(visible_until) AS next_visible FROM messages
+                    WHERE queue_name = ? AND status = 'processing'
+                """, (queue_name,))
+                next_visible = cursor.fetchone()['next_visible']
+            
+            candidates = []
+            if next_scheduled:
+                candidates.append(datetime.fromisoformat(next_scheduled).timestamp())
+            if next_visible is not None:
+                candidates.append(next_visible)
+            return min(candidates) if candidates else None
+            
         except Exception as e:
-            logger.error(f"Error getting next message for queue {queue_name}: {e}")
+            logger.error(f"Error getting next due time for queue {queue_name}: {e}")
             return None
     
+    def open_change_watcher(self) -> 'StorageChangeWatcher':
+        """Создание наблюдателя за коммитами в БД (в том числе из других процессов)."""
+        return StorageChangeWatcher(self.db_path)
+    
     def update_message_status(
         self, 
         message_id: str, 
@@ -356,6 +831,7 @@ class QueueStorage:
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
+                conn.execute("BEGIN IMMEDIATE")
                 
                 # Сохраняем в dead letters
                 cursor.execute("""
@@ -366,7 +842,7 @@ class QueueStorage:
                     str(uuid.uuid4()),
                     message.id,
                     message.queue_name,
-                    MessageSerializer.serialize(message),
+                    self._serialize(message),
                     error,
                     message.attempts,
                     datetime.now()
@@ -374,112 +850,222 @@ class QueueStorage:
                 
                 # Удаляем из основной очереди
                 cursor.execute(
-                    "DELETE FROM messages WHERE id = ?",
+                    "DELETE FROM messages WHERE id = ? RETURNING status",
                     (message.id,)
                 )
-                
-                conn.commit()
+                deleted = cursor.fetchone()
                 
                 # Обновляем статистику
-                self._update_queue_stats(message.queue_name)
+                delta = QueueCounters(queue_name=message.queue_name)
+                if deleted:
+                    delta.transition(MessageStatus(deleted['status']), None)
+                delta.dead_letters += 1
+                self._apply_stats(conn, {message.queue_name: delta})
                 
-                logger.warning(f"Message {message.id} moved to dead letter queue: {error}")
-                return True
+                conn.commit()
+            
+            logger.warning(f"Message {message.id} moved to dead letter queue: {error}")
+            return True
                 
         except Exception as e:
             logger.error(f"Error moving message to dead letter: {e}")
             return False
     
+    @staticmethod
+    def _fetch_statuses(conn: sqlite3.Connection, message_ids: List[str]) -> Dict[str, MessageStatus]:
+        """Текущие статусы сообщений (для учета переходов в счетчиках)."""
+        statuses = {}
+        # Ограничение SQLite на число параметров в запросе
+        for i in range(0, len(message_ids), 500):
+            chunk = message_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for row in conn.execute(
+                f"SELECT id, status FROM messages WHERE id IN ({placeholders})", chunk
+            ):
+                statuses[row['id']] = MessageStatus(row['status'])
+        return statuses
+    
+    @staticmethod
+    def _record_save(
+        deltas: Dict[str, QueueCounters],
+        message: QueueMessage,
+        old_status: Optional[MessageStatus]
+    ):
+        """Учет сохранения сообщения в приращениях счетчиков."""
+        delta = deltas.get(message.queue_name)
+        if delta is None:
+            delta = deltas[message.queue_name] = QueueCounters(queue_name=message.queue_name)
+        delta.transition(old_status, message.status)
+        if (message.status == MessageStatus.COMPLETED
+                and old_status != MessageStatus.COMPLETED
+                and message.processed_at):
+            delta.observe_latency(
+                (message.processed_at - message.created_at).total_seconds()
+            )
+    
+    @staticmethod
+    def _apply_stats(conn: sqlite3.Connection, deltas: Dict[str, QueueCounters]):
+        """
+        Применение приращений счетчиков в текущей транзакции записи.
+        
+        Обновляются только строки, уже пересчитанные по таблицам
+        (counters_ready): иначе изменение будет учтено при пересчете.
+        Приращения складываются в БД, поэтому счетчики сходятся при
+        записи из нескольких процессов.
+        """
+        now = datetime.now()
+        for queue_name, delta in deltas.items():
+            cursor = conn.execute("""
+                UPDATE queue_stats SET
+                    total_messages = total_messages + ?,
+                    pending_messages = pending_messages + ?,
+                    processing_messages = processing_messages + ?,
+                    completed_messages = completed_messages + ?,
+                    failed_messages = failed_messages + ?,
+                    dead_letters = dead_letters + ?,
+                    latency_sum = latency_sum + ?,
+                    latency_count = latency_count + ?,
+                    avg_processing_time = CASE WHEN latency_count + ? > 0
+                        THEN (latency_sum + ?) / (latency_count + ?) ELSE 0 END,
+                    last_updated = ?
+                WHERE queue_name = ? AND counters_ready = 1
+            """, (
+                delta.total_messages,
+                delta.pending_messages,
+                delta.processing_messages,
+                delta.completed_messages,
+                delta.failed_messages,
+                delta.dead_letters,
+                delta.latency_sum,
+                delta.latency_count,
+                delta.latency_count,
+                delta.latency_sum,
+                delta.latency_count,
+                now,
+                queue_name
+            ))
+            
+            if cursor.rowcount and delta.latency_count:
+                conn.executemany("""
+                    INSERT INTO queue_latency_histogram (queue_name, bucket, count)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(queue_name, bucket) DO UPDATE SET count = count + excluded.count
+                """, [
+                    (queue_name, bucket, count)
+                    for bucket, count in enumerate(delta.latency_histogram) if count
+                ])
+    
     def get_queue_stats(self, queue_name: str) -> Dict[str, Any]:
-        """Получение статистики очереди."""
+        """Получение статистики очереди (одна строка queue_stats)."""
         try:
             with self._get_connection() as conn:
-                cursor = conn.cursor()
+                row = conn.execute(
+                    "SELECT * FROM queue_stats WHERE queue_name = ? AND counters_ready = 1",
+                    (queue_name,)
+                ).fetchone()
+                if row is None:
+                    conn.commit()
+                    return self.rebuild_queue_stats(queue_name).to_dict()
                 
-                cursor.execute("""
-                    SELECT * FROM queue_stats WHERE queue_name = ?
-                """, (queue_name,))
+                counters = QueueCounters(
+                    queue_name=queue_name,
+                    total_messages=row['total_messages'],
+                    pending_messages=row['pending_messages'],
+                    processing_messages=row['processing_messages'],
+                    completed_messages=row['completed_messages'],
+                    failed_messages=row['failed_messages'],
+                    dead_letters=row['dead_letters'],
+                    latency_sum=row['latency_sum'],
+                    latency_count=row['latency_count']
+                )
+                for bucket_row in conn.execute(
+                    "SELECT bucket, count FROM queue_latency_histogram WHERE queue_name = ?",
+                    (queue_name,)
+                ):
+                    counters.latency_histogram[bucket_row['bucket']] = bucket_row['count']
                 
-                row = cursor.fetchone()
-                if row:
-                    return dict(row)
-                
-                # Если статистики нет, создаем запись
-                return {
-                    'queue_name': queue_name,
-                    'total_messages': 0,
-                    'pending_messages': 0,
-                    'completed_messages': 0,
-                    'failed_messages': 0,
-                    'dead_letters': 0,
-                    'avg_processing_time': 0.0
-                }
+                return counters.to_dict()
                 
         except Exception as e:
             logger.error(f"Error getting queue stats: {e}")
             return {}
     
-    def _update_queue_stats(self, queue_name: str):
-        """Обновление статистики очереди."""
-        try:
-            with self._get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Считаем статистику
-                cursor.execute("""
-                    SELECT 
-                        COUNT(*) as total,
-                        COUNT(CASE WHEN status = 'pending' THEN 1 END) as pending,
-                        COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed,
-                        COUNT(CASE WHEN status = 'failed' THEN 1 END) as failed
-                    FROM messages 
-                    WHERE queue_name = ?
-                """, (queue_name,))
-                
-                msg_stats = dict(cursor.fetchone())
-                
-                cursor.execute("""
-                    SELECT COUNT(*) as dead_letters 
-                    FROM dead_letters 
-                    WHERE queue_name = ?
-                """, (queue_name,))
-                
-                dead_stats = dict(cursor.fetchone())
-                
-                # Среднее время обработки
-                cursor.execute("""
-                    SELECT AVG(
-                        JULIANDAY(processed_at) - JULIANDAY(created_at)
-                    ) * 86400.0 as avg_processing_time
-                    FROM messages 
-                    WHERE queue_name = ? 
-                    AND status = 'completed' 
-                    AND processed_at IS NOT NULL
-                """, (queue_name,))
-                
-                time_stats = dict(cursor.fetchone())
-                
-                # Сохраняем статистику
-                cursor.execute("""
-                    INSERT OR REPLACE INTO queue_stats 
-                    (queue_name, total_messages, pending_messages, completed_messages, 
-                     failed_messages, dead_letters, avg_processing_time, last_updated)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    queue_name,
-                    msg_stats['total'],
-                    msg_stats['pending'],
-                    msg_stats['completed'],
-                    msg_stats['failed'],
-                    dead_stats['dead_letters'],
-                    time_stats['avg_processing_time'] or 0.0,
-                    datetime.now()
-                ))
-                
-                conn.commit()
-                
-        except Exception as e:
-            logger.error(f"Error updating queue stats: {e}")
+    def rebuild_queue_stats(self, queue_name: str) -> QueueCounters:
+        """
+        Полный пересчет счетчиков очереди по таблицам.
+        
+        Нужен только для восстановления: при первом обращении к очереди
+        без пересчитанных счетчиков или после изменений в обход хранилища.
+        Пересчет идет под блокировкой записи, поэтому приращения других
+        транзакций не теряются и не учитываются дважды.
+        """
+        counters = QueueCounters(queue_name=queue_name)
+        
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            conn.execute("BEGIN IMMEDIATE")
+            
+            cursor.execute("""
+                SELECT status, COUNT(*) AS count
+                FROM messages 
+                WHERE queue_name = ?
+                GROUP BY status
+            """, (queue_name,))
+            
+            for row in cursor.fetchall():
+                counters.total_messages += row['count']
+                field_name = STATUS_COUNTERS.get(MessageStatus(row['status']))
+                if field_name:
+                    setattr(counters, field_name, row['count'])
+            
+            cursor.execute("""
+                SELECT COUNT(*) as dead_letters 
+                FROM dead_letters 
+                WHERE queue_name = ?
+            """, (queue_name,))
+            counters.dead_letters = cursor.fetchone()['dead_letters']
+            
+            # Время обработки завершенных сообщений
+            cursor.execute("""
+                SELECT (JULIANDAY(processed_at) - JULIANDAY(created_at)) * 86400.0 AS latency
+                FROM messages 
+                WHERE queue_name = ? 
+                AND status = 'completed' 
+                AND processed_at IS NOT NULL
+            """, (queue_name,))
+            for row in cursor.fetchall():
+                counters.observe_latency(row['latency'])
+            
+            cursor.execute("""
+                INSERT OR REPLACE INTO queue_stats 
+                (queue_name, total_messages, pending_messages, processing_messages,
+                 completed_messages, failed_messages, dead_letters, avg_processing_time,
+                 latency_sum, latency_count, counters_ready, last_updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+            """, (
+                queue_name,
+                counters.total_messages,
+                counters.pending_messages,
+                counters.processing_messages,
+                counters.completed_messages,
+                counters.failed_messages,
+                counters.dead_letters,
+                counters.latency_sum / counters.latency_count if counters.latency_count else 0.0,
+                counters.latency_sum,
+                counters.latency_count,
+                datetime.now()
+            ))
+            cursor.execute("DELETE FROM queue_latency_histogram WHERE queue_name = ?", (queue_name,))
+            cursor.executemany(
+                "INSERT INTO queue_latency_histogram (queue_name, bucket, count) VALUES (?, ?, ?)",
+                [
+                    (queue_name, bucket, count)
+                    for bucket, count in enumerate(counters.latency_histogram) if count
+                ]
+            )
+            conn.commit()
+        
+        return counters
     
     def cleanup_old_messages(self, retention_days: int = 7) -> int:
         """Очистка старых сообщений."""
@@ -488,30 +1074,40 @@ class QueueStorage:
             
             with self._get_connection() as conn:
                 cursor = conn.cursor()
+                conn.execute("BEGIN IMMEDIATE")
                 
                 # Удаляем старые completed/failed сообщения
                 cursor.execute("""
                     DELETE FROM messages 
                     WHERE status IN ('completed', 'failed') 
                     AND created_at < ?
+                    RETURNING queue_name, status
                 """, (cutoff_date,))
-                
-                deleted = cursor.rowcount
+                deleted_messages = cursor.fetchall()
                 
                 # Удаляем старые dead letters
                 cursor.execute(
-                    "DELETE FROM dead_letters WHERE created_at < ?",
+                    "DELETE FROM dead_letters WHERE created_at < ? RETURNING queue_name",
                     (cutoff_date,)
                 )
+                deleted_dead = cursor.fetchall()
                 
-                deleted += cursor.rowcount
+                deltas: Dict[str, QueueCounters] = {}
+                for row in deleted_messages:
+                    delta = deltas.setdefault(row['queue_name'], QueueCounters(queue_name=row['queue_name']))
+                    delta.transition(MessageStatus(row['status']), None)
+                for row in deleted_dead:
+                    delta = deltas.setdefault(row['queue_name'], QueueCounters(queue_name=row['queue_name']))
+                    delta.dead_letters -= 1
+                self._apply_stats(conn, deltas)
                 
                 conn.commit()
-                
-                if deleted > 0:
-                    logger.info(f"Cleaned up {deleted} old messages")
-                
-                return deleted
+            
+            deleted = len(deleted_messages) + len(deleted_dead)
+            if deleted > 0:
+                logger.info(f"Cleaned up {deleted} old messages")
+            
+            return deleted
                 
         except Exception as e:
             logger.error(f"Error cleaning up old messages: {e}")
@@ -521,12 +1117,18 @@ class QueueStorage:
 class MessageQueue:
     """Очередь сообщений."""
     
+    # Доля таймаута видимости, которую сообщение может провести в очереди
+    # передачи без продления видимости (ожидание бывает только в гонках)
+    VISIBILITY_SLACK = 0.01
+    
     def __init__(
         self,
         name: str,
         storage: QueueStorage,
         max_concurrent: int = 4,
-        process_timeout: float = 30.0
+        process_timeout: float = 30.0,
+        watch_interval: float = 0.05,
+        serializer: Optional[Any] = None
     ):
         """
         Инициализация очереди.
@@ -536,15 +1138,31 @@ class MessageQueue:
             storage: Хранилище очереди
             max_concurrent: Максимальное количество параллельных обработчиков
             process_timeout: Таймаут обработки сообщения
+            watch_interval: Период проверки изменений БД от других процессов
+            serializer: Сериализатор сообщений очереди (например,
+                BinaryMessageSerializer); по умолчанию MessageSerializer
         """
         self.name = name
         self.storage = storage
         self.max_concurrent = max_concurrent
         self.process_timeout = process_timeout
+        # Захваченное сообщение скрыто от других воркеров на время таймаута обработки
+        self.visibility_timeout = process_timeout
+        
+        self.watch_interval = watch_interval
+        
+        if serializer is not None:
+            storage.set_serializer(name, serializer)
         
         self._running = False
         self._workers: List[threading.Thread] = []
-        self._worker_semaphore = threading.Semaphore(max_concurrent)
+        self._dispatcher: Optional[threading.Thread] = None
+        # Захватывается не больше сообщений, чем свободных воркеров:
+        # таймаут видимости не расходуется на ожидание в очереди передачи
+        self._idle_workers = 0
+        self._handoff: ThreadQueue = ThreadQueue(maxsize=max_concurrent)
+        # Пробуждение диспетчера при публикации из этого процесса
+        self._wakeup = threading.Event()
         self._message_callbacks: Dict[str, Callable] = {}
         self._lock = threading.RLock()
         
@@ -585,8 +1203,69 @@ class MessageQueue:
         Returns:
             ID сообщения
         """
-        message_id = str(uuid.uuid4())
+        message = self._build_message(
+            body, message_type, priority, delay, max_attempts, retry_delay, metadata
+        )
+        
+        success = self.storage.save_message(message)
+        if success:
+            logger.debug(f"Published message {message.id} to queue {self.name}")
+            self._wakeup.set()
+            return message.id
+        else:
+            raise RuntimeError(f"Failed to publish message to queue {self.name}")
+    
+    def publish_many(
+        self,
+        bodies: List[Any],
+        message_type: Optional[str] = None,
+        priority: MessagePriority = MessagePriority.NORMAL,
+        delay: Optional[float] = None,
+        max_attempts: int = 3,
+        retry_delay: float = 1.0,
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> List[str]:
+        """
+        Публикация пачки сообщений одной транзакцией.
+        
+        Args:
+            bodies: Тела сообщений
+            message_type: Тип сообщений
+            priority: Приоритет
+            delay: Задержка в секундах
+            max_attempts: Максимальное количество попыток
+            retry_delay: Задержка между попытками
+            metadata: Дополнительные метаданные (копируются в каждое сообщение)
+            
+        Returns:
+            ID сообщений в порядке тел
+        """
+        messages = [
+            self._build_message(
+                body, message_type, priority, delay, max_attempts, retry_delay,
+                dict(metadata) if metadata else None
+            )
+            for body in bodies
+        ]
         
+        if self.storage.save_messages(messages) != len(messages):
+            raise RuntimeError(f"Failed to publish {len(messages)} messages to queue {self.name}")
+        
+        logger.debug(f"Published {len(messages)} messages to queue {self.name}")
+        self._wakeup.set()
+        return [message.id for message in messages]
+    
+    def _build_message(
+        self,
+        body: Any,
+        message_type: Optional[str],
+        priority: MessagePriority,
+        delay: Optional[float],
+        max_attempts: int,
+        retry_delay: float,
+        metadata: Optional[Dict[str, Any]]
+    ) -> QueueMessage:
+        """Создание сообщения для публикации."""
         # Добавляем тип сообщения в метаданные
         message_metadata = metadata or {}
         if message_type:
@@ -596,8 +1275,8 @@ class MessageQueue:
         if delay:
             scheduled_for = datetime.now() + timedelta(seconds=delay)
         
-        message = QueueMessage(
-            id=message_id,
+        return QueueMessage(
+            id=str(uuid.uuid4()),
             queue_name=self.name,
             body=body,
             priority=priority,
@@ -606,17 +1285,17 @@ class MessageQueue:
             retry_delay=retry_delay,
             metadata=message_metadata
         )
-        
-        success = self.storage.save_message(message)
-        if success:
-            logger.debug(f"Published message {message_id} to queue {self.name}")
-            return message_id
-        else:
-            raise RuntimeError(f"Failed to publish message to queue {self.name}")
     
     def _process_message(self, message: QueueMessage):
         """Обработка одного сообщения."""
         try:
+            # Сообщение вернулось после истечения видимости сверх лимита попыток
+            if message.attempts > message.max_attempts:
+                self.storage.move_to_dead_letter(
+                    message, "Visibility timeout expired on last attempt"
+                )
+                return
+            
             # Получаем обработчик
             message_type = message.metadata.get('type')
             
@@ -672,40 +1351,96 @@ class MessageQueue:
                     # Превышено количество попыток - перемещаем в dead letter
                     self.storage.move_to_dead_letter(message, error_msg)
                     
+        except Exception as e:
+            logger.error(f"Unexpected error processing message {message.id}: {e}")
+    
+    def _dispatch_loop(self):
+        """
+        Цикл диспетчера: захват пачек и передача их пулу воркеров.
+        
+        В простое диспетчер спит до публикации в этом процессе, коммита
+        из другого соединения (data_version) или наступления времени
+        отложенного сообщения.
+        """
+        logger.info(f"Dispatcher started for queue {self.name}")
+        watcher = self.storage.open_change_watcher()
+        next_due: Optional[float] = None
+        
+        try:
+            while self._running:
+                try:
+                    free = self._free_slots()
+                    if free > 0:
+                        messages = self.storage.claim_messages(
+                            self.name, free, self.visibility_timeout
+                        )
+                        claimed_at = time.time()
+                        for message in messages:
+                            self._handoff.put((claimed_at, message))
+                        if messages:
+                            continue
+                        next_due = self.storage.get_next_due_time(self.name)
+                    
+                    # Ждем повода для следующего захвата
+                    while self._running:
+                        if self._wakeup.wait(self.watch_interval):
+                            self._wakeup.clear()
+                            break
+                        if free <= 0 and self._free_slots() > 0:
+                            break
+                        if watcher.changed():
+                            break
+                        if next_due is not None and time.time() >= next_due:
+                            break
+                    
+                except Exception as e:
+                    logger.error(f"Dispatcher error in queue {self.name}: {e}")
+                    time.sleep(1)
         finally:
-            # Освобождаем семафор
-            self._worker_semaphore.release()
+            watcher.close()
+    
+    def _free_slots(self) -> int:
+        """Сколько сообщений можно захватить: свободные воркеры без уже переданных."""
+        with self._lock:
+            return self._idle_workers - self._handoff.qsize()
     
     def _worker_loop(self, worker_id: int):
-        """Цикл работы воркера."""
+        """Цикл работы воркера пула."""
         logger.info(f"Worker {worker_id} started for queue {self.name}")
+        idle = False
         
-        while self._running:
+        # После остановки воркеры дорабатывают уже переданные сообщения
+        while self._running or not self._handoff.empty():
+            if not idle:
+                idle = True
+                with self._lock:
+                    self._idle_workers += 1
+                # Воркер освободился — диспетчер может захватить сообщение
+                self._wakeup.set()
+            
             try:
-                # Ждем разрешения на обработку
-                if not self._worker_semaphore.acquire(timeout=1):
-                    continue
-                
-                # Получаем следующее сообщение
-                message = self.storage.get_next_message(self.name)
-                
-                if message:
-                    # Запускаем обработку в отдельном потоке
-                    thread = threading.Thread(
-                        target=self._process_message,
-                        args=(message,),
-                        daemon=True,
-                        name=f"MessageProcessor-{message.id[:8]}"
-                    )
-                    thread.start()
-                else:
-                    # Нет сообщений - освобождаем семафор
-                    self._worker_semaphore.release()
-                    time.sleep(0.1)
-                    
-            except Exception as e:
-                logger.error(f"Worker {worker_id} error: {e}")
-                time.sleep(1)
+                claimed_at, message = self._handoff.get(timeout=1)
+            except Empty:
+                continue
+            
+            idle = False
+            with self._lock:
+                self._idle_workers -= 1
+            
+            try:
+                # Таймаут видимости отсчитывается от начала обработки
+                waited = time.time() - claimed_at
+                if waited > self.VISIBILITY_SLACK * self.visibility_timeout:
+                    if not self.storage.extend_visibility(message, self.visibility_timeout):
+                        logger.warning(f"Message {message.id} was reclaimed while waiting for a worker")
+                        continue
+                self._process_message(message)
+            finally:
+                self._handoff.task_done()
+        
+        if idle:
+            with self._lock:
+                self._idle_workers -= 1
     
     def start(self):
         """Запуск очереди."""
@@ -714,8 +1449,17 @@ class MessageQueue:
             return
         
         self._running = True
+        self._workers = []
         
-        # Запускаем воркеров
+        # Запускаем диспетчер
+        self._dispatcher = threading.Thread(
+            target=self._dispatch_loop,
+            name=f"QueueDispatcher-{self.name}",
+            daemon=True
+        )
+        self._dispatcher.start()
+        
+        # Запускаем фиксированный пул воркеров
         for i in range(self.max_concurrent):
             worker = threading.Thread(
                 target=self._worker_loop,
@@ -731,6 +1475,10 @@ class MessageQueue:
     def stop(self):
         """Остановка очереди."""
         self._running = False
+        self._wakeup.set()
+        
+        if self._dispatcher:
+            self._dispatcher.join(timeout=5)
         
         # Ждем завершения воркеров
         for worker in self._workers:
@@ -770,7 +1518,7 @@ class MessageQueue:
                 
                 # Находим failed сообщения
                 cursor.execute("""
-                    SELECT body FROM messages 
+                    SELECT body, status, attempts FROM messages 
                     WHERE queue_name = ? 
                     AND status = 'failed'
                     AND attempts < ?
@@ -778,7 +1526,7 @@ class MessageQueue:
                 
                 count = 0
                 for row in cursor.fetchall():
-                    message = MessageSerializer.deserialize(row['body'])
+                    message = self.storage._row_to_message(row)
                     
                     # Сбрасываем статус для повторной обработки
                     message.status = MessageStatus.PENDING
@@ -809,7 +1557,8 @@ class QueueManager:
         self, 
         name: str, 
         max_concurrent: int = 4,
-        process_timeout: float = 30.0
+        process_timeout: float = 30.0,
+        serializer: Optional[Any] = None
     ) -> MessageQueue:
         """
         Создание новой очереди.
@@ -818,6 +1567,7 @@ class QueueManager:
             name: Имя очереди
             max_concurrent: Максимальное количество параллельных обработчиков
             process_timeout: Таймаут обработки сообщения
+            serializer: Сериализатор сообщений очереди
             
         Returns:
             Созданная очередь
@@ -830,7 +1580,8 @@ class QueueManager:
                 name=name,
                 storage=self.storage,
                 max_concurrent=max_concurrent,
-                process_timeout=process_timeout
+                process_timeout=process_timeout,
+                serializer=serializer
             )
             
             self.queues[name] = queue
@@ -1,16 +1,19 @@
 import json
 import yaml
 import hashlib
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
 import sqlite3
 from contextlib import contextmanager
 import logging
+import threading
 from pathlib import Path
 import difflib
 import re
+import time
+from collections import OrderedDict
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -88,23 +91,286 @@ class ConfigDiff:
     added_keys: List[str]
     removed_keys: List[str]
     modified_keys: List[str]
-    diff_text: str
+    patch: List[Dict[str, Any]] = field(default_factory=list)
+    # Исходные документы для ленивого построения текстового diff
+    text_source: Optional[Tuple[Any, Any]] = field(default=None, repr=False, compare=False)
+    _diff_text: Optional[str] = field(default=None, repr=False, compare=False)
     
-    def to_dict(self) -> Dict[str, Any]:
+    @property
+    def diff_text(self) -> str:
+        """Unified diff в текстовом виде (строится при первом обращении)."""
+        if self._diff_text is None:
+            if self.text_source is None:
+                return ""
+            old_config, new_config = self.text_source
+            old_str = json.dumps(old_config, indent=2, sort_keys=True)
+            new_str = json.dumps(new_config, indent=2, sort_keys=True)
+            self._diff_text = "\n".join(difflib.unified_diff(
+                old_str.splitlines(),
+                new_str.splitlines(),
+                lineterm='',
+                fromfile='old',
+                tofile='new'
+            ))
+        return self._diff_text
+    
+    def to_dict(self, include_text: bool = True) -> Dict[str, Any]:
         """Сериализация в словарь."""
-        return {
+        data = {
             'from_version': self.from_version,
             'to_version': self.to_version,
             'changes': self.changes,
             'added_keys': self.added_keys,
             'removed_keys': self.removed_keys,
             'modified_keys': self.modified_keys,
-            'diff_text': self.diff_text
+            'patch': self.patch
         }
+        if include_text:
+            data['diff_text'] = self.diff_text
+        return data
+
+
+# Проверки простых типов (общие для интерпретатора и компилятора схем)
+_TYPE_CHECKS = {
+    'string': lambda x: isinstance(x, str),
+    'number': lambda x: isinstance(x, (int, float)),
+    'integer': lambda x: isinstance(x, int),
+    'boolean': lambda x: isinstance(x, bool),
+    'null': lambda x: x is None
+}
+
+# Скомпилированный валидатор: (данные, путь, список ошибок) -> None.
+# Путь передается цепочкой кортежей (родитель, сегмент) и превращается
+# в строку только при ошибке
+CompiledValidator = Callable[[Any, Any, List[str]], None]
+
+
+def _format_path(path: Any) -> str:
+    """
+    Строковый путь из цепочки (родитель, сегмент).
+    
+    Args:
+        path: "" для корня, иначе кортеж (родитель, ".ключ" или индекс)
+        
+    Returns:
+        Путь в формате ConfigValidator._validate_recursive
+    """
+    parts = []
+    while path:
+        path, segment = path
+        parts.append(f"[{segment}]" if isinstance(segment, int) else segment)
+    return "".join(reversed(parts))
+
+
+class SchemaCompiler:
+    """
+    Компилятор JSON схем в дерево специализированных замыканий.
+    
+    Схема разбирается один раз: для каждого узла остаются только нужные
+    проверки, regex и enum подготовлены заранее. Результат и порядок ошибок
+    совпадают с ConfigValidator._validate_recursive.
+    """
+    
+    @staticmethod
+    def _noop(data: Any, path: str, errors: List[str]) -> None:
+        return None
+    
+    @classmethod
+    def compile(cls, schema: Dict[str, Any]) -> CompiledValidator:
+        """
+        Компиляция схемы.
+        
+        Args:
+            schema: JSON схема
+            
+        Returns:
+            Функция валидации
+        """
+        checks: List[CompiledValidator] = []
+        
+        expected_type = schema.get('type')
+        if expected_type == 'object':
+            type_check = cls._compile_object(schema)
+        elif expected_type == 'array':
+            type_check = cls._compile_array(schema)
+        elif expected_type in _TYPE_CHECKS:
+            type_check = cls._compile_scalar(expected_type)
+        else:
+            type_check = None
+        
+        if 'enum' in schema:
+            checks.append(cls._compile_enum(schema['enum']))
+        if 'pattern' in schema:
+            checks.append(cls._compile_pattern(schema['pattern']))
+        range_check = cls._compile_range(schema)
+        if range_check is not None:
+            checks.append(range_check)
+        
+        if type_check is None and not checks:
+            return cls._noop
+        if not checks:
+            return type_check
+        
+        if expected_type in ('object', 'array'):
+            # Как и в интерпретаторе, при несовпадении контейнерного типа
+            # остальные проверки узла пропускаются
+            container = dict if expected_type == 'object' else list
+            
+            def validate_node(data, path, errors):
+                type_check(data, path, errors)
+                if isinstance(data, container):
+                    for check in checks:
+                        check(data, path, errors)
+            return validate_node
+        
+        if type_check is not None:
+            checks.insert(0, type_check)
+        checks = tuple(checks)
+        
+        def validate_node(data, path, errors):
+            for check in checks:
+                check(data, path, errors)
+        return validate_node
+    
+    @classmethod
+    def _compile_object(cls, schema: Dict[str, Any]) -> CompiledValidator:
+        required = tuple(schema.get('required', []))
+        properties = {
+            key: cls.compile(sub_schema)
+            for key, sub_schema in schema.get('properties', {}).items()
+        }
+        # Свойства без ограничений проверять не нужно, достаточно знать, что они разрешены
+        allowed = frozenset(properties)
+        properties = {
+            k: (v, f".{k}") for k, v in properties.items() if v is not cls._noop
+        }
+        strict = schema.get('additionalProperties', True) is False
+        
+        def validate_object(data, path, errors):
+            if not isinstance(data, dict):
+                errors.append(f"{_format_path(path)}: Expected object, got {type(data).__name__}")
+                return
+            for name in required:
+                if name not in data:
+                    errors.append(f"{_format_path(path)}.{name}: Required field is missing")
+            if strict:
+                for key, value in data.items():
+                    entry = properties.get(key)
+                    if entry is not None:
+                        entry[0](value, (path, entry[1]), errors)
+                    elif key not in allowed:
+                        errors.append(f"{_format_path(path)}.{key}: Additional property not allowed")
+            elif properties:
+                for key, value in data.items():
+                    entry = properties.get(key)
+                    if entry is not None:
+                        entry[0](value, (path, entry[1]), errors)
+        return validate_object
+    
+    @classmethod
+    def _compile_array(cls, schema: Dict[str, Any]) -> CompiledValidator:
+        item_validator = cls.compile(schema.get('items', {}))
+        
+        if item_validator is cls._noop:
+            def validate_array(data, path, errors):
+                if not isinstance(data, list):
+                    errors.append(f"{_format_path(path)}: Expected array, got {type(data).__name__}")
+            return validate_array
+        
+        def validate_array(data, path, errors):
+            if not isinstance(data, list):
+                errors.append(f"{_format_path(path)}: Expected array, got {type(data).__name__}")
+                return
+            for i, item in enumerate(data):
+                item_validator(item, (path, i), errors)
+        return validate_array
+    
+    @staticmethod
+    def _compile_scalar(expected_type: str) -> CompiledValidator:
+        if expected_type == 'null':
+            def validate_null(data, path, errors):
+                if data is not None:
+                    errors.append(f"{_format_path(path)}: Expected null, got {type(data).__name__}")
+            return validate_null
+        
+        python_types = {
+            'string': str,
+            'number': (int, float),
+            'integer': int,
+            'boolean': bool
+        }[expected_type]
+        
+        def validate_scalar(data, path, errors):
+            if not isinstance(data, python_types):
+                errors.append(f"{_format_path(path)}: Expected {expected_type}, got {type(data).__name__}")
+        return validate_scalar
+    
+    @staticmethod
+    def _compile_enum(values: List[Any]) -> CompiledValidator:
+        message = f"Value must be one of {values}"
+        try:
+            value_set = frozenset(values)
+        except TypeError:
+            value_set = None
+        
+        def validate_enum(data, path, errors):
+            if value_set is not None:
+                try:
+                    if data in value_set:
+                        return
+                except TypeError:
+                    # Нехешируемое значение: проверяем перебором, как интерпретатор
+                    pass
+                else:
+                    errors.append(f"{_format_path(path)}: {message}")
+                    return
+            if data not in values:
+                errors.append(f"{_format_path(path)}: {message}")
+        return validate_enum
+    
+    @staticmethod
+    def _compile_pattern(pattern: str) -> CompiledValidator:
+        regex = re.compile(pattern)
+        
+        def validate_pattern(data, path, errors):
+            if isinstance(data, str) and regex.search(data) is None:
+                errors.append(f"{_format_path(path)}: Value must match pattern {pattern!r}")
+        return validate_pattern
+    
+    @staticmethod
+    def _compile_range(schema: Dict[str, Any]) -> Optional[CompiledValidator]:
+        keys = ('minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum')
+        if not any(key in schema for key in keys):
+            return None
+        
+        has_min, has_max = 'minimum' in schema, 'maximum' in schema
+        has_xmin, has_xmax = 'exclusiveMinimum' in schema, 'exclusiveMaximum' in schema
+        minimum, maximum = schema.get('minimum'), schema.get('maximum')
+        xminimum, xmaximum = schema.get('exclusiveMinimum'), schema.get('exclusiveMaximum')
+        
+        def validate_range(data, path, errors):
+            if not isinstance(data, (int, float)):
+                return
+            if has_min and data < minimum:
+                errors.append(f"{_format_path(path)}: Value must be >= {minimum}")
+            if has_max and data > maximum:
+                errors.append(f"{_format_path(path)}: Value must be <= {maximum}")
+            if has_xmin and data <= xminimum:
+                errors.append(f"{_format_path(path)}: Value must be > {xminimum}")
+            if has_xmax and data >= xmaximum:
+                errors.append(f"{_format_path(path)}: Value must be < {xmaximum}")
+        return validate_range
 
 
 class ConfigValidator:
-    """Валидатор конфигураций."""
+    """
+    Валидатор конфигураций.
+    
+    Схемы компилируются SchemaCompiler при регистрации (или при первой
+    валидации незарегистрированной схемы) и дальше не интерпретируются.
+    Изменять схему после регистрации нельзя: скомпилированная версия
+    не обновится.
+    """
     
     def __init__(self, schema_registry: Optional[Dict[str, Any]] = None):
         """
@@ -114,6 +380,9 @@ class ConfigValidator:
             schema_registry: Реестр JSON схем
         """
         self.schema_registry = schema_registry or {}
+        # id(схемы) -> (схема, скомпилированный валидатор); схема хранится,
+        # чтобы id не переиспользовался другим объектом
+        self._compiled: Dict[int, Tuple[Dict[str, Any], CompiledValidator]] = {}
     
     def register_schema(self, config_type: str, schema: Dict[str, Any]) -> None:
         """
@@ -123,9 +392,22 @@ class ConfigValidator:
             config_type: Тип конфигурации
             schema: JSON схема
         """
+        previous = self.schema_registry.get(config_type)
+        if previous is not None:
+            self._compiled.pop(id(previous), None)
+        
         self.schema_registry[config_type] = schema
+        self._get_compiled(schema)
         logger.info(f"Registered schema for config type: {config_type}")
     
+    def _get_compiled(self, schema: Dict[str, Any]) -> CompiledValidator:
+        """Скомпилированный валидатор для схемы (с кэшированием)."""
+        entry = self._compiled.get(id(schema))
+        if entry is None or entry[0] is not schema:
+            entry = (schema, SchemaCompiler.compile(schema))
+            self._compiled[id(schema)] = entry
+        return entry[1]
+    
     def validate(self, config: Dict[str, Any], schema: Dict[str, Any]) -> Tuple[bool, List[str]]:
         """
         Валидация конфигурации по JSON схеме.
@@ -141,12 +423,70 @@ class ConfigValidator:
         
         try:
             # Простая валидация (в реальном проекте используйте jsonschema)
+            self._get_compiled(schema)(config, "", errors)
+        except Exception as e:
+            errors.append(f"Validation error: {str(e)}")
+        
+        return len(errors) == 0, errors
+    
+    def validate_interpreted(self, config: Dict[str, Any], schema: Dict[str, Any]) -> Tuple[bool, List[str]]:
+        """
+        Валидация обходом схемы без компиляции (эталон для сравнения).
+        
+        Args:
+            config: Конфигурация для валидации
+            schema: JSON схема
+            
+        Returns:
+            (валидна, список ошибок)
+        """
+        errors = []
+        
+        try:
             self._validate_recursive(config, schema, "", errors)
         except Exception as e:
             errors.append(f"Validation error: {str(e)}")
         
         return len(errors) == 0, errors
     
+    def benchmark(
+        self,
+        config: Dict[str, Any],
+        schema: Dict[str, Any],
+        iterations: int = 1000
+    ) -> Dict[str, Any]:
+        """
+        Сравнение скорости скомпилированной и интерпретируемой валидации.
+        
+        Args:
+            config: Конфигурация для валидации
+            schema: JSON схема
+            iterations: Количество прогонов
+            
+        Returns:
+            Время обоих вариантов в секундах, ускорение и совпадение результатов
+        """
+        compiled_result = self.validate(config, schema)
+        interpreted_result = self.validate_interpreted(config, schema)
+        
+        start = time.perf_counter()
+        for _ in range(iterations):
+            self.validate_interpreted(config, schema)
+        interpreted_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for _ in range(iterations):
+            self.validate(config, schema)
+        compiled_time = time.perf_counter() - start
+        
+        return {
+            'iterations': iterations,
+            'interpreted_seconds': interpreted_time,
+            'compiled_seconds': compiled_time,
+            'speedup': interpreted_time / compiled_time if compiled_time > 0 else float('inf'),
+            'results_match': compiled_result == interpreted_result
+        }
+    
     def _validate_recursive(self, data: Any, schema: Dict[str, Any], path: str, errors: List[str]) -> None:
         """
         Рекурсивная валидация.
@@ -190,16 +530,8 @@ class ConfigValidator:
             
             else:
                 # Проверка простых типов
-                type_check = {
-                    'string': lambda x: isinstance(x, str),
-                    'number': lambda x: isinstance(x, (int, float)),
-                    'integer': lambda x: isinstance(x, int),
-                    'boolean': lambda x: isinstance(x, bool),
-                    'null': lambda x: x is None
-                }
-                
-                if expected_type in type_check:
-                    if not type_check[expected_type](data):
+                if expected_type in _TYPE_CHECKS:
+                    if not _TYPE_CHECKS[expected_type](data):
                         errors.append(f"{path}: Expected {expected_type}, got {type(data).__name__}")
         
         # Проверка enum
@@ -207,6 +539,11 @@ class ConfigValidator:
             if data not in schema['enum']:
                 errors.append(f"{path}: Value must be one of {schema['enum']}")
         
+        # Проверка шаблона строки
+        if 'pattern' in schema and isinstance(data, str):
+            if re.search(schema['pattern'], data) is None:
+                errors.append(f"{path}: Value must match pattern {schema['pattern']!r}")
+        
         # Проверка диапазонов
         if isinstance(data, (int, float)):
             if 'minimum' in schema and data < schema['minimum']:
@@ -298,6 +635,24 @@ class ConfigHashCalculator:
         
         return hashlib.sha256(json_str.encode()).hexdigest()
     
+    @staticmethod
+    def calculate_blob_hash(serialized: Union[str, bytes]) -> str:
+        """
+        Точный хеш сохраняемого JSON — ключ блоба в config_blobs.
+        
+        В отличие от calculate_hash, без нормализации: конфигурации,
+        отличающиеся хотя бы в последнем знаке float, получают разные блобы.
+        
+        Args:
+            serialized: JSON в том виде, в каком он хранится
+            
+        Returns:
+            SHA256 хеш
+        """
+        if isinstance(serialized, str):
+            serialized = serialized.encode()
+        return hashlib.sha256(serialized).hexdigest()
+    
     @staticmethod
     def _normalize_config(config: Any) -> Any:
         """
@@ -321,139 +676,265 @@ class ConfigHashCalculator:
             return config
 
 
-class ConfigDiffCalculator:
-    """Калькулятор различий между конфигурациями."""
+class ConfigPatch:
+    """
+    Структурные патчи конфигураций в формате JSON Patch (RFC 6902).
+    
+    Патчи, сохраненные ранее, могут содержать в операциях remove и replace
+    поле "old" с прежним значением; применение патча его игнорирует.
+    """
     
     @staticmethod
-    def calculate_diff(old_config: Dict[str, Any], new_config: Dict[str, Any]) -> ConfigDiff:
+    def _escape(token: Any) -> str:
+        return str(token).replace('~', '~0').replace('/', '~1')
+    
+    @staticmethod
+    def _unescape(token: str) -> str:
+        return token.replace('~1', '/').replace('~0', '~')
+    
+    @staticmethod
+    def make(old: Any, new: Any) -> List[Dict[str, Any]]:
         """
-        Вычисление различий между двумя конфигурациями.
+        Построение патча, превращающего old в new.
         
         Args:
-            old_config: Старая конфигурация
-            new_config: Новая конфигурация
+            old: Исходный документ
+            new: Целевой документ
             
         Returns:
-            Объект с различиями
-        """
-        changes = []
-        added_keys = []
-        removed_keys = []
-        modified_keys = []
-        
-        # Сравниваем ключи
-        old_keys = set(ConfigDiffCalculator._flatten_dict(old_config).keys())
-        new_keys = set(ConfigDiffCalculator._flatten_dict(new_config).keys())
-        
-        added_keys = list(new_keys - old_keys)
-        removed_keys = list(old_keys - new_keys)
-        common_keys = old_keys & new_keys
-        
-        # Находим измененные значения
-        for key in common_keys:
-            old_value = ConfigDiffCalculator._get_nested_value(old_config, key)
-            new_value = ConfigDiffCalculator._get_nested_value(new_config, key)
-            
-            if old_value != new_value:
-                modified_keys.append(key)
-                changes.append({
-                    'key': key,
-                    'old_value': old_value,
-                    'new_value': new_value,
-                    'change_type': 'modified'
-                })
-        
-        # Форматируем diff в текстовом виде
-        old_str = json.dumps(old_config, indent=2, sort_keys=True)
-        new_str = json.dumps(new_config, indent=2, sort_keys=True)
-        diff_text = "\n".join(difflib.unified_diff(
-            old_str.splitlines(),
-            new_str.splitlines(),
-            lineterm='',
-            fromfile='old',
-            tofile='new'
-        ))
-        
-        return ConfigDiff(
-            from_version=0,  # Заполнится позже
-            to_version=0,    # Заполнится позже
-            changes=changes,
-            added_keys=added_keys,
-            removed_keys=removed_keys,
-            modified_keys=modified_keys,
-            diff_text=diff_text
-        )
+            Список операций
+        """
+        # Тот же обход, что и у ConfigDiffCalculator; списки — только по индексу
+        walker = _StructuralDiff(())
+        walker.walk(old, new, '', '', walker.patch)
+        return walker.patch
     
     @staticmethod
-    def _flatten_dict(d: Dict[str, Any], parent_key: str = '') -> Dict[str, Any]:
+    def apply(document: Any, ops: List[Dict[str, Any]]) -> Any:
         """
-        Преобразование вложенного словаря в плоский.
+        Применение патча к документу (документ изменяется на месте).
         
         Args:
-            d: Словарь для преобразования
-            parent_key: Родительский ключ
+            document: Исходный документ
+            ops: Операции патча
             
         Returns:
-            Плоский словарь
-        """
-        items = []
-        for k, v in d.items():
-            new_key = f"{parent_key}.{k}" if parent_key else k
-            
-            if isinstance(v, dict):
-                items.extend(ConfigDiffCalculator._flatten_dict(v, new_key).items())
-            elif isinstance(v, list):
-                for i, item in enumerate(v):
-                    if isinstance(item, dict):
-                        items.extend(
-                            ConfigDiffCalculator._flatten_dict(item, f"{new_key}[{i}]").items()
-                        )
-                    else:
-                        items.append((f"{new_key}[{i}]", item))
+            Результирующий документ
+        """
+        for op in ops:
+            path = op['path']
+            if not path:
+                # Операция над корнем документа
+                document = op.get('value') if op['op'] != 'remove' else None
+                continue
+            
+            tokens = [ConfigPatch._unescape(t) for t in path.split('/')[1:]]
+            parent = document
+            for token in tokens[:-1]:
+                parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+            
+            last = tokens[-1]
+            if isinstance(parent, list):
+                index = len(parent) if last == '-' else int(last)
+                if op['op'] == 'add':
+                    parent.insert(index, op['value'])
+                elif op['op'] == 'remove':
+                    del parent[index]
+                else:
+                    parent[index] = op['value']
             else:
-                items.append((new_key, v))
+                if op['op'] == 'remove':
+                    del parent[last]
+                else:
+                    parent[last] = op['value']
         
-        return dict(items)
+        return document
+
+
+class ConfigDiffCalculator:
+    """
+    Калькулятор различий между конфигурациями.
+    
+    Различия ищутся одним рекурсивным обходом обоих деревьев, поэтому
+    время линейно по размеру конфигураций. Списки сравниваются по индексу
+    либо, если у всех элементов есть общее поле-идентификатор из list_keys,
+    по значению этого поля.
+    """
+    
+    DEFAULT_LIST_KEYS = ('id', 'name', 'key')
     
     @staticmethod
-    def _get_nested_value(d: Dict[str, Any], key: str) -> Any:
+    def calculate_diff(
+        old_config: Dict[str, Any],
+        new_config: Dict[str, Any],
+        list_keys: Optional[Tuple[str, ...]] = DEFAULT_LIST_KEYS
+    ) -> ConfigDiff:
         """
-        Получение значения по пути в формате "key1.key2[0].key3".
+        Вычисление различий между двумя конфигурациями.
         
         Args:
-            d: Словарь
-            key: Путь к значению
+            old_config: Старая конфигурация
+            new_config: Новая конфигурация
+            list_keys: Поля-идентификаторы для сопоставления элементов списков
+                (None или пустой кортеж — сопоставление только по индексу)
             
         Returns:
-            Значение или None если не найдено
-        """
-        parts = re.split(r'[\.\[\]]', key)
-        parts = [p for p in parts if p and not p.endswith(']')]
-        
-        current = d
-        for part in parts:
-            if ']' in part:
-                # Обработка массивов
-                array_part, index = part.split('[')
-                index = int(index.rstrip(']'))
-                current = current.get(array_part, [])
-                if isinstance(current, list) and len(current) > index:
-                    current = current[index]
+            Объект с различиями; JSON Patch в поле patch, текстовый diff
+            строится лениво при обращении к diff_text
+        """
+        walker = _StructuralDiff(list_keys or ())
+        walker.walk(old_config, new_config, '', '', walker.patch)
+        
+        return ConfigDiff(
+            from_version=0,  # Заполнится позже
+            to_version=0,    # Заполнится позже
+            changes=walker.changes,
+            added_keys=walker.added_keys,
+            removed_keys=walker.removed_keys,
+            modified_keys=walker.modified_keys,
+            patch=walker.patch,
+            text_source=(old_config, new_config)
+        )
+
+
+class _StructuralDiff:
+    """Однопроходный обход двух деревьев для ConfigDiffCalculator."""
+    
+    def __init__(self, list_keys: Tuple[str, ...]):
+        self.list_keys = list_keys
+        self.changes: List[Dict[str, Any]] = []
+        self.added_keys: List[str] = []
+        self.removed_keys: List[str] = []
+        self.modified_keys: List[str] = []
+        self.patch: List[Dict[str, Any]] = []
+    
+    def _added(self, key: str, pointer: str, value: Any, ops: List[Dict[str, Any]]):
+        self.added_keys.append(key)
+        self.changes.append({'key': key, 'old_value': None, 'new_value': value, 'change_type': 'added'})
+        ops.append({'op': 'add', 'path': pointer, 'value': value})
+    
+    def _removed(self, key: str, pointer: str, value: Any, ops: List[Dict[str, Any]]):
+        self.removed_keys.append(key)
+        self.changes.append({'key': key, 'old_value': value, 'new_value': None, 'change_type': 'removed'})
+        ops.append({'op': 'remove', 'path': pointer})
+    
+    def walk(self, old: Any, new: Any, key: str, pointer: str, ops: List[Dict[str, Any]]):
+        """
+        Сравнение узлов.
+        
+        Args:
+            old: Узел старого документа
+            new: Узел нового документа
+            key: Путь в формате "a.b[0].c" (для отчета)
+            pointer: Путь JSON Pointer (для патча)
+            ops: Куда добавлять операции патча
+        """
+        if isinstance(old, dict) and isinstance(new, dict):
+            for k, old_value in old.items():
+                child_key = f"{key}.{k}" if key else str(k)
+                child_pointer = f"{pointer}/{ConfigPatch._escape(k)}"
+                if k in new:
+                    self.walk(old_value, new[k], child_key, child_pointer, ops)
                 else:
-                    return None
+                    self._removed(child_key, child_pointer, old_value, ops)
+            for k, new_value in new.items():
+                if k not in old:
+                    child_key = f"{key}.{k}" if key else str(k)
+                    self._added(child_key, f"{pointer}/{ConfigPatch._escape(k)}", new_value, ops)
+        
+        elif isinstance(old, list) and isinstance(new, list):
+            list_key = self._common_list_key(old, new)
+            if list_key is None:
+                self._walk_indexed(old, new, key, pointer, ops)
+            else:
+                self._walk_keyed(old, new, list_key, key, pointer, ops)
+        
+        elif old != new or type(old) is not type(new):
+            self.modified_keys.append(key)
+            self.changes.append({'key': key, 'old_value': old, 'new_value': new, 'change_type': 'modified'})
+            ops.append({'op': 'replace', 'path': pointer, 'value': new})
+    
+    def _common_list_key(self, old: list, new: list) -> Optional[str]:
+        """Поле, уникально идентифицирующее элементы обоих списков."""
+        if not old or not new:
+            return None
+        for list_key in self.list_keys:
+            ok = True
+            for items in (old, new):
+                seen = set()
+                for item in items:
+                    if not isinstance(item, dict) or list_key not in item:
+                        ok = False
+                        break
+                    value = item[list_key]
+                    if not isinstance(value, (str, int)) or value in seen:
+                        ok = False
+                        break
+                    seen.add(value)
+                if not ok:
+                    break
+            if ok:
+                return list_key
+        return None
+    
+    def _walk_indexed(self, old: list, new: list, key: str, pointer: str, ops: List[Dict[str, Any]]):
+        common = min(len(old), len(new))
+        for i in range(common):
+            self.walk(old[i], new[i], f"{key}[{i}]", f"{pointer}/{i}", ops)
+        # Удаляем с конца, чтобы индексы в патче не сдвигались
+        for i in range(len(old) - 1, common - 1, -1):
+            self._removed(f"{key}[{i}]", f"{pointer}/{i}", old[i], ops)
+        for i in range(common, len(new)):
+            self._added(f"{key}[{i}]", f"{pointer}/{i}", new[i], ops)
+    
+    def _walk_keyed(
+        self,
+        old: list,
+        new: list,
+        list_key: str,
+        key: str,
+        pointer: str,
+        ops: List[Dict[str, Any]]
+    ):
+        old_by_key = {item[list_key]: item for item in old}
+        new_keys = {item[list_key] for item in new}
+        
+        # Порядок общих элементов; если он изменился, в патче список заменяется целиком
+        kept = [item[list_key] for item in old if item[list_key] in new_keys]
+        order_kept = kept == [item[list_key] for item in new if item[list_key] in old_by_key]
+        list_ops = ops if order_kept else []
+        
+        for i in range(len(old) - 1, -1, -1):
+            if old[i][list_key] not in new_keys:
+                self._removed(f"{key}[{list_key}={old[i][list_key]}]", f"{pointer}/{i}", old[i], list_ops)
+        
+        # После удалений префикс списка совпадает с new[:j], а следующий
+        # оставшийся элемент — это сопоставленный с new[j]
+        for j, item in enumerate(new):
+            item_key = f"{key}[{list_key}={item[list_key]}]"
+            if item[list_key] in old_by_key:
+                self.walk(old_by_key[item[list_key]], item, item_key, f"{pointer}/{j}", list_ops)
             else:
-                current = current.get(part)
-                if current is None:
-                    return None
+                self._added(item_key, f"{pointer}/{j}", item, list_ops)
         
-        return current
+        if not order_kept:
+            ops.append({'op': 'replace', 'path': pointer, 'value': new})
 
 
 class ConfigStorage:
     """Хранилище конфигураций."""
     
-    def __init__(self, db_path: str = "config_versions.db"):
+    def __init__(self, db_path: str = "config_versions.db", snapshot_interval: int = 20):
+        """
+        Инициализация хранилища.
+        
+        Args:
+            db_path: Путь к файлу БД
+            snapshot_interval: Полный снимок сохраняется каждые K версий,
+                остальные версии хранятся как патч к предыдущей
+        """
         self.db_path = db_path
+        self.snapshot_interval = max(1, snapshot_interval)
         self._init_database()
     
     def _init_database(self):
@@ -510,6 +991,53 @@ class ConfigStorage:
                 )
             """)
             
+            # Содержимое, адресуемое хешем: одинаковые конфигурации (в разных
+            # окружениях, после откатов) хранятся один раз
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS config_blobs (
+                    hash TEXT PRIMARY KEY,
+                    content BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    ref_count INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Вид хранения версии: 'blob' (полный JSON в config_blobs по blob_hash),
+            # 'delta' (патч к version - 1) или 'snapshot' (полный JSON в строке версии)
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(config_versions)")}
+            if 'storage_kind' not in columns:
+                cursor.execute(
+                    "ALTER TABLE config_versions ADD COLUMN storage_kind TEXT NOT NULL DEFAULT 'snapshot'"
+                )
+            # Ключ блоба — точный хеш JSON; hash версии нормализован (округляет
+            # float) и годится только для сравнения содержимого
+            if 'blob_hash' not in columns:
+                cursor.execute("ALTER TABLE config_versions ADD COLUMN blob_hash TEXT")
+                # Блобы, записанные раньше, остаются под прежним ключом
+                cursor.execute("""
+                    UPDATE config_versions SET blob_hash = hash
+                    WHERE storage_kind = 'blob'
+                """)
+            
+            # Переносим полные снимки, сохраненные в строках версий, в config_blobs
+            conn.create_function(
+                'blob_hash', 1, ConfigHashCalculator.calculate_blob_hash, deterministic=True
+            )
+            cursor.execute("""
+                INSERT INTO config_blobs (hash, content, size, ref_count)
+                SELECT blob_hash(content), MIN(content), LENGTH(MIN(content)), COUNT(*)
+                FROM config_versions
+                WHERE storage_kind = 'snapshot'
+                GROUP BY blob_hash(content)
+                ON CONFLICT(hash) DO UPDATE SET ref_count = ref_count + excluded.ref_count
+            """)
+            cursor.execute("""
+                UPDATE config_versions
+                SET storage_kind = 'blob', blob_hash = blob_hash(content), content = ''
+                WHERE storage_kind = 'snapshot'
+            """)
+            
             # Индексы для быстрого поиска
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_config_versions_config ON config_versions(config_id, version)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_config_versions_hash ON config_versions(hash)")
@@ -582,7 +1110,7 @@ class ConfigStorage:
             version = 1
             version_id = self._create_version(
                 config_id, version, content, created_by, 
-                ChangeType.CREATED, None, conn
+                ChangeType.CREATED, None, conn, previous_content=None
             )
             
             # Обновляем текущую версию
@@ -605,11 +1133,17 @@ class ConfigStorage:
         created_by: str,
         change_type: ChangeType,
         parent_version: Optional[int],
-        conn: sqlite3.Connection
+        conn: sqlite3.Connection,
+        previous_content: Optional[Dict[str, Any]] = None
     ) -> str:
         """
         Создание версии конфигурации.
         
+        Если такое содержимое уже хранится (откат, одинаковые конфигурации),
+        версия только ссылается на блоб по точному хешу JSON. Иначе каждая
+        snapshot_interval-я версия записывается новым блобом, остальные —
+        патчем относительно предыдущей версии.
+        
         Args:
             config_id: ID конфигурации
             version: Номер версии
@@ -618,6 +1152,7 @@ class ConfigStorage:
             change_type: Тип изменения
             parent_version: Родительская версия
             conn: Подключение к БД
+            previous_content: Содержимое версии version - 1 (None — сохранить снимок)
             
         Returns:
             ID версии
@@ -629,25 +1164,115 @@ class ConfigStorage:
         version_id = f"{config_id}_v{version}"
         
         cursor = conn.cursor()
+        
+        blob = json.dumps(content)
+        blob_hash = ConfigHashCalculator.calculate_blob_hash(blob)
+        
+        # Такое содержимое уже хранится: версия ссылается на существующий блоб
+        cursor.execute(
+            "UPDATE config_blobs SET ref_count = ref_count + 1 WHERE hash = ?",
+            (blob_hash,)
+        )
+        
+        if cursor.rowcount > 0:
+            storage_kind = 'blob'
+            stored = ''
+        elif previous_content is None or (version - 1) % self.snapshot_interval == 0:
+            storage_kind = 'blob'
+            stored = ''
+            cursor.execute(
+                "INSERT INTO config_blobs (hash, content, size, ref_count) VALUES (?, ?, ?, 1)",
+                (blob_hash, blob, len(blob))
+            )
+        else:
+            storage_kind = 'delta'
+            stored = json.dumps(ConfigPatch.make(previous_content, content))
+            blob_hash = None
+        
         cursor.execute("""
             INSERT INTO config_versions 
             (id, config_id, version, content, hash, created_by, 
-             comment, change_type, parent_version)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+             comment, change_type, parent_version, storage_kind, blob_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (
             version_id,
             config_id,
             version,
-            json.dumps(content),
+            stored,
             config_hash,
             created_by,
             f"{change_type.value} version {version}",
             change_type.value,
-            parent_version
+            parent_version,
+            storage_kind,
+            blob_hash
         ))
         
         return version_id
     
+    def _load_versions(
+        self,
+        conn: sqlite3.Connection,
+        config_id: str,
+        versions: List[int]
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Восстановление содержимого нескольких версий.
+        
+        Каждая версия восстанавливается от своего ближайшего снимка, поэтому
+        число применяемых патчей не превышает snapshot_interval на версию
+        независимо от расстояния между запрошенными версиями. Версии с общим
+        снимком восстанавливаются одним проходом.
+        
+        Args:
+            conn: Подключение к БД
+            config_id: ID конфигурации
+            versions: Номера нужных версий
+            
+        Returns:
+            Словарь {версия: содержимое} для найденных версий
+        """
+        cursor = conn.cursor()
+        
+        # Ближайший снимок (не патч) не новее каждой версии
+        segments: Dict[int, List[int]] = {}
+        for version in set(versions):
+            cursor.execute("""
+                SELECT MAX(version) AS base FROM config_versions
+                WHERE config_id = ? AND version <= ? AND storage_kind != 'delta'
+            """, (config_id, version))
+            base = cursor.fetchone()['base']
+            if base is not None:
+                segments.setdefault(base, []).append(version)
+        
+        result: Dict[int, Dict[str, Any]] = {}
+        
+        for base, wanted in segments.items():
+            high = max(wanted)
+            cursor.execute("""
+                SELECT cv.version, cv.storage_kind, COALESCE(b.content, cv.content) AS content
+                FROM config_versions cv
+                LEFT JOIN config_blobs b ON cv.storage_kind = 'blob' AND b.hash = cv.blob_hash
+                WHERE cv.config_id = ? AND cv.version BETWEEN ? AND ?
+                ORDER BY cv.version ASC
+            """, (config_id, base, high))
+            
+            content: Any = None
+            for row in cursor.fetchall():
+                if row['storage_kind'] != 'delta':
+                    content = json.loads(row['content'])
+                else:
+                    content = ConfigPatch.apply(content, json.loads(row['content']))
+                
+                if row['version'] in wanted:
+                    # Копия через JSON: дальнейшие патчи меняют документ на месте
+                    if row['version'] == high:
+                        result[row['version']] = content
+                    else:
+                        result[row['version']] = json.loads(json.dumps(content))
+        
+        return result
+    
     def update_config(
         self,
         config_id: str,
@@ -670,9 +1295,9 @@ class ConfigStorage:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             
-            # Получаем текущую конфигурацию
+            # Получаем текущую версию и ее хеш
             cursor.execute("""
-                SELECT c.current_version, cv.content, cv.hash
+                SELECT c.current_version, cv.hash
                 FROM configs c
                 LEFT JOIN config_versions cv ON c.id = cv.config_id AND c.current_version = cv.version
                 WHERE c.id = ?
@@ -683,7 +1308,6 @@ class ConfigStorage:
                 raise ValueError(f"Config '{config_id}' not found")
             
             current_version = row['current_version']
-            current_content = json.loads(row['content']) if row['content'] else {}
             current_hash = row['hash']
             
             # Вычисляем хеш новой конфигурации
@@ -694,12 +1318,16 @@ class ConfigStorage:
                 logger.info(f"Config '{config_id}' not changed, skipping version creation")
                 return current_version, False
             
+            # Текущее содержимое нужно только для построения патча
+            current_content = self._load_versions(conn, config_id, [current_version]).get(current_version)
+            
             # Создаем новую версию
             new_version = current_version + 1
             
             version_id = self._create_version(
                 config_id, new_version, content, created_by,
-                ChangeType.UPDATED, current_version, conn
+                ChangeType.UPDATED, current_version, conn,
+                previous_content=current_content
             )
             
             # Обновляем комментарий если указан
@@ -736,28 +1364,22 @@ class ConfigStorage:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             
-            if version is None:
-                # Получаем текущую версию
-                cursor.execute("""
-                    SELECT cv.content, cv.version, c.format
-                    FROM configs c
-                    JOIN config_versions cv ON c.id = cv.config_id AND c.current_version = cv.version
-                    WHERE c.id = ?
-                """, (config_id,))
-            else:
-                # Получаем конкретную версию
-                cursor.execute("""
-                    SELECT cv.content, cv.version, c.format
-                    FROM configs c
-                    JOIN config_versions cv ON c.id = cv.config_id AND cv.version = ?
-                    WHERE c.id = ?
-                """, (version, config_id))
-            
+            cursor.execute(
+                "SELECT current_version, format FROM configs WHERE id = ?",
+                (config_id,)
+            )
             row = cursor.fetchone()
-            if row:
+            if not row:
+                return None
+            
+            # None — текущая версия
+            target = row['current_version'] if version is None else version
+            contents = self._load_versions(conn, config_id, [target])
+            
+            if target in contents:
                 return {
-                    'content': json.loads(row['content']),
-                    'version': row['version'],
+                    'content': contents[target],
+                    'version': target,
                     'format': ConfigFormat(row['format'])
                 }
             
@@ -818,17 +1440,17 @@ class ConfigStorage:
         Returns:
             Различия или None если версии не найдены
         """
-        # Получаем конфигурации
-        from_config_data = self.get_config(config_id, from_version)
-        to_config_data = self.get_config(config_id, to_version)
+        with self._get_connection() as conn:
+            # Каждая версия восстанавливается от своего ближайшего снимка
+            contents = self._load_versions(conn, config_id, [from_version, to_version])
         
-        if not from_config_data or not to_config_data:
+        if from_version not in contents or to_version not in contents:
             return None
         
         # Вычисляем различия
         diff = ConfigDiffCalculator.calculate_diff(
-            from_config_data['content'],
-            to_config_data['content']
+            contents[from_version],
+            contents[to_version]
         )
         
         diff.from_version = from_version
@@ -851,18 +1473,6 @@ class ConfigStorage:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             
-            # Получаем целевую версию
-            cursor.execute("""
-                SELECT content FROM config_versions 
-                WHERE config_id = ? AND version = ?
-            """, (config_id, target_version))
-            
-            row = cursor.fetchone()
-            if not row:
-                raise ValueError(f"Version {target_version} not found for config '{config_id}'")
-            
-            target_content = json.loads(row['content'])
-            
             # Получаем текущую версию
             cursor.execute("""
                 SELECT current_version FROM configs WHERE id = ?
@@ -874,11 +1484,19 @@ class ConfigStorage:
             
             current_version = current_version_row['current_version']
             
-            # Создаем новую версию с типом ROLLBACK
+            # Целевая и текущая версии восстанавливаются от своих снимков
+            contents = self._load_versions(conn, config_id, [target_version, current_version])
+            if target_version not in contents:
+                raise ValueError(f"Version {target_version} not found for config '{config_id}'")
+            
+            target_content = contents[target_version]
+            
+            # Создаем новую версию с типом ROLLBACK (патч от текущей к целевой)
             new_version = current_version + 1
             version_id = self._create_version(
                 config_id, new_version, target_content, created_by,
-                ChangeType.ROLLBACK, current_version, conn
+                ChangeType.ROLLBACK, current_version, conn,
+                previous_content=contents.get(current_version)
             )
             
             # Обновляем комментарий
@@ -900,11 +1518,181 @@ class ConfigStorage:
             logger.info(f"Rolled back config '{config_id}' from version {current_version} to {target_version}")
             return True
     
+    def delete_config(self, config_id: str) -> bool:
+        """
+        Удаление конфигурации со всеми версиями и деплойментами.
+        
+        Счетчики ссылок блобов уменьшаются; блобы, на которые больше
+        никто не ссылается, удаляются.
+        
+        Args:
+            config_id: ID конфигурации
+            
+        Returns:
+            True если конфигурация была удалена
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            
+            cursor.execute("""
+                SELECT blob_hash, COUNT(*) AS refs
+                FROM config_versions
+                WHERE config_id = ? AND storage_kind = 'blob'
+                GROUP BY blob_hash
+            """, (config_id,))
+            blob_refs = [(row['refs'], row['blob_hash']) for row in cursor.fetchall()]
+            
+            cursor.executemany(
+                "UPDATE config_blobs SET ref_count = ref_count - ? WHERE hash = ?",
+                blob_refs
+            )
+            cursor.executemany(
+                "DELETE FROM config_blobs WHERE hash = ? AND ref_count <= 0",
+                [(blob_hash,) for _, blob_hash in blob_refs]
+            )
+            
+            cursor.execute("DELETE FROM config_versions WHERE config_id = ?", (config_id,))
+            cursor.execute("DELETE FROM deployments WHERE config_id = ?", (config_id,))
+            cursor.execute("DELETE FROM configs WHERE id = ?", (config_id,))
+            deleted = cursor.rowcount > 0
+            
+            conn.commit()
+        
+        if deleted:
+            logger.info(f"Deleted config '{config_id}'")
+        return deleted
+    
+    def record_deployment(
+        self,
+        config_id: str,
+        version: int,
+        environment: str,
+        deployed_by: str = "system",
+        status: str = "success",
+        notes: Optional[str] = None
+    ) -> str:
+        """
+        Запись о применении версии конфигурации в окружении.
+        
+        Args:
+            config_id: ID конфигурации
+            version: Примененная версия
+            environment: Окружение
+            deployed_by: Кто применил
+            status: Статус деплоймента ('success' делает версию текущей для окружения)
+            notes: Примечания
+            
+        Returns:
+            ID деплоймента
+        """
+        deployment_id = hashlib.md5(
+            f"{config_id}:{environment}:{version}:{time.time_ns()}".encode()
+        ).hexdigest()
+        
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO deployments
+                (id, config_id, version, deployed_by, environment, status, notes)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (deployment_id, config_id, version, deployed_by, environment, status, notes))
+            conn.commit()
+        
+        logger.info(f"Deployed config '{config_id}' version {version} to {environment} ({status})")
+        return deployment_id
+    
+    def get_version_watermarks(
+        self,
+        keys: List[Tuple[str, Optional[str]]]
+    ) -> Dict[Tuple[str, Optional[str]], Optional[int]]:
+        """
+        Актуальные номера версий для пар (config_id, окружение).
+        
+        Для окружения None берется текущая версия конфигурации, для
+        остальных — версия последнего успешного деплоймента.
+        
+        Args:
+            keys: Пары (ID конфигурации, окружение)
+            
+        Returns:
+            Словарь {пара: версия или None если нет}
+        """
+        result: Dict[Tuple[str, Optional[str]], Optional[int]] = {key: None for key in keys}
+        
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            
+            config_ids = sorted({config_id for config_id, environment in keys if environment is None})
+            for i in range(0, len(config_ids), 500):
+                chunk = config_ids[i:i + 500]
+                cursor.execute(
+                    f"SELECT id, current_version FROM configs "
+                    f"WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                for row in cursor.fetchall():
+                    result[(row['id'], None)] = row['current_version']
+            
+            for config_id, environment in keys:
+                if environment is None:
+                    continue
+                cursor.execute("""
+                    SELECT version FROM deployments
+                    WHERE config_id = ? AND environment = ? AND status = 'success'
+                    ORDER BY deployed_at DESC, rowid DESC
+                    LIMIT 1
+                """, (config_id, environment))
+                row = cursor.fetchone()
+                if row:
+                    result[(config_id, environment)] = row['version']
+        
+        return result
+    
+    def get_blob_stats(self) -> Dict[str, Any]:
+        """
+        Статистика хранилища блобов.
+        
+        Returns:
+            Количество блобов, их суммарный размер и число ссылок на них
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COUNT(*) AS blobs,
+                       COALESCE(SUM(size), 0) AS total_size,
+                       COALESCE(SUM(ref_count), 0) AS ref_count
+                FROM config_blobs
+            """)
+            row = cursor.fetchone()
+            return {
+                'blobs': row['blobs'],
+                'total_size': row['total_size'],
+                'references': row['ref_count']
+            }
+    
+    def find_configs_by_content(self, content: Dict[str, Any], limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Поиск конфигураций, текущая версия которых совпадает с содержимым.
+        
+        Args:
+            content: Содержимое конфигурации
+            limit: Максимальное количество результатов
+            
+        Returns:
+            Список конфигураций
+        """
+        return self.search_configs(
+            content_hash=ConfigHashCalculator.calculate_hash(content),
+            limit=limit
+        )
+    
     def search_configs(
         self,
         name_filter: Optional[str] = None,
         tag_filter: Optional[List[str]] = None,
-        limit: int = 50
+        limit: int = 50,
+        content_hash: Optional[str] = None
     ) -> List[Dict[str, Any]]:
         """
         Поиск конфигураций.
@@ -913,6 +1701,7 @@ class ConfigStorage:
             name_filter: Фильтр по имени (подстрока)
             tag_filter: Фильтр по тегам
             limit: Максимальное количество результатов
+            content_hash: Хеш содержимого текущей версии (поиск по индексу)
             
         Returns:
             Список конфигураций
@@ -931,6 +1720,7 @@ class ConfigStorage:
                     c.updated_at,
                     c.created_by,
                     c.tags,
+                    cv.hash,
                     cv.created_at as last_updated
                 FROM configs c
                 JOIN config_versions cv ON c.id = cv.config_id AND c.current_version = cv.version
@@ -939,6 +1729,11 @@ class ConfigStorage:
             
             params = []
             
+            if content_hash:
+                # Точное совпадение по idx_config_versions_hash
+                query += " AND cv.hash = ?"
+                params.append(content_hash)
+            
             if name_filter:
                 query += " AND c.name LIKE ?"
                 params.append(f"%{name_filter}%")
@@ -969,19 +1764,315 @@ class ConfigStorage:
                     'updated_at': row['updated_at'],
                     'created_by': row['created_by'],
                     'tags': json.loads(row['tags']) if row['tags'] else [],
+                    'hash': row['hash'],
                     'last_updated': row['last_updated']
                 })
             
             return configs
 
 
+# Подписчик на изменения: (ID конфигурации, окружение, новые данные или None)
+ConfigCallback = Callable[[str, Optional[str], Optional[Dict[str, Any]]], None]
+
+
+class ConfigCache:
+    """
+    Кэш разобранных конфигураций для чтения в горячем пути.
+    
+    Записи хранятся по паре (config_id, окружение). Перед чтением
+    проверяется PRAGMA data_version на отдельном соединении: значение
+    меняется при любом коммите другого соединения. Только тогда одним
+    запросом сверяются номера версий закэшированных записей, и
+    устаревшие записи перечитываются, а подписчики получают уведомление.
+    
+    Возвращаемые словари общие для всех читателей, изменять их нельзя.
+    Число записей ограничено max_entries, вытесняются давно не читавшиеся
+    записи без подписчиков.
+    """
+    
+    def __init__(self, storage: ConfigStorage, check_interval: float = 0.0, max_entries: int = 1024):
+        """
+        Инициализация кэша.
+        
+        Args:
+            storage: Хранилище конфигураций
+            check_interval: Минимальный интервал между проверками data_version
+                в секундах (0 — проверять при каждом чтении)
+            max_entries: Максимальное число записей в кэше
+        """
+        self.storage = storage
+        self.check_interval = check_interval
+        self.max_entries = max(1, max_entries)
+        
+        self._entries: 'OrderedDict[Tuple[str, Optional[str]], Optional[Dict[str, Any]]]' = OrderedDict()
+        self._subscribers: Dict[Tuple[str, Optional[str]], List[ConfigCallback]] = {}
+        self._lock = threading.RLock()
+        
+        self._watch_conn = sqlite3.connect(storage.db_path, check_same_thread=False)
+        self._data_version = self._read_data_version()
+        self._last_check = time.monotonic()
+    
+    def _read_data_version(self) -> int:
+        return self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+    
+    def _load(self, config_id: str, environment: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Чтение записи из хранилища."""
+        if environment is None:
+            return self.storage.get_config(config_id)
+        
+        version = self.storage.get_version_watermarks([(config_id, environment)])[(config_id, environment)]
+        if version is None:
+            return None
+        
+        config_data = self.storage.get_config(config_id, version)
+        if config_data is not None:
+            config_data['environment'] = environment
+        return config_data
+    
+    def _store(self, key: Tuple[str, Optional[str]], config_data: Optional[Dict[str, Any]]) -> None:
+        """Сохранение записи с вытеснением давно не читавшихся (под _lock)."""
+        self._entries[key] = config_data
+        self._entries.move_to_end(key)
+        if len(self._entries) <= self.max_entries:
+            return
+        # Записи с подписчиками не вытесняются: по ним refresh() сверяет версии
+        for old_key in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if old_key not in self._subscribers:
+                del self._entries[old_key]
+    
+    def get(self, config_id: str, environment: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Получение конфигурации через кэш.
+        
+        Args:
+            config_id: ID конфигурации
+            environment: Окружение (None — текущая версия)
+            
+        Returns:
+            Данные конфигурации или None если не найдена
+        """
+        self.refresh()
+        
+        key = (config_id, environment)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            data_version = self._read_data_version()
+        
+        config_data = self._load(config_id, environment)
+        with self._lock:
+            # Коммит во время чтения мог уже учесть refresh() другого потока,
+            # и устаревшая запись больше не перепроверялась бы: ее не кэшируем
+            if self._read_data_version() == data_version:
+                self._store(key, config_data)
+        return config_data
+    
+    def refresh(self, force: bool = False) -> None:
+        """
+        Сверка кэша с хранилищем, если в БД были коммиты.
+        
+        Args:
+            force: Проверить версии без учета data_version и интервала
+        """
+        notifications = []
+        
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            
+            data_version = self._read_data_version()
+            if not force and data_version == self._data_version:
+                return
+            self._data_version = data_version
+            
+            keys = list(set(self._entries) | set(self._subscribers))
+            if not keys:
+                return
+            
+            try:
+                watermarks = self.storage.get_version_watermarks(keys)
+            except Exception as e:
+                logger.error(f"Failed to check config versions: {e}")
+                self._entries.clear()
+                return
+            
+            for key in keys:
+                cached = self._entries.get(key)
+                cached_version = cached['version'] if cached else None
+                if key in self._entries and watermarks[key] == cached_version:
+                    continue
+                
+                config_data = self._load(*key) if watermarks[key] is not None else None
+                self._entries[key] = config_data
+                for callback in self._subscribers.get(key, []):
+                    notifications.append((callback, key, config_data))
+        
+        for callback, (config_id, environment), config_data in notifications:
+            try:
+                callback(config_id, environment, config_data)
+            except Exception as e:
+                logger.error(f"Config change callback failed for '{config_id}': {e}")
+    
+    def invalidate(self, config_id: Optional[str] = None) -> None:
+        """
+        Сброс записей кэша.
+        
+        Args:
+            config_id: ID конфигурации (None — весь кэш)
+        """
+        with self._lock:
+            if config_id is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == config_id]:
+                    del self._entries[key]
+    
+    def subscribe(
+        self,
+        config_id: str,
+        callback: ConfigCallback,
+        environment: Optional[str] = None
+    ) -> None:
+        """
+        Подписка на изменения конфигурации.
+        
+        Args:
+            config_id: ID конфигурации
+            callback: Функция (config_id, environment, данные или None)
+            environment: Окружение (None — текущая версия)
+        """
+        key = (config_id, environment)
+        with self._lock:
+            data_version = self._read_data_version()
+        config_data = self._load(config_id, environment)
+        with self._lock:
+            self._subscribers.setdefault(key, []).append(callback)
+            if key not in self._entries and self._read_data_version() == data_version:
+                self._store(key, config_data)
+    
+    def unsubscribe(
+        self,
+        config_id: str,
+        callback: ConfigCallback,
+        environment: Optional[str] = None
+    ) -> None:
+        """
+        Отписка от изменений конфигурации.
+        
+        Args:
+            config_id: ID конфигурации
+            callback: Ранее переданная функция
+            environment: Окружение
+        """
+        key = (config_id, environment)
+        with self._lock:
+            callbacks = self._subscribers.get(key, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._subscribers.pop(key, None)
+    
+    def close(self):
+        """Закрытие соединения наблюдателя."""
+        self._watch_conn.close()
+
+
 class ConfigManager:
     """Менеджер конфигураций."""
     
-    def __init__(self, storage: Optional[ConfigStorage] = None):
+    def __init__(
+        self,
+        storage: Optional[ConfigStorage] = None,
+        cache_check_interval: float = 0.0,
+        cache_max_entries: int = 1024
+    ):
         self.storage = storage or ConfigStorage()
         self.validator = ConfigValidator()
         self.parser = ConfigParser()
+        self.cache = ConfigCache(
+            self.storage,
+            check_interval=cache_check_interval,
+            max_entries=cache_max_entries
+        )
+    
+    def get_config(self, config_id: str, environment: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Получение конфигурации из кэша (для частого чтения сервисами).
+        
+        Args:
+            config_id: ID конфигурации
+            environment: Окружение (None — текущая версия)
+            
+        Returns:
+            Данные конфигурации (только для чтения) или None
+        """
+        return self.cache.get(config_id, environment)
+    
+    def deploy(
+        self,
+        config_id: str,
+        environment: str,
+        version: Optional[int] = None,
+        deployed_by: str = "system"
+    ) -> str:
+        """
+        Применение версии конфигурации в окружении.
+        
+        Args:
+            config_id: ID конфигурации
+            environment: Окружение
+            version: Версия (None — текущая)
+            deployed_by: Кто применил
+            
+        Returns:
+            ID деплоймента
+        """
+        config_data = self.storage.get_config(config_id, version)
+        if not config_data:
+            raise ValueError(f"Config '{config_id}' version {version} not found")
+        
+        deployment_id = self.storage.record_deployment(
+            config_id, config_data['version'], environment, deployed_by
+        )
+        self.cache.refresh()
+        return deployment_id
+    
+    def subscribe(
+        self,
+        config_id: str,
+        callback: ConfigCallback,
+        environment: Optional[str] = None
+    ) -> None:
+        """
+        Подписка на изменения конфигурации.
+        
+        Args:
+            config_id: ID конфигурации
+            callback: Функция (config_id, environment, данные или None)
+            environment: Окружение (None — текущая версия)
+        """
+        self.cache.subscribe(config_id, callback, environment)
+    
+    def unsubscribe(
+        self,
+        config_id: str,
+        callback: ConfigCallback,
+        environment: Optional[str] = None
+    ) -> None:
+        """
+        Отписка от изменений конфигурации.
+        
+        Args:
+            config_id: ID конфигурации
+            callback: Ранее переданная функция
+            environment: Окружение
+        """
+        self.cache.unsubscribe(config_id, callback, environment)
     
     def load_from_file(
         self,
@@ -1053,7 +2144,7 @@ class ConfigManager:
         Returns:
             (валидна, список ошибок)
         """
-        config_data = self.storage.get_config(config_id)
+        config_data = self.get_config(config_id)
         if not config_data:
             return False, [f"Config '{config_id}' not found"]
         
@@ -1259,6 +2350,10 @@ def main():
             for error in errors:
                 print(f"  - {error}")
         
+        bench = manager.validator.benchmark(test_config, app_schema, iterations=2000)
+        print(f"  Compiled validator: {bench['speedup']:.1f}x faster than interpreter "
+              f"({bench['compiled_seconds']:.3f}s vs {bench['interpreted_seconds']:.3f}s)")
+        
         # Обновляем конфигурацию
         print("\n4. Updating configuration...")
         
@@ -2,7 +2,7 @@ import asyncio
 import smtplib
 import json
 import logging
-from typing import Any, Dict, List, Optional, Union, Set
+from typing import Any, Callable, Dict, List, Optional, Tuple, Set
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from enum import Enum
@@ -10,12 +10,15 @@ import sqlite3
 from contextlib import contextmanager
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import requests
+from requests.adapters import HTTPAdapter
 from abc import ABC, abstractmethod
 import uuid
 import re
+import heapq
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -49,6 +52,8 @@ class NotificationStatus(str, Enum):
     FAILED = "failed"
     READ = "read"
     ARCHIVED = "archived"
+    BUFFERED = "buffered"     # Ждет окна дайджеста
+    COALESCED = "coalesced"   # Объединено в дайджест (см. digest_id)
 
 
 @dataclass
@@ -125,6 +130,8 @@ class Notification:
     retry_count: int = 0
     max_retries: int = 3
     error_message: Optional[str] = None
+    digest_key: Optional[str] = None
+    digest_id: Optional[str] = None
     
     def to_dict(self) -> Dict[str, Any]:
         """Сериализация в словарь."""
@@ -147,7 +154,9 @@ class Notification:
             'read_at': self.read_at.isoformat() if self.read_at else None,
             'retry_count': self.retry_count,
             'max_retries': self.max_retries,
-            'error_message': self.error_message
+            'error_message': self.error_message,
+            'digest_key': self.digest_key,
+            'digest_id': self.digest_id
         }
     
     @classmethod
@@ -172,10 +181,21 @@ class Notification:
             read_at=datetime.fromisoformat(data['read_at']) if data.get('read_at') else None,
             retry_count=data.get('retry_count', 0),
             max_retries=data.get('max_retries', 3),
-            error_message=data.get('error_message')
+            error_message=data.get('error_message'),
+            digest_key=data.get('digest_key'),
+            digest_id=data.get('digest_id')
         )
 
 
+# Порядок обслуживания приоритетов (меньше — раньше)
+PRIORITY_RANK = {
+    NotificationPriority.URGENT: 0,
+    NotificationPriority.HIGH: 1,
+    NotificationPriority.NORMAL: 2,
+    NotificationPriority.LOW: 3
+}
+
+
 class NotificationValidator:
     """Валидатор уведомлений."""
     
@@ -235,8 +255,17 @@ class NotificationValidator:
 class NotificationStorage:
     """Хранилище уведомлений."""
     
-    def __init__(self, db_path: str = "notifications.db"):
+    def __init__(self, db_path: str = "notifications.db", claim_timeout: float = 300.0):
+        """
+        Инициализация хранилища.
+        
+        Args:
+            db_path: Путь к файлу БД
+            claim_timeout: Срок захвата (секунды): уведомления в статусе sending,
+                захват которых не продлевался дольше, возвращаются в pending
+        """
         self.db_path = db_path
+        self.claim_timeout = claim_timeout
         self._init_database()
     
     def _init_database(self):
@@ -301,11 +330,22 @@ class NotificationStorage:
                 )
             """)
             
+            # Колонки дайджестов: ключ группы и ссылка на итоговый дайджест
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(notifications)")}
+            if 'digest_key' not in columns:
+                cursor.execute("ALTER TABLE notifications ADD COLUMN digest_key TEXT")
+            if 'digest_id' not in columns:
+                cursor.execute("ALTER TABLE notifications ADD COLUMN digest_id TEXT")
+            # Время захвата (или последнего продления) уведомления в статусе sending
+            if 'claimed_at' not in columns:
+                cursor.execute("ALTER TABLE notifications ADD COLUMN claimed_at TIMESTAMP")
+            
             # Индексы для быстрого поиска
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_status ON notifications(status, scheduled_for)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, created_at)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_type ON notifications(notification_type, status)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_scheduled ON notifications(scheduled_for)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_digest ON notifications(status, digest_key)")
             
             conn.commit()
     
@@ -422,8 +462,8 @@ class NotificationStorage:
                     (id, user_id, notification_type, recipient, subject, body, body_html,
                      priority, status, metadata, template_id, template_variables,
                      scheduled_for, created_at, sent_at, read_at, retry_count,
-                     max_retries, error_message)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                     max_retries, error_message, digest_key, digest_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     notification.id,
                     notification.user_id,
@@ -443,7 +483,9 @@ class NotificationStorage:
                     notification.read_at,
                     notification.retry_count,
                     notification.max_retries,
-                    notification.error_message
+                    notification.error_message,
+                    notification.digest_key,
+                    notification.digest_id
                 ))
                 
                 conn.commit()
@@ -474,6 +516,9 @@ class NotificationStorage:
                 if sent_at:
                     updates['sent_at'] = sent_at
                 
+                if status == NotificationStatus.SENDING:
+                    updates['claimed_at'] = datetime.now()
+                
                 if status == NotificationStatus.FAILED:
                     updates['retry_count'] = 'retry_count + 1'
                 
@@ -529,6 +574,353 @@ class NotificationStorage:
             logger.error(f"Error getting pending notifications: {e}")
             return []
     
+    def claim_pending_notifications(
+        self,
+        limit: int = 100,
+        priorities: Optional[List[NotificationPriority]] = None,
+        notification_types: Optional[List[NotificationType]] = None
+    ) -> List[Notification]:
+        """
+        Атомарный захват pending уведомлений для отправки.
+        
+        Захваченные уведомления переводятся в статус sending одним
+        UPDATE ... RETURNING, поэтому повторно не выбираются. В той же
+        транзакции в pending возвращаются уведомления, захват которых истек
+        (отправитель упал или завис, не продлив захват).
+        
+        Args:
+            limit: Максимальное количество
+            priorities: Захватывать только эти приоритеты (None — все)
+            notification_types: Захватывать только эти каналы (None — все)
+        
+        Returns:
+            Захваченные уведомления в порядке приоритета
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                
+                now = datetime.now()
+                cursor.execute("""
+                    UPDATE notifications SET status = 'pending', claimed_at = NULL
+                    WHERE status = 'sending'
+                    AND (claimed_at IS NULL OR claimed_at < ?)
+                """, (now - timedelta(seconds=self.claim_timeout),))
+                if cursor.rowcount > 0:
+                    logger.warning(f"Requeued {cursor.rowcount} notifications with expired claims")
+                
+                params: List[Any] = [now, now]
+                priority_clause = ""
+                if priorities:
+                    priority_clause = f"AND priority IN ({','.join('?' * len(priorities))})"
+                    params.extend(priority.value for priority in priorities)
+                if notification_types:
+                    priority_clause += (
+                        f" AND notification_type IN ({','.join('?' * len(notification_types))})"
+                    )
+                    params.extend(notification_type.value for notification_type in notification_types)
+                params.append(limit)
+                
+                cursor.execute(f"""
+                    UPDATE notifications SET status = 'sending', claimed_at = ?
+                    WHERE id IN (
+                        SELECT id FROM notifications
+                        WHERE status = 'pending'
+                        AND (scheduled_for IS NULL OR scheduled_for <= ?)
+                        {priority_clause}
+                        ORDER BY 
+                            CASE priority
+                                WHEN 'urgent' THEN 1
+                                WHEN 'high' THEN 2
+                                WHEN 'normal' THEN 3
+                                WHEN 'low' THEN 4
+                            END,
+                            created_at ASC
+                        LIMIT ?
+                    )
+                    RETURNING *
+                """, params)
+                
+                notifications = [self._row_to_notification(row) for row in cursor.fetchall()]
+                conn.commit()
+                
+                # RETURNING не гарантирует порядок строк
+                notifications.sort(key=lambda n: (PRIORITY_RANK[n.priority], n.created_at))
+                return notifications
+        
+        except Exception as e:
+            logger.error(f"Error claiming pending notifications: {e}")
+            return []
+    
+    def claim_notification(self, notification_id: str) -> bool:
+        """
+        Захват конкретного pending уведомления (перевод в sending).
+        
+        Args:
+            notification_id: ID уведомления
+            
+        Returns:
+            True если уведомление было pending и захвачено этим вызовом
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE notifications SET status = 'sending', claimed_at = ?
+                    WHERE id = ? AND status = 'pending'
+                """, (datetime.now(), notification_id))
+                conn.commit()
+                return cursor.rowcount > 0
+                
+        except Exception as e:
+            logger.error(f"Error claiming notification {notification_id}: {e}")
+            return False
+    
+    def get_digest_window(self, digest_key: str) -> Tuple[Optional[datetime], int]:
+        """
+        Текущее окно группы дайджеста.
+        
+        Args:
+            digest_key: Ключ группы
+        
+        Returns:
+            (конец окна или None если группа пуста, число уведомлений в буфере)
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT MIN(scheduled_for) AS window_end, COUNT(*) AS count
+                    FROM notifications
+                    WHERE status = 'buffered' AND digest_key = ?
+                """, (digest_key,))
+                row = cursor.fetchone()
+                window_end = datetime.fromisoformat(row['window_end']) if row['window_end'] else None
+                return window_end, row['count']
+        
+        except Exception as e:
+            logger.error(f"Error getting digest window {digest_key}: {e}")
+            return None, 0
+    
+    def get_due_digest_keys(self, now: datetime) -> List[str]:
+        """
+        Ключи групп дайджестов, окно которых истекло.
+        
+        Args:
+            now: Текущее время
+        
+        Returns:
+            Список ключей
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT digest_key FROM notifications
+                    WHERE status = 'buffered'
+                    GROUP BY digest_key
+                    HAVING MIN(scheduled_for) <= ?
+                """, (now,))
+                return [row['digest_key'] for row in cursor.fetchall()]
+        
+        except Exception as e:
+            logger.error(f"Error getting due digests: {e}")
+            return []
+    
+    def coalesce_digest(
+        self,
+        digest_key: str,
+        build_digest: Callable[[List[Notification]], Notification]
+    ) -> Optional[Notification]:
+        """
+        Замена буферизованной группы одним уведомлением в одной транзакции.
+        
+        Группа из одного уведомления просто переводится в pending. Иначе
+        build_digest строит дайджест, он сохраняется как pending, а участники
+        получают статус coalesced и digest_id.
+        
+        Args:
+            digest_key: Ключ группы
+            build_digest: Построение дайджеста по участникам (по времени создания)
+        
+        Returns:
+            Уведомление к отправке или None если группа пуста
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                
+                cursor.execute("""
+                    SELECT * FROM notifications
+                    WHERE status = 'buffered' AND digest_key = ?
+                    ORDER BY created_at ASC
+                """, (digest_key,))
+                members = [self._row_to_notification(row) for row in cursor.fetchall()]
+                
+                if not members:
+                    conn.rollback()
+                    return None
+                
+                if len(members) == 1:
+                    single = members[0]
+                    cursor.execute("""
+                        UPDATE notifications SET status = 'pending', scheduled_for = NULL
+                        WHERE id = ?
+                    """, (single.id,))
+                    conn.commit()
+                    single.status = NotificationStatus.PENDING
+                    single.scheduled_for = None
+                    return single
+                
+                digest = build_digest(members)
+                cursor.execute("""
+                    INSERT INTO notifications 
+                    (id, user_id, notification_type, recipient, subject, body, body_html,
+                     priority, status, metadata, template_id, template_variables,
+                     created_at, max_retries)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (
+                    digest.id,
+                    digest.user_id,
+                    digest.notification_type.value,
+                    digest.recipient,
+                    digest.subject,
+                    digest.body,
+                    digest.body_html,
+                    digest.priority.value,
+                    digest.status.value,
+                    json.dumps(digest.metadata) if digest.metadata else None,
+                    digest.template_id,
+                    json.dumps(digest.template_variables, default=str) if digest.template_variables else None,
+                    digest.created_at,
+                    digest.max_retries
+                ))
+                cursor.executemany("""
+                    UPDATE notifications SET status = 'coalesced', digest_id = ?
+                    WHERE id = ?
+                """, [(digest.id, member.id) for member in members])
+                
+                conn.commit()
+                logger.info(f"Coalesced {len(members)} notifications into digest {digest.id}")
+                return digest
+        
+        except Exception as e:
+            logger.error(f"Error coalescing digest {digest_key}: {e}")
+            return None
+    
+    def release_notifications(self, notification_ids: List[str]) -> int:
+        """
+        Возврат захваченных, но не отправленных уведомлений в pending.
+        
+        Args:
+            notification_ids: ID уведомлений
+        
+        Returns:
+            Количество возвращенных
+        """
+        if not notification_ids:
+            return 0
+        
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany("""
+                    UPDATE notifications SET status = 'pending', claimed_at = NULL
+                    WHERE id = ? AND status = 'sending'
+                """, [(notification_id,) for notification_id in notification_ids])
+                conn.commit()
+                return cursor.rowcount
+        
+        except Exception as e:
+            logger.error(f"Error releasing notifications: {e}")
+            return 0
+    
+    def renew_claims(self, notification_ids: List[str]) -> Set[str]:
+        """
+        Продление захвата уведомлений, ожидающих отправки.
+        
+        Args:
+            notification_ids: ID захваченных уведомлений
+        
+        Returns:
+            ID уведомлений, которые все еще в статусе sending и продлены;
+            остальные уже возвращены в pending по истечении захвата
+        """
+        if not notification_ids:
+            return set()
+        
+        try:
+            renewed: Set[str] = set()
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                now = datetime.now()
+                # Порциями, чтобы не превысить лимит параметров SQLite
+                for i in range(0, len(notification_ids), 500):
+                    chunk = notification_ids[i:i + 500]
+                    cursor.execute(f"""
+                        UPDATE notifications SET claimed_at = ?
+                        WHERE status = 'sending' AND id IN ({','.join('?' * len(chunk))})
+                        RETURNING id
+                    """, [now, *chunk])
+                    renewed.update(row['id'] for row in cursor.fetchall())
+                conn.commit()
+            return renewed
+        
+        except Exception as e:
+            logger.error(f"Error renewing notification claims: {e}")
+            # Захват не потерян, просто не продлен
+            return set(notification_ids)
+    
+    def update_notification_statuses(
+        self,
+        updates: List[Tuple[str, NotificationStatus, Optional[str], Optional[datetime]]]
+    ) -> int:
+        """
+        Пакетное обновление статусов уведомлений одной транзакцией.
+        
+        Семантика та же, что у update_notification_status: при FAILED
+        увеличивается retry_count, sent_at меняется только если передан.
+        
+        Args:
+            updates: Кортежи (ID, статус, сообщение об ошибке, время отправки)
+        
+        Returns:
+            Количество обновленных уведомлений
+        """
+        if not updates:
+            return 0
+        
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.executemany("""
+                    UPDATE notifications
+                    SET status = ?,
+                        error_message = ?,
+                        sent_at = COALESCE(?, sent_at),
+                        retry_count = retry_count + ?
+                    WHERE id = ?
+                """, [
+                    (
+                        status.value,
+                        error_message,
+                        sent_at,
+                        1 if status == NotificationStatus.FAILED else 0,
+                        notification_id
+                    )
+                    for notification_id, status, error_message, sent_at in updates
+                ])
+                
+                conn.commit()
+                return cursor.rowcount
+        
+        except Exception as e:
+            logger.error(f"Error updating notification statuses: {e}")
+            return 0
+    
     def get_user_notifications(
         self,
         user_id: str,
@@ -637,7 +1029,7 @@ class NotificationStorage:
                     # Для расчета success rate
                     if status in ['sent', 'delivered', 'read']:
                         total_delivered += count
-                    if status != 'pending':
+                    if status not in ('pending', 'buffered', 'coalesced'):
                         total_sent += count
                 
                 # Расчет success rate
@@ -653,31 +1045,477 @@ class NotificationStorage:
     def _row_to_notification(self, row) -> Notification:
         """Преобразование строки БД в объект Notification."""
         return Notification(
-            id=row['id'],
-            user_id=row['user_id'],
-            notification_type=NotificationType(row['notification_type']),
-            recipient=row['recipient'],
-            subject=row['subject'],
-            body=row['body'],
-            body_html=row['body_html'],
-            priority=NotificationPriority(row['priority']),
-            status=NotificationStatus(row['status']),
-            metadata=json.loads(row['metadata']) if row['metadata'] else {},
-            template_id=row['template_id'],
-            template_variables=json.loads(row['template_variables']) if row['template_variables'] else {},
-            scheduled_for=datetime.fromisoformat(row['scheduled_for']) if row['scheduled_for'] else None,
-            created_at=datetime.fromisoformat(row['created_at']),
-            sent_at=datetime.fromisoformat(row['sent_at']) if row['sent_at'] else None,
-            read_at=datetime.fromisoformat(row['read_at']) if row['read_at'] else None,
-            retry_count=row['retry_count'],
-            max_retries=row['max_retries'],
-            error_message=row['error_message']
+            id=row['id'],
+            user_id=row['user_id'],
+            notification_type=NotificationType(row['notification_type']),
+            recipient=row['recipient'],
+            subject=row['subject'],
+            body=row['body'],
+            body_html=row['body_html'],
+            priority=NotificationPriority(row['priority']),
+            status=NotificationStatus(row['status']),
+            metadata=json.loads(row['metadata']) if row['metadata'] else {},
+            template_id=row['template_id'],
+            template_variables=json.loads(row['template_variables']) if row['template_variables'] else {},
+            scheduled_for=datetime.fromisoformat(row['scheduled_for']) if row['scheduled_for'] else None,
+            created_at=datetime.fromisoformat(row['created_at']),
+            sent_at=datetime.fromisoformat(row['sent_at']) if row['sent_at'] else None,
+            read_at=datetime.fromisoformat(row['read_at']) if row['read_at'] else None,
+            retry_count=row['retry_count'],
+            max_retries=row['max_retries'],
+            error_message=row['error_message'],
+            digest_key=row['digest_key'],
+            digest_id=row['digest_id']
+        )
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity."""
+    
+    def __init__(self, rate: float, capacity: float):
+        """
+        Инициализация корзины.
+        
+        Args:
+            rate: Скорость пополнения (токенов в секунду)
+            capacity: Емкость (допустимый всплеск)
+        """
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+    
+    def available(self, now: float) -> bool:
+        """Есть ли токен для отправки."""
+        self._refill(now)
+        return self.tokens >= 1.0
+    
+    def consume(self, now: float) -> None:
+        """Списание токена (после проверки available)."""
+        self._refill(now)
+        self.tokens -= 1.0
+    
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд ждать следующего токена."""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+    
+    def is_full(self, now: float) -> bool:
+        """Корзина полна (давно не использовалась)."""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class RateLimit:
+    """Лимит отправки: rate в секунду с допустимым всплеском burst."""
+    rate: float
+    burst: float = 1.0
+    
+    def create_bucket(self) -> TokenBucket:
+        return TokenBucket(self.rate, self.burst)
+
+
+class NotificationScheduler:
+    """
+    Планировщик отправки в памяти.
+    
+    Уведомления выдаются в порядке приоритета (затем времени создания),
+    но только если у канала и у получателя есть токены: уведомление,
+    упершееся в лимит, ждет в очереди, а не отправляется с ошибкой
+    провайдера. Заблокированный лимитом канал или получатель не
+    задерживает остальных.
+    """
+    
+    # Корзины получателей, простаивающие дольше этого времени, удаляются
+    IDLE_BUCKET_TTL = 300.0
+    
+    def __init__(self):
+        self._heap: List[Tuple[int, float, int, Notification, str]] = []
+        self._seq = 0
+        self._counts: Dict[NotificationType, int] = {}
+        
+        self.channel_limits: Dict[NotificationType, RateLimit] = {}
+        self.recipient_limits: Dict[NotificationType, RateLimit] = {}
+        self._channel_buckets: Dict[NotificationType, TokenBucket] = {}
+        self._recipient_buckets: Dict[Tuple[NotificationType, str], TokenBucket] = {}
+        self._last_prune = time.monotonic()
+    
+    def __len__(self) -> int:
+        return len(self._heap)
+    
+    def count(self, notification_type: NotificationType) -> int:
+        """Количество уведомлений канала в очереди."""
+        return self._counts.get(notification_type, 0)
+    
+    def set_limits(
+        self,
+        notification_type: NotificationType,
+        channel_limit: Optional[RateLimit] = None,
+        recipient_limit: Optional[RateLimit] = None
+    ) -> None:
+        """
+        Настройка лимитов канала.
+        
+        Args:
+            notification_type: Тип канала
+            channel_limit: Общий лимит канала (None — без ограничения)
+            recipient_limit: Лимит на одного получателя (None — без ограничения)
+        """
+        for limits, limit in ((self.channel_limits, channel_limit), (self.recipient_limits, recipient_limit)):
+            if limit is None:
+                limits.pop(notification_type, None)
+            else:
+                limits[notification_type] = limit
+        
+        self._channel_buckets.pop(notification_type, None)
+        for key in [key for key in self._recipient_buckets if key[0] == notification_type]:
+            del self._recipient_buckets[key]
+    
+    def push(self, notification: Notification, recipient_key: str) -> None:
+        """
+        Добавление уведомления в очередь.
+        
+        Args:
+            notification: Уведомление
+            recipient_key: Ключ получателя для лимита (адрес, URL вебхука)
+        """
+        self._seq += 1
+        heapq.heappush(self._heap, (
+            PRIORITY_RANK[notification.priority],
+            notification.created_at.timestamp(),
+            self._seq,
+            notification,
+            recipient_key
+        ))
+        notification_type = notification.notification_type
+        self._counts[notification_type] = self._counts.get(notification_type, 0) + 1
+    
+    def queued_ids(self) -> List[str]:
+        """ID уведомлений в очереди."""
+        return [item[3].id for item in self._heap]
+    
+    def discard(self, notification_ids: Set[str]) -> None:
+        """
+        Удаление уведомлений из очереди.
+        
+        Args:
+            notification_ids: ID удаляемых уведомлений
+        """
+        self._heap = [item for item in self._heap if item[3].id not in notification_ids]
+        heapq.heapify(self._heap)
+        self._counts.clear()
+        for item in self._heap:
+            notification_type = item[3].notification_type
+            self._counts[notification_type] = self._counts.get(notification_type, 0) + 1
+    
+    def drain(self) -> List[Notification]:
+        """Извлечение всех уведомлений из очереди."""
+        notifications = [item[3] for item in self._heap]
+        self._heap = []
+        self._counts.clear()
+        return notifications
+    
+    def _channel_bucket(self, notification_type: NotificationType) -> Optional[TokenBucket]:
+        limit = self.channel_limits.get(notification_type)
+        if limit is None:
+            return None
+        bucket = self._channel_buckets.get(notification_type)
+        if bucket is None:
+            bucket = self._channel_buckets[notification_type] = limit.create_bucket()
+        return bucket
+    
+    def _recipient_bucket(self, notification_type: NotificationType, recipient_key: str) -> Optional[TokenBucket]:
+        limit = self.recipient_limits.get(notification_type)
+        if limit is None:
+            return None
+        key = (notification_type, recipient_key)
+        bucket = self._recipient_buckets.get(key)
+        if bucket is None:
+            bucket = self._recipient_buckets[key] = limit.create_bucket()
+        return bucket
+    
+    def take_ready(
+        self,
+        batch_sizes: Dict[NotificationType, int],
+        now: Optional[float] = None
+    ) -> Tuple[Dict[NotificationType, List[Notification]], Optional[float]]:
+        """
+        Выбор уведомлений, которые можно отправить сейчас.
+        
+        Args:
+            batch_sizes: Сколько уведомлений взять по каждому каналу;
+                каналы, которых нет в словаре, сейчас заняты и пропускаются
+            now: Текущее время (time.monotonic)
+        
+        Returns:
+            (уведомления по каналам, через сколько секунд освободится
+            следующий токен или None если ждать нечего)
+        """
+        now = time.monotonic() if now is None else now
+        ready: Dict[NotificationType, List[Notification]] = {}
+        deferred = []
+        wait: Optional[float] = None
+        
+        # Каналы, из которых в этом проходе больше ничего не взять
+        closed = {t for t in self._counts if batch_sizes.get(t, 0) <= 0}
+        
+        while self._heap and len(closed) < len(self._counts):
+            item = heapq.heappop(self._heap)
+            notification, recipient_key = item[3], item[4]
+            notification_type = notification.notification_type
+            
+            if notification_type in closed:
+                deferred.append(item)
+                continue
+            
+            channel_bucket = self._channel_bucket(notification_type)
+            if channel_bucket is not None and not channel_bucket.available(now):
+                delay = channel_bucket.wait_time(now)
+                wait = delay if wait is None else min(wait, delay)
+                closed.add(notification_type)
+                deferred.append(item)
+                continue
+            
+            recipient_bucket = self._recipient_bucket(notification_type, recipient_key)
+            if recipient_bucket is not None and not recipient_bucket.available(now):
+                delay = recipient_bucket.wait_time(now)
+                wait = delay if wait is None else min(wait, delay)
+                deferred.append(item)
+                continue
+            
+            if channel_bucket is not None:
+                channel_bucket.consume(now)
+            if recipient_bucket is not None:
+                recipient_bucket.consume(now)
+            
+            batch = ready.setdefault(notification_type, [])
+            batch.append(notification)
+            self._counts[notification_type] -= 1
+            if not self._counts[notification_type]:
+                del self._counts[notification_type]
+                closed.discard(notification_type)
+            if len(batch) >= batch_sizes[notification_type]:
+                closed.add(notification_type)
+        
+        for item in deferred:
+            heapq.heappush(self._heap, item)
+        
+        if now - self._last_prune > self.IDLE_BUCKET_TTL:
+            self._prune(now)
+        
+        return ready, wait
+    
+    def _prune(self, now: float) -> None:
+        """Удаление полных (неиспользуемых) корзин получателей."""
+        self._last_prune = now
+        for key in [key for key, bucket in self._recipient_buckets.items() if bucket.is_full(now)]:
+            del self._recipient_buckets[key]
+
+
+@dataclass
+class DigestPolicy:
+    """Настройки объединения уведомлений шаблона в дайджест."""
+    template_name: str
+    window_seconds: float = 300.0
+    # Шаблон дайджеста (None — встроенный список уведомлений)
+    digest_template_name: Optional[str] = None
+    # Дайджест отправляется досрочно, когда накопилось столько уведомлений
+    max_items: int = 50
+    # Срочные уведомления не ждут окна
+    bypass_priorities: Tuple[NotificationPriority, ...] = (NotificationPriority.URGENT,)
+
+
+class DigestCoalescer:
+    """
+    Объединение уведомлений в дайджесты.
+    
+    Уведомления шаблона с включенной политикой сохраняются со статусом
+    buffered и ключом (user_id, канал, шаблон). Окно группы открывает первое
+    уведомление; когда окно истекает (или набирается max_items), группа
+    одной транзакцией заменяется дайджестом: участники получают статус
+    coalesced и ссылку digest_id на новое pending уведомление.
+    """
+    
+    DEFAULT_DIGEST_TEMPLATE = NotificationTemplate(
+        id="digest",
+        name="digest",
+        notification_type=NotificationType.EMAIL,
+        subject="You have {{count}} new notifications",
+        body="You have {{count}} new notifications:\n\n{{items}}",
+        variables=['count', 'items']
+    )
+    
+    def __init__(self, storage: NotificationStorage, on_ready: Optional[Callable[[], None]] = None):
+        """
+        Инициализация.
+        
+        Args:
+            storage: Хранилище уведомлений
+            on_ready: Вызывается, когда группа досрочно (по max_items)
+                стала pending уведомлением, например NotificationSender.wake
+        """
+        self.storage = storage
+        self.on_ready = on_ready
+        self.policies: Dict[str, DigestPolicy] = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(user_id: str, notification_type: NotificationType, template_id: str) -> str:
+        """Ключ группы дайджеста."""
+        return f"{user_id}:{notification_type.value}:{template_id}"
+    
+    def set_policy(self, template_id: str, policy: Optional[DigestPolicy]) -> None:
+        """
+        Включение (или отключение при None) дайджеста для шаблона.
+        
+        Args:
+            template_id: ID шаблона
+            policy: Политика объединения
+        """
+        with self._lock:
+            if policy is None:
+                self.policies.pop(template_id, None)
+            else:
+                self.policies[template_id] = policy
+    
+    def get_policy(self, notification: Notification) -> Optional[DigestPolicy]:
+        """Политика для уведомления, если его нужно буферизовать."""
+        if not notification.template_id or notification.scheduled_for is not None:
+            return None
+        policy = self.policies.get(notification.template_id)
+        if policy is None or notification.priority in policy.bypass_priorities:
+            return None
+        return policy
+    
+    def buffer(self, notification: Notification, policy: DigestPolicy) -> bool:
+        """
+        Сохранение уведомления в буфер дайджеста.
+        
+        Args:
+            notification: Уведомление (с template_id)
+            policy: Политика шаблона
+        
+        Returns:
+            True если успешно сохранено
+        """
+        key = self.make_key(notification.user_id, notification.notification_type, notification.template_id)
+        
+        with self._lock:
+            window_end, count = self.storage.get_digest_window(key)
+            if window_end is None:
+                window_end = notification.created_at + timedelta(seconds=policy.window_seconds)
+            
+            notification.status = NotificationStatus.BUFFERED
+            notification.digest_key = key
+            # scheduled_for буферизованного уведомления — конец окна группы
+            notification.scheduled_for = window_end
+            
+            if not self.storage.save_notification(notification):
+                return False
+        
+        if count + 1 >= policy.max_items:
+            if self.flush_group(key) is not None and self.on_ready is not None:
+                self.on_ready()
+        return True
+    
+    def flush_due(self, now: Optional[datetime] = None) -> int:
+        """
+        Объединение групп с истекшим окном.
+        
+        Args:
+            now: Текущее время
+        
+        Returns:
+            Количество созданных (или освобожденных) уведомлений
+        """
+        flushed = 0
+        for key in self.storage.get_due_digest_keys(now or datetime.now()):
+            if self.flush_group(key):
+                flushed += 1
+        return flushed
+    
+    def flush_group(self, key: str) -> Optional[Notification]:
+        """
+        Замена буферизованной группы дайджестом.
+        
+        Args:
+            key: Ключ группы
+        
+        Returns:
+            Уведомление к отправке (дайджест или единственное уведомление группы)
+        """
+        return self.storage.coalesce_digest(key, self._build_digest)
+    
+    def _get_digest_template(self, policy: Optional[DigestPolicy]) -> NotificationTemplate:
+        if policy and policy.digest_template_name:
+            template = self.storage.get_template_by_name(policy.digest_template_name)
+            if template:
+                return template
+            logger.warning(f"Digest template not found: {policy.digest_template_name}")
+        return self.DEFAULT_DIGEST_TEMPLATE
+    
+    def _build_digest(self, members: List[Notification]) -> Notification:
+        """
+        Рендеринг дайджеста по участникам группы (по порядку создания).
+        
+        Контекст шаблона: переменные последнего уведомления, count, items
+        (тексты уведомлений списком), subjects, first_at, last_at.
+        """
+        latest = members[-1]
+        policy = self.policies.get(latest.template_id)
+        template = self._get_digest_template(policy)
+        
+        context = dict(latest.template_variables)
+        context.update({
+            'count': len(members),
+            'items': "\n".join(f"- {member.subject or member.body}" for member in members),
+            'subjects': ", ".join(member.subject for member in members if member.subject),
+            'first_at': members[0].created_at.isoformat(),
+            'last_at': latest.created_at.isoformat()
+        })
+        rendered = template.render(context)
+        
+        priority = min((member.priority for member in members), key=lambda p: PRIORITY_RANK[p])
+        metadata = dict(latest.metadata)
+        metadata.update({
+            'digest_key': latest.digest_key,
+            'digest_count': len(members),
+            'digest_of': [member.id for member in members]
+        })
+        
+        return Notification(
+            id=str(uuid.uuid4()),
+            user_id=latest.user_id,
+            notification_type=latest.notification_type,
+            recipient=latest.recipient,
+            subject=rendered.get('subject', latest.subject),
+            body=rendered.get('body') or "",
+            body_html=rendered.get('body_html'),
+            priority=priority,
+            metadata=metadata,
+            template_id=latest.template_id,
+            template_variables=context
         )
 
 
 class NotificationChannel(ABC):
     """Абстрактный класс канала уведомлений."""
     
+    # Максимальный размер пакета для send_batch
+    batch_size: int = 50
+    
+    # Лимиты провайдера по умолчанию (None — без ограничения)
+    rate_limit: Optional[RateLimit] = None
+    recipient_rate_limit: Optional[RateLimit] = None
+    
     @abstractmethod
     async def send(self, notification: Notification) -> bool:
         """
@@ -685,7 +1523,7 @@ class NotificationChannel(ABC):
         
         Args:
             notification: Уведомление для отправки
-            
+        
         Returns:
             True если успешно отправлено
         """
@@ -696,6 +1534,109 @@ class NotificationChannel(ABC):
         """Получение имени канала."""
         pass
 
+    async def send_batch(self, notifications: List[Notification]) -> List[bool]:
+        """
+        Отправка пакета уведомлений.
+        
+        По умолчанию уведомления отправляются параллельными вызовами send;
+        каналы с постоянными соединениями переопределяют метод.
+        
+        Args:
+            notifications: Уведомления для отправки
+        
+        Returns:
+            Результаты в том же порядке
+        """
+        results = await asyncio.gather(
+            *(self.send(notification) for notification in notifications),
+            return_exceptions=True
+        )
+        return [result is True for result in results]
+    
+    def rate_limit_key(self, notification: Notification) -> str:
+        """Ключ получателя для лимита на получателя."""
+        return notification.recipient
+    
+    def close(self) -> None:
+        """Закрытие соединений канала."""
+        pass
+
+
+def _create_http_session(pool_size: int) -> requests.Session:
+    """HTTP сессия с keep-alive пулом на pool_size соединений к хосту."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class SMTPConnectionPool:
+    """
+    Пул постоянных SMTP сессий.
+    
+    Сессии переиспользуются между пакетами; простаивавшая дольше
+    idle_timeout сессия проверяется командой NOOP и при ошибке
+    открывается заново.
+    """
+    
+    def __init__(self, connect: Callable[[], smtplib.SMTP], idle_timeout: float = 30.0):
+        """
+        Инициализация пула.
+        
+        Args:
+            connect: Функция открытия новой сессии
+            idle_timeout: Время простоя, после которого сессия проверяется
+        """
+        self._connect = connect
+        self.idle_timeout = idle_timeout
+        self._idle: List[Tuple[smtplib.SMTP, float]] = []
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> smtplib.SMTP:
+        """Получение рабочей сессии из пула (или новой)."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, released_at = self._idle.pop()
+            
+            if time.monotonic() - released_at < self.idle_timeout:
+                return server
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.discard(server)
+        
+        return self._connect()
+    
+    def release(self, server: smtplib.SMTP) -> None:
+        """Возврат сессии в пул."""
+        with self._lock:
+            self._idle.append((server, time.monotonic()))
+    
+    @staticmethod
+    def discard(server: Optional[smtplib.SMTP]) -> None:
+        """Закрытие сломанной сессии."""
+        if server is None:
+            return
+        try:
+            server.close()
+        except Exception:
+            pass
+    
+    def close(self) -> None:
+        """Закрытие всех сессий пула."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            try:
+                server.quit()
+            except Exception:
+                self.discard(server)
+
 
 class EmailChannel(NotificationChannel):
     """Канал для отправки email."""
@@ -707,7 +1648,10 @@ class EmailChannel(NotificationChannel):
         smtp_username: Optional[str] = None,
         smtp_password: Optional[str] = None,
         use_tls: bool = True,
-        from_email: str = "noreply@example.com"
+        from_email: str = "noreply@example.com",
+        pool_size: int = 2,
+        batch_size: int = 50,
+        timeout: float = 30.0
     ):
         """
         Инициализация email канала.
@@ -719,6 +1663,9 @@ class EmailChannel(NotificationChannel):
             smtp_password: Пароль SMTP
             use_tls: Использовать TLS
             from_email: Email отправителя
+            pool_size: Количество параллельных SMTP сессий
+            batch_size: Максимальный размер пакета
+            timeout: Таймаут SMTP операций
         """
         self.smtp_host = smtp_host
         self.smtp_port = smtp_port
@@ -726,71 +1673,161 @@ class EmailChannel(NotificationChannel):
         self.smtp_password = smtp_password
         self.use_tls = use_tls
         self.from_email = from_email
+        self.pool_size = max(1, pool_size)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        
+        self._pool = SMTPConnectionPool(self._connect)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
     
     def get_name(self) -> str:
         return "email"
     
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Потоки SMTP сессий: по одному на сессию пула."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size,
+                    thread_name_prefix="EmailChannel"
+                )
+            return self._executor
+    
+    def _build_message(self, notification: Notification) -> MIMEMultipart:
+        """Сборка MIME сообщения."""
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = notification.subject or "Notification"
+        msg['From'] = self.from_email
+        msg['To'] = notification.recipient
+        
+        # Текстовая часть
+        if notification.body:
+            text_part = MIMEText(notification.body, 'plain', 'utf-8')
+            msg.attach(text_part)
+        
+        # HTML часть
+        if notification.body_html:
+            html_part = MIMEText(notification.body_html, 'html', 'utf-8')
+            msg.attach(html_part)
+        
+        return msg
+    
     async def send(self, notification: Notification) -> bool:
         """Отправка email."""
+        return (await self.send_batch([notification]))[0]
+    
+    async def send_batch(self, notifications: List[Notification]) -> List[bool]:
+        """
+        Отправка пакета email через постоянные SMTP сессии.
+        
+        Пакет делится между сессиями пула; внутри сессии письма
+        отправляются подряд без переподключения.
+        """
+        if not notifications:
+            return []
+        
         try:
-            # Создаем сообщение
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = notification.subject or "Notification"
-            msg['From'] = self.from_email
-            msg['To'] = notification.recipient
-            
-            # Текстовая часть
-            if notification.body:
-                text_part = MIMEText(notification.body, 'plain', 'utf-8')
-                msg.attach(text_part)
-            
-            # HTML часть
-            if notification.body_html:
-                html_part = MIMEText(notification.body_html, 'html', 'utf-8')
-                msg.attach(html_part)
-            
-            # Отправка
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                self._send_sync,
-                msg
-            )
-            
-            logger.info(f"Email sent to {notification.recipient}")
-            return True
-            
+            messages = [self._build_message(notification) for notification in notifications]
         except Exception as e:
-            logger.error(f"Failed to send email to {notification.recipient}: {e}")
-            return False
+            logger.error(f"Failed to build email batch: {e}")
+            return [False] * len(notifications)
+        
+        chunk_size = -(-len(messages) // self.pool_size)
+        chunks = [messages[i:i + chunk_size] for i in range(0, len(messages), chunk_size)]
+        
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        chunk_results = await asyncio.gather(
+            *(loop.run_in_executor(executor, self._send_many, chunk) for chunk in chunks),
+            return_exceptions=True
+        )
+        
+        results = []
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            if isinstance(chunk_result, BaseException):
+                logger.error(f"Failed to send email batch: {chunk_result}")
+                results.extend([False] * len(chunk))
+            else:
+                results.extend(chunk_result)
+        
+        logger.info(f"Email batch sent: {sum(results)}/{len(results)}")
+        return results
     
-    def _send_sync(self, msg: MIMEMultipart):
-        """Синхронная отправка email."""
+    def _connect(self) -> smtplib.SMTP:
+        """Открытие новой SMTP сессии."""
+        server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=self.timeout)
         try:
-            with smtplib.SMTP(self.smtp_host, self.smtp_port) as server:
-                if self.use_tls:
-                    server.starttls()
-                
-                if self.smtp_username and self.smtp_password:
-                    server.login(self.smtp_username, self.smtp_password)
-                
-                server.send_message(msg)
-        except Exception as e:
-            raise e
+            if self.use_tls:
+                server.starttls()
+            
+            if self.smtp_username and self.smtp_password:
+                server.login(self.smtp_username, self.smtp_password)
+        except Exception:
+            SMTPConnectionPool.discard(server)
+            raise
+        return server
+    
+    def _send_many(self, messages: List[MIMEMultipart]) -> List[bool]:
+        """
+        Синхронная отправка писем через одну сессию пула.
+        
+        При обрыве соединения сессия открывается заново и письмо
+        повторяется один раз; ошибки отдельных писем (например, отказ
+        получателя) сессию не закрывают.
+        """
+        results = []
+        server: Optional[smtplib.SMTP] = None
+        
+        for msg in messages:
+            sent = False
+            for attempt in range(2):
+                try:
+                    if server is None:
+                        server = self._pool.acquire() if attempt == 0 else self._connect()
+                    server.send_message(msg)
+                    sent = True
+                    break
+                except (smtplib.SMTPServerDisconnected, OSError) as e:
+                    SMTPConnectionPool.discard(server)
+                    server = None
+                    if attempt == 1:
+                        logger.error(f"Failed to send email to {msg['To']}: {e}")
+                except smtplib.SMTPException as e:
+                    logger.error(f"Failed to send email to {msg['To']}: {e}")
+                    break
+            results.append(sent)
+        
+        if server is not None:
+            self._pool.release(server)
+        return results
+    
+    def close(self) -> None:
+        """Закрытие SMTP сессий."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self._pool.close()
 
 
 class WebhookChannel(NotificationChannel):
     """Канал для отправки webhook уведомлений."""
     
-    def __init__(self, timeout: int = 10):
+    def __init__(self, timeout: int = 10, pool_size: int = 10, batch_size: int = 50):
         """
         Инициализация webhook канала.
         
         Args:
             timeout: Таймаут запроса
+            pool_size: Количество keep-alive соединений и параллельных запросов
+            batch_size: Максимальный размер пакета
         """
         self.timeout = timeout
-        self.session = requests.Session()
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.session = _create_http_session(pool_size)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="WebhookChannel")
     
     def get_name(self) -> str:
         return "webhook"
@@ -813,14 +1850,14 @@ class WebhookChannel(NotificationChannel):
             }
             
             # Headers
-            headers = notification.metadata.get('headers', {})
+            headers = dict(notification.metadata.get('headers', {}))
             headers.setdefault('Content-Type', 'application/json')
             headers.setdefault('User-Agent', 'NotificationSystem/1.0')
             
-            # Отправка
-            loop = asyncio.get_event_loop()
+            # Отправка (соединения переиспользуются сессией)
+            loop = asyncio.get_running_loop()
             response = await loop.run_in_executor(
-                None,
+                self._executor,
                 lambda: self.session.post(
                     webhook_url,
                     json=payload,
@@ -835,33 +1872,59 @@ class WebhookChannel(NotificationChannel):
             else:
                 logger.warning(f"Webhook to {webhook_url} failed with status {response.status_code}")
                 return False
-                
+        
         except Exception as e:
             logger.error(f"Failed to send webhook: {e}")
             return False
+    
+    def close(self) -> None:
+        """Закрытие HTTP соединений и потоков отправки."""
+        self._executor.shutdown(wait=True)
+        self.session.close()
 
 
 class SlackChannel(NotificationChannel):
     """Канал для отправки в Slack."""
     
-    def __init__(self, default_webhook_url: Optional[str] = None):
+    # Входящие вебхуки Slack принимают около одного сообщения в секунду
+    recipient_rate_limit = RateLimit(rate=1.0, burst=1.0)
+    
+    def __init__(
+        self,
+        default_webhook_url: Optional[str] = None,
+        timeout: int = 10,
+        pool_size: int = 4,
+        batch_size: int = 20
+    ):
         """
         Инициализация Slack канала.
         
         Args:
             default_webhook_url: URL вебхука Slack по умолчанию
+            timeout: Таймаут запроса
+            pool_size: Количество keep-alive соединений и параллельных запросов
+            batch_size: Максимальный размер пакета
         """
         self.default_webhook_url = default_webhook_url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.session = _create_http_session(pool_size)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="SlackChannel")
     
     def get_name(self) -> str:
         return "slack"
     
+    def rate_limit_key(self, notification: Notification) -> str:
+        """Лимит Slack действует на вебхук, а не на получателя."""
+        return notification.metadata.get('slack_webhook_url', self.default_webhook_url) or ""
+    
     async def send(self, notification: Notification) -> bool:
         """Отправка в Slack."""
         try:
             # Получаем webhook URL
             webhook_url = notification.metadata.get(
-                'slack_webhook_url', 
+                'slack_webhook_url',
                 self.default_webhook_url
             )
             
@@ -888,14 +1951,14 @@ class SlackChannel(NotificationChannel):
             if notification.metadata.get('slack_blocks'):
                 slack_message['blocks'].extend(notification.metadata['slack_blocks'])
             
-            # Отправка
-            loop = asyncio.get_event_loop()
+            # Отправка (соединения переиспользуются сессией)
+            loop = asyncio.get_running_loop()
             response = await loop.run_in_executor(
-                None,
-                lambda: requests.post(
+                self._executor,
+                lambda: self.session.post(
                     webhook_url,
                     json=slack_message,
-                    timeout=10
+                    timeout=self.timeout
                 )
             )
             
@@ -905,27 +1968,56 @@ class SlackChannel(NotificationChannel):
             else:
                 logger.warning(f"Slack webhook failed: {response.text}")
                 return False
-                
+        
         except Exception as e:
             logger.error(f"Failed to send Slack message: {e}")
             return False
+    
+    def close(self) -> None:
+        """Закрытие HTTP соединений и потоков отправки."""
+        self._executor.shutdown(wait=True)
+        self.session.close()
 
 
 class NotificationSender:
     """Отправитель уведомлений."""
     
-    def __init__(self, storage: NotificationStorage):
+    def __init__(self, storage: NotificationStorage, fetch_limit: int = 500):
         """
         Инициализация отправителя.
         
         Args:
             storage: Хранилище уведомлений
+            fetch_limit: Сколько уведомлений каждого канала держать в очереди
+                планировщика
         """
         self.storage = storage
         self.channels: Dict[NotificationType, NotificationChannel] = {}
         self.running = False
         self.worker_thread: Optional[threading.Thread] = None
         self.check_interval = 5  # секунды
+        self.fetch_limit = fetch_limit
+        
+        # Один долгоживущий event loop в потоке отправителя
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        
+        # Очередь с приоритетами и лимитами; в каждом канале не больше
+        # одного пакета в полете
+        self.scheduler = NotificationScheduler()
+        self._busy_channels: Set[NotificationType] = set()
+        self._inflight: Set[asyncio.Task] = set()
+        # ID отправляемых пакетов: их захват продлевается вместе с очередью
+        self._inflight_ids: Set[str] = set()
+        self._last_renew = time.monotonic()
+        # wake() просит проверить хранилище; завершение пакета — только планировщик
+        self._poll_requested = False
+        # Каналы, захватившие при последней проверке полную порцию: в хранилище
+        # может быть еще, очередь пополняется, когда опустеет наполовину
+        self._backlogged: Set[NotificationType] = set()
+        
+        # Объединение в дайджесты (подключается NotificationService)
+        self.coalescer: Optional['DigestCoalescer'] = None
     
     def register_channel(self, channel: NotificationChannel) -> None:
         """
@@ -947,6 +2039,11 @@ class NotificationSender:
         
         if channel_name in type_map:
             self.channels[type_map[channel_name]] = channel
+            self.scheduler.set_limits(
+                type_map[channel_name],
+                channel.rate_limit,
+                channel.recipient_rate_limit
+            )
             logger.info(f"Registered channel: {channel_name}")
         else:
             logger.warning(f"Unknown channel type: {channel_name}")
@@ -1019,37 +2116,295 @@ class NotificationSender:
             )
             return False
     
-    def _worker_loop(self):
-        """Цикл обработки уведомлений."""
-        logger.info("Notification sender worker started")
+    async def send_notifications(self, notifications: List[Notification]) -> int:
+        """
+        Пакетная отправка уведомлений, уже переведенных в статус sending.
+        
+        Уведомления группируются по каналам и отправляются пакетами до
+        channel.batch_size; статусы записываются одной транзакцией.
+        
+        Args:
+            notifications: Уведомления для отправки
+        
+        Returns:
+            Количество успешно отправленных
+        """
+        updates: List[Tuple[str, NotificationStatus, Optional[str], Optional[datetime]]] = []
+        by_channel: Dict[NotificationType, List[Notification]] = {}
+        
+        for notification in notifications:
+            is_valid, errors = NotificationValidator.validate_notification(notification)
+            if not is_valid:
+                logger.error(f"Notification {notification.id} validation failed: {errors}")
+                updates.append((
+                    notification.id, NotificationStatus.FAILED,
+                    f"Validation failed: {', '.join(errors)}", None
+                ))
+                continue
+            
+            if notification.notification_type not in self.channels:
+                logger.error(f"No channel registered for type: {notification.notification_type}")
+                updates.append((
+                    notification.id, NotificationStatus.FAILED,
+                    f"No channel for type: {notification.notification_type}", None
+                ))
+                continue
+            
+            by_channel.setdefault(notification.notification_type, []).append(notification)
+        
+        batches = []
+        for notification_type, channel_notifications in by_channel.items():
+            channel = self.channels[notification_type]
+            size = max(1, channel.batch_size)
+            for i in range(0, len(channel_notifications), size):
+                batches.append((channel, channel_notifications[i:i + size]))
+        
+        batch_results = await asyncio.gather(
+            *(channel.send_batch(batch) for channel, batch in batches),
+            return_exceptions=True
+        )
+        
+        sent_count = 0
+        sent_at = datetime.now()
+        for (channel, batch), results in zip(batches, batch_results):
+            if isinstance(results, BaseException):
+                logger.error(f"Error sending batch via {channel.get_name()}: {results}")
+                results = [False] * len(batch)
+            
+            for notification, success in zip(batch, results):
+                if success:
+                    sent_count += 1
+                    updates.append((notification.id, NotificationStatus.SENT, None, sent_at))
+                else:
+                    updates.append((notification.id, NotificationStatus.FAILED, "Channel send failed", None))
+        
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.storage.update_notification_statuses, updates)
+        
+        if notifications:
+            logger.info(f"Sent {sent_count}/{len(notifications)} notifications")
+        return sent_count
+    
+    def set_rate_limit(
+        self,
+        notification_type: NotificationType,
+        channel_limit: Optional[RateLimit] = None,
+        recipient_limit: Optional[RateLimit] = None
+    ) -> None:
+        """
+        Настройка лимитов провайдера для канала.
+        
+        Args:
+            notification_type: Тип канала
+            channel_limit: Общий лимит канала (None — без ограничения)
+            recipient_limit: Лимит на одного получателя (None — без ограничения)
+        """
+        self.scheduler.set_limits(notification_type, channel_limit, recipient_limit)
+    
+    async def _fill_scheduler(self) -> int:
+        """
+        Захват pending уведомлений в очередь планировщика.
+        
+        Каждый канал захватывает не больше fetch_limit уведомлений в очередь.
+        Если очередь канала заполнена, захватываются только его срочные
+        уведомления, чтобы они обгоняли уже ожидающие низкоприоритетные.
+        
+        Каналы, захватившие полную порцию, запоминаются в _backlogged.
+        
+        Returns:
+            Количество захваченных
+        """
+        loop = asyncio.get_running_loop()
+        
+        # Группы дайджестов с истекшим окном становятся pending уведомлениями
+        if self.coalescer is not None:
+            await loop.run_in_executor(None, self.coalescer.flush_due)
+        
+        await self._renew_claims()
+        
+        # Квота на канал: канал, упершийся в лимит провайдера, не занимает
+        # очередь остальных
+        claimed: List[Notification] = []
+        self._backlogged.clear()
+        for notification_type in self.channels:
+            room = self.fetch_limit - self.scheduler.count(notification_type)
+            if room > 0:
+                channel_claimed = await loop.run_in_executor(
+                    None, self.storage.claim_pending_notifications,
+                    room, None, [notification_type]
+                )
+                if len(channel_claimed) >= room:
+                    self._backlogged.add(notification_type)
+            else:
+                channel_claimed = await loop.run_in_executor(
+                    None, self.storage.claim_pending_notifications,
+                    max(1, self.fetch_limit // 10), [NotificationPriority.URGENT], [notification_type]
+                )
+            claimed.extend(channel_claimed)
+        
+        # Уведомления каналов без обработчика сразу помечаются failed
+        unregistered = [t for t in NotificationType if t not in self.channels]
+        if unregistered:
+            claimed.extend(await loop.run_in_executor(
+                None, self.storage.claim_pending_notifications,
+                self.fetch_limit, None, unregistered
+            ))
+        
+        unroutable = []
+        for notification in claimed:
+            channel = self.channels.get(notification.notification_type)
+            if channel is None:
+                unroutable.append(notification)
+            else:
+                self.scheduler.push(notification, channel.rate_limit_key(notification))
+        
+        if unroutable:
+            # Для них нет канала: send_notifications сразу пометит их failed
+            await self.send_notifications(unroutable)
+        
+        return len(claimed)
+    
+    def _needs_refill(self) -> bool:
+        """Очередь канала с невыбранным остатком в хранилище опустела наполовину."""
+        return any(
+            self.scheduler.count(notification_type) <= self.fetch_limit // 2
+            for notification_type in self._backlogged
+        )
+    
+    async def _renew_claims(self) -> None:
+        """
+        Продление захвата уведомлений в очереди планировщика и в полете.
+        
+        Уведомление может ждать токена дольше срока захвата; продление раз в
+        треть срока не дает другому отправителю вернуть его в pending.
+        Уведомления, захват которых все же истек, из очереди удаляются.
+        """
+        now = time.monotonic()
+        if now - self._last_renew < self.storage.claim_timeout / 3:
+            return
+        self._last_renew = now
+        
+        queued = self.scheduler.queued_ids()
+        held = queued + list(self._inflight_ids)
+        if not held:
+            return
+        
+        loop = asyncio.get_running_loop()
+        renewed = await loop.run_in_executor(None, self.storage.renew_claims, held)
+        lost = {notification_id for notification_id in queued if notification_id not in renewed}
+        if lost:
+            self.scheduler.discard(lost)
+            logger.warning(f"Dropped {len(lost)} queued notifications with expired claims")
+    
+    async def _send_channel_batch(self, notification_type: NotificationType, batch: List[Notification]):
+        """Отправка пакета одного канала с освобождением канала по завершении."""
+        batch_ids = [notification.id for notification in batch]
+        self._inflight_ids.update(batch_ids)
+        try:
+            await self.send_notifications(batch)
+        except Exception as e:
+            logger.error(f"Error sending {notification_type.value} batch: {e}")
+        finally:
+            self._inflight_ids.difference_update(batch_ids)
+            self._busy_channels.discard(notification_type)
+            self._wakeup.set()
+    
+    async def _run(self):
+        """Основной цикл отправителя внутри event loop."""
+        next_poll = 0.0
         
         while self.running:
             try:
-                # Получаем pending уведомления
-                pending_notifications = self.storage.get_pending_notifications(limit=10)
+                now = time.monotonic()
+                if now >= next_poll or self._needs_refill():
+                    await self._fill_scheduler()
+                    next_poll = now + self.check_interval
                 
-                if pending_notifications:
-                    # Создаем event loop для асинхронной обработки
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    
-                    # Отправляем каждое уведомление
-                    tasks = []
-                    for notification in pending_notifications:
-                        tasks.append(self.send_notification(notification))
-                    
-                    # Запускаем все задачи параллельно
-                    if tasks:
-                        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
-                    
-                    loop.close()
+                batch_sizes = {
+                    notification_type: channel.batch_size
+                    for notification_type, channel in self.channels.items()
+                    if notification_type not in self._busy_channels
+                }
+                ready, token_wait = self.scheduler.take_ready(batch_sizes)
                 
-                # Пауза перед следующей проверкой
-                time.sleep(self.check_interval)
+                for notification_type, batch in ready.items():
+                    self._busy_channels.add(notification_type)
+                    task = asyncio.ensure_future(self._send_channel_batch(notification_type, batch))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._inflight.discard)
                 
+                timeout = max(0.0, next_poll - time.monotonic())
+                if token_wait is not None:
+                    timeout = min(timeout, token_wait)
             except Exception as e:
                 logger.error(f"Error in notification worker: {e}")
-                time.sleep(10)
+                timeout = 10
+            
+            # Пауза до токена, следующей проверки хранилища, завершения
+            # пакета или wake()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._poll_requested:
+                self._poll_requested = False
+                next_poll = 0.0
+        
+        # Дожидаемся пакетов в полете, неотправленное возвращаем в pending
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        queued = self.scheduler.drain()
+        if queued:
+            self.storage.release_notifications([notification.id for notification in queued])
+            logger.info(f"Returned {len(queued)} queued notifications to pending")
+    
+    def _worker_loop(self):
+        """Цикл обработки уведомлений."""
+        logger.info("Notification sender worker started")
+        
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._wakeup = asyncio.Event()
+        self._loop = loop
+        
+        try:
+            loop.run_until_complete(self._run())
+        finally:
+            self._loop = None
+            loop.close()
+    
+    def _request_poll(self) -> None:
+        """Проверка хранилища на следующей итерации цикла (в потоке цикла)."""
+        self._poll_requested = True
+        self._wakeup.set()
+    
+    def wake(self) -> None:
+        """Немедленная проверка новых уведомлений (потокобезопасно)."""
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._request_poll)
+            except RuntimeError:
+                # Цикл уже остановлен
+                pass
+    
+    def run_coroutine(self, coro) -> Any:
+        """
+        Выполнение корутины в цикле отправителя (или во временном цикле,
+        если отправитель не запущен).
+        
+        Args:
+            coro: Корутина
+        
+        Returns:
+            Результат корутины
+        """
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            return asyncio.run_coroutine_threadsafe(coro, loop).result()
+        
+        return asyncio.run(coro)
     
     def start(self):
         """Запуск отправителя."""
@@ -1070,10 +2425,18 @@ class NotificationSender:
     def stop(self):
         """Остановка отправителя."""
         self.running = False
+        self.wake()
         
         if self.worker_thread:
             self.worker_thread.join(timeout=10)
         
+        # Закрываем постоянные соединения каналов
+        for channel in self.channels.values():
+            try:
+                channel.close()
+            except Exception as e:
+                logger.error(f"Error closing channel {channel.get_name()}: {e}")
+        
         logger.info("Notification sender stopped")
 
 
@@ -1090,6 +2453,8 @@ class NotificationService:
         self.storage = storage or NotificationStorage()
         self.sender = NotificationSender(self.storage)
         self.validator = NotificationValidator()
+        self.coalescer = DigestCoalescer(self.storage, on_ready=self.sender.wake)
+        self.sender.coalescer = self.coalescer
         
         # Регистрация каналов по умолчанию
         self._register_default_channels()
@@ -1191,10 +2556,21 @@ class NotificationService:
             logger.error(f"Notification validation failed: {errors}")
             return None
         
+        # Шаблоны с включенным дайджестом копятся в буфере
+        policy = self.coalescer.get_policy(notification)
+        if policy is not None:
+            if self.coalescer.buffer(notification, policy):
+                logger.info(f"Notification buffered for digest: {notification.id}")
+                return notification
+            logger.error(f"Failed to buffer notification: {notification.id}")
+            return None
+        
         # Сохраняем
         success = self.storage.save_notification(notification)
         if success:
             logger.info(f"Notification created: {notification.id}")
+            if scheduled_for is None:
+                self.sender.wake()
             return notification
         else:
             logger.error(f"Failed to save notification: {notification.id}")
@@ -1232,12 +2608,11 @@ class NotificationService:
             **kwargs
         )
         
-        if notification:
-            # Немедленная отправка (в реальном приложении через очередь)
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            success = loop.run_until_complete(self.sender.send_notification(notification))
-            loop.close()
+        # Захватываем уведомление, чтобы фоновый отправитель не взял его повторно
+        if notification and self.storage.claim_notification(notification.id):
+            # Немедленная отправка в цикле отправителя
+            sent = self.sender.run_coroutine(self.sender.send_notifications([notification]))
+            success = sent == 1
             
             if success:
                 return notification.id
@@ -1285,6 +2660,59 @@ class NotificationService:
             logger.error(f"Failed to create template: {name}")
             return None
     
+    def enable_digest(
+        self,
+        template_name: str,
+        window_seconds: float = 300.0,
+        digest_template_name: Optional[str] = None,
+        max_items: int = 50
+    ) -> bool:
+        """
+        Включение объединения уведомлений шаблона в дайджесты.
+        
+        Уведомления одного пользователя по одному каналу и шаблону,
+        пришедшие в течение окна, отправляются одним дайджестом.
+        
+        Args:
+            template_name: Имя шаблона
+            window_seconds: Длина окна от первого уведомления группы
+            digest_template_name: Шаблон дайджеста (None — встроенный список)
+            max_items: Отправить досрочно при таком количестве уведомлений
+        
+        Returns:
+            True если шаблон найден
+        """
+        template = self.storage.get_template_by_name(template_name)
+        if not template:
+            logger.error(f"Template not found: {template_name}")
+            return False
+        
+        self.coalescer.set_policy(template.id, DigestPolicy(
+            template_name=template_name,
+            window_seconds=window_seconds,
+            digest_template_name=digest_template_name,
+            max_items=max_items
+        ))
+        logger.info(f"Digest enabled for template {template_name} ({window_seconds}s window)")
+        return True
+    
+    def disable_digest(self, template_name: str) -> None:
+        """
+        Отключение дайджеста для шаблона (уже накопленные группы будут отправлены).
+        
+        Args:
+            template_name: Имя шаблона
+        """
+        template = self.storage.get_template_by_name(template_name)
+        if template:
+            self.coalescer.set_policy(template.id, None)
+            flushed = False
+            for key in self.storage.get_due_digest_keys(datetime.max):
+                if key.endswith(f":{template.id}"):
+                    flushed = self.coalescer.flush_group(key) is not None or flushed
+            if flushed:
+                self.sender.wake()
+    
     def get_user_notifications(
         self,
         user_id: str,
@@ -1383,4 +2811,72 @@ The Team""",
 <p><strong>Your account details:</strong></p>
 <ul>
 <li><strong>Username:</strong> {{username}}</li>
-<li><strong>Email:</strong> {{email}}</
\ No newline at end of file
+<li><strong>Email:</strong> {{email}}</li>
+</ul>
+<p>Best regards,<br>The Team</p>""",
+            variables=["name", "username", "email"]
+        )
+        print(f"   Template created: {welcome_template.name if welcome_template else 'failed'}")
+        
+        # Шаблон для Slack
+        alert_template = service.create_template(
+            name="system_alert",
+            notification_type=NotificationType.SLACK,
+            body="*{{level}}*: {{message}}",
+            variables=["level", "message"]
+        )
+        print(f"   Template created: {alert_template.name if alert_template else 'failed'}")
+        
+        # Запуск фоновой отправки
+        print("\n2. Starting notification service...")
+        service.start_service()
+        
+        # Уведомления по шаблонам
+        print("\n3. Creating notifications...")
+        welcome = service.create_notification(
+            user_id="user_123",
+            notification_type=NotificationType.EMAIL,
+            recipient="john.doe@example.com",
+            template_name="welcome_email",
+            template_variables={
+                "name": "John",
+                "username": "johndoe",
+                "email": "john.doe@example.com"
+            }
+        )
+        print(f"   Welcome email: {welcome.id if welcome else 'failed'}")
+        
+        alert = service.create_notification(
+            user_id="admin",
+            notification_type=NotificationType.SLACK,
+            recipient="https://hooks.slack.com/services/T000/B000/XXXX",
+            priority=NotificationPriority.HIGH,
+            template_name="system_alert",
+            template_variables={"level": "WARNING", "message": "Disk usage is above 80%"}
+        )
+        print(f"   Slack alert: {alert.id if alert else 'failed'}")
+        
+        # Отложенное уведомление
+        reminder = service.create_notification(
+            user_id="user_123",
+            notification_type=NotificationType.EMAIL,
+            recipient="john.doe@example.com",
+            subject="Reminder",
+            body="Don't forget to complete your profile.",
+            scheduled_for=datetime.now() + timedelta(hours=1)
+        )
+        print(f"   Scheduled reminder: {reminder.id if reminder else 'failed'}")
+        
+        # Даем отправителю обработать очередь (SMTP и Slack в демо недоступны)
+        time.sleep(2)
+        
+        print("\n4. Statistics:")
+        print(json.dumps(service.get_stats(days=1), indent=2, default=str))
+        
+    finally:
+        service.stop_service()
+        print("\n=== Demo completed ===")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Нагрузочная проверка отправки уведомлений (deepseek_secure_12).
+
+Отправка идет через полный путь NotificationSender — захват из БД,
+планировщик, пулы соединений каналов и пакетная запись статусов — на
+локальные SMTP и HTTP заглушки.
+
+Запуск: python deepseek_secure_12_benchmark.py [количество]
+"""
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+from deepseek_secure_12 import (
+    EmailChannel,
+    Notification,
+    NotificationSender,
+    NotificationStatus,
+    NotificationStorage,
+    NotificationType,
+    WebhookChannel,
+)
+
+
+class _LocalSMTPHandler(socketserver.StreamRequestHandler):
+    """Минимальный SMTP сервер-заглушка для benchmark_delivery: принимает все письма."""
+    
+    def handle(self):
+        self.wfile.write(b"220 localhost ESMTP\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.wfile.write(b"250 localhost\r\n")
+            elif command == b"DATA":
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                self.server.received += 1
+                self.wfile.write(b"250 OK\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP
+                self.wfile.write(b"250 OK\r\n")
+
+
+class _LocalHTTPHandler(BaseHTTPRequestHandler):
+    """HTTP сервер-заглушка для benchmark_delivery: отвечает 200 с keep-alive."""
+    
+    protocol_version = "HTTP/1.1"
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.received += 1
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark_delivery(count: int = 2000, timeout: float = 60.0) -> Dict[str, float]:
+    """
+    Проверка пакетной отправки на локальных SMTP и HTTP заглушках.
+    
+    Половина уведомлений отправляется по email, половина вебхуками; все
+    проходят полный путь: захват из БД, планировщик, пулы соединений
+    каналов и пакетная запись статусов.
+    
+    Args:
+        count: Количество уведомлений
+        timeout: Максимальное время ожидания отправки (секунды)
+    
+    Returns:
+        Число отправленных (по статусам в БД и по данным заглушек),
+        время и уведомлений в секунду
+    """
+    smtp_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _LocalSMTPHandler)
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), _LocalHTTPHandler)
+    smtp_server.daemon_threads = True
+    http_server.daemon_threads = True
+    smtp_server.received = 0
+    http_server.received = 0
+    servers = [smtp_server, http_server]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    sender = None
+    
+    try:
+        storage = NotificationStorage(db_path)
+        webhook_url = f"http://127.0.0.1:{http_server.server_address[1]}/hook"
+        for i in range(count):
+            email = i % 2 == 0
+            storage.save_notification(Notification(
+                id=str(uuid.uuid4()),
+                user_id=f"user{i % 100}",
+                notification_type=NotificationType.EMAIL if email else NotificationType.WEBHOOK,
+                recipient=f"user{i}@example.com" if email else webhook_url,
+                subject=f"Benchmark {i}",
+                body="Benchmark notification"
+            ))
+        
+        sender = NotificationSender(storage)
+        sender.register_channel(EmailChannel(
+            smtp_host='127.0.0.1',
+            smtp_port=smtp_server.server_address[1],
+            use_tls=False
+        ))
+        sender.register_channel(WebhookChannel())
+        
+        start = time.perf_counter()
+        sender.start()
+        deadline = time.monotonic() + timeout
+        while smtp_server.received + http_server.received < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        
+        sender.stop()
+        sender = None
+        stats = storage.get_notification_stats(datetime.min, datetime.max)
+        sent = stats.get('by_status', {}).get(NotificationStatus.SENT.value, 0)
+        
+        return {
+            'sent': sent,
+            'smtp_received': smtp_server.received,
+            'http_received': http_server.received,
+            'seconds': elapsed,
+            'per_second': (smtp_server.received + http_server.received) / elapsed if elapsed > 0 else 0.0
+        }
+    finally:
+        if sender is not None:
+            sender.stop()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        os.remove(db_path)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    results = benchmark_delivery(count)
+    for name, value in results.items():
+        print(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
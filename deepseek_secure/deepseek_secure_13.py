@@ -1,12 +1,17 @@
-from typing import Dict, List, Set, Optional, Any
+from typing import Dict, List, Set, Optional, Any, Callable, Iterable, Tuple
 from dataclasses import dataclass, field
 from enum import Enum
 import sqlite3
 from contextlib import contextmanager
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 import json
 from abc import ABC, abstractmethod
+import atexit
+import queue
+import random
+import threading
+import time
 import uuid
 
 logging.basicConfig(level=logging.INFO)
@@ -48,6 +53,53 @@ class ResourceType(str, Enum):
     REPORT = "report"
 
 
+# Битовые маски разрешений: бит на каждую пару (ResourceType, Permission)
+_PERMISSION_BITS: Dict[Tuple[ResourceType, Permission], int] = {
+    (resource, permission): 1 << (resource_index * len(Permission) + permission_index)
+    for resource_index, resource in enumerate(ResourceType)
+    for permission_index, permission in enumerate(Permission)
+}
+
+
+def permission_bit(resource: ResourceType, permission: Permission) -> int:
+    """Бит пары (ресурс, разрешение) в маске разрешений."""
+    return _PERMISSION_BITS[(resource, permission)]
+
+
+def permissions_to_mask(permissions: Dict[ResourceType, Set[Permission]]) -> int:
+    """
+    Компиляция словаря разрешений в битовую маску.
+    
+    Args:
+        permissions: Разрешения по типам ресурсов
+    
+    Returns:
+        Битовая маска
+    """
+    mask = 0
+    for resource, perms in permissions.items():
+        for permission in perms:
+            mask |= _PERMISSION_BITS[(resource, permission)]
+    return mask
+
+
+def mask_to_permissions(mask: int) -> Dict[ResourceType, Set[Permission]]:
+    """
+    Обратное преобразование битовой маски в словарь разрешений.
+    
+    Args:
+        mask: Битовая маска
+    
+    Returns:
+        Разрешения по типам ресурсов
+    """
+    permissions: Dict[ResourceType, Set[Permission]] = {}
+    for (resource, permission), bit in _PERMISSION_BITS.items():
+        if mask & bit:
+            permissions.setdefault(resource, set()).add(permission)
+    return permissions
+
+
 @dataclass
 class Role:
     """Роль пользователя."""
@@ -57,6 +109,10 @@ class Role:
     permissions: Dict[ResourceType, Set[Permission]] = field(default_factory=dict)
     is_system: bool = False
     created_at: datetime = field(default_factory=datetime.now)
+    # Родительские роли: их разрешения наследуются
+    parent_ids: List[str] = field(default_factory=list)
+    # Материализованные разрешения с учетом всех предков (заполняет хранилище)
+    effective_permissions: Dict[ResourceType, Set[Permission]] = field(default_factory=dict, compare=False)
     
     def add_permission(self, resource: ResourceType, permission: Permission) -> None:
         """Добавление разрешения к роли."""
@@ -88,7 +144,8 @@ class Role:
                 for resource, perms in self.permissions.items()
             },
             'is_system': self.is_system,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at.isoformat(),
+            'parent_ids': list(self.parent_ids)
         }
     
     @classmethod
@@ -105,7 +162,8 @@ class Role:
             description=data['description'],
             permissions=permissions,
             is_system=data.get('is_system', False),
-            created_at=datetime.fromisoformat(data['created_at'])
+            created_at=datetime.fromisoformat(data['created_at']),
+            parent_ids=list(data.get('parent_ids', []))
         )
 
 
@@ -144,6 +202,14 @@ class RBACStorage:
         self._init_database()
         self._cache = {}
         self._cache_ttl = 300  # 5 минут
+        self._listeners: List[Callable[[str, str], None]] = []
+        
+        # Изменения из других процессов: PRAGMA data_version меняется при
+        # любом чужом коммите, тогда сверяется счетчик rbac_changes
+        self._watch_conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._watch_lock = threading.Lock()
+        self._data_version = self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+        self._change_version = self._read_change_version()
         
     def _init_database(self):
         """Инициализация структуры базы данных."""
@@ -162,6 +228,23 @@ class RBACStorage:
                 )
             """)
             
+            # Миграция: иерархия ролей
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(roles)")}
+            if 'parent_ids' not in columns:
+                cursor.execute("ALTER TABLE roles ADD COLUMN parent_ids TEXT")  # JSON массив role_id
+            if 'effective_permissions' not in columns:
+                cursor.execute("ALTER TABLE roles ADD COLUMN effective_permissions TEXT")  # JSON объект
+            
+            # Транзитивное замыкание иерархии: (роль, предок), включая саму роль
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS role_closure (
+                    role_id TEXT NOT NULL,
+                    ancestor_id TEXT NOT NULL,
+                    PRIMARY KEY (role_id, ancestor_id)
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_role_closure_ancestor ON role_closure(ancestor_id)")
+            
             # Таблица пользователей
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS users (
@@ -190,6 +273,26 @@ class RBACStorage:
                 )
             """)
             
+            # Счетчик изменений ролей и пользователей: по нему кеши разрешений
+            # в других процессах узнают, что их нужно сбросить (записи аудита
+            # его не меняют)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS rbac_changes (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    version INTEGER NOT NULL
+                )
+            """)
+            cursor.execute("INSERT OR IGNORE INTO rbac_changes (id, version) VALUES (1, 0)")
+            for table in ('roles', 'users'):
+                for event in ('INSERT', 'UPDATE', 'DELETE'):
+                    cursor.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_changes
+                        AFTER {event} ON {table}
+                        BEGIN
+                            UPDATE rbac_changes SET version = version + 1 WHERE id = 1;
+                        END
+                    """)
+            
             # Индексы
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_user ON audit_log(user_id, created_at)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_resource ON audit_log(resource_type, resource_id)")
@@ -198,6 +301,13 @@ class RBACStorage:
             
             # Создаем системные роли если их нет
             self._create_system_roles(conn)
+            
+            # Материализуем иерархию для ролей без замыкания (новые БД и миграция)
+            cursor.execute("SELECT id FROM roles WHERE id NOT IN (SELECT role_id FROM role_closure)")
+            missing = [row['id'] for row in cursor.fetchall()]
+            if missing:
+                self._recompute_hierarchy(conn, missing)
+                conn.commit()
     
     def _create_system_roles(self, conn: sqlite3.Connection):
         """Создание системных ролей по умолчанию."""
@@ -273,6 +383,268 @@ class RBACStorage:
         
         conn.commit()
     
+    @staticmethod
+    def _encode_permissions(permissions: Dict[ResourceType, Set[Permission]]) -> str:
+        return json.dumps({
+            resource.value: sorted(perm.value for perm in perms)
+            for resource, perms in permissions.items()
+        })
+    
+    @staticmethod
+    def _decode_permissions(data: Optional[str]) -> Dict[ResourceType, Set[Permission]]:
+        permissions_data = json.loads(data) if data else {}
+        return {
+            ResourceType(resource_str): {Permission(p) for p in perms_list}
+            for resource_str, perms_list in permissions_data.items()
+        }
+    
+    @staticmethod
+    def _fetch_in(cursor: sqlite3.Cursor, query: str, ids: Iterable[str], chunk_size: int = 500) -> List[sqlite3.Row]:
+        """Выполнение запроса с условием IN (...) по частям."""
+        ids = list(ids)
+        rows = []
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            cursor.execute(query.format(', '.join('?' * len(chunk))), chunk)
+            rows.extend(cursor.fetchall())
+        return rows
+    
+    def _recompute_hierarchy(
+        self,
+        conn: sqlite3.Connection,
+        role_ids: Iterable[str],
+        structure_changed: bool = True
+    ) -> List[str]:
+        """
+        Инкрементальный пересчет замыкания и эффективных разрешений.
+        
+        Пересчитываются только переданные роли и их потомки; для
+        родителей вне этого множества используются уже материализованные
+        предки и разрешения. Записываются только изменившиеся строки.
+        
+        Args:
+            conn: Соединение (изменения не фиксируются)
+            role_ids: Измененные роли
+            structure_changed: Изменились родители (иначе замыкание не пересчитывается)
+        
+        Returns:
+            ID переданных ролей и потомков, чьи эффективные разрешения изменились
+        """
+        cursor = conn.cursor()
+        roots = set(role_ids)
+        affected = set(roots)
+        affected.update(
+            row['role_id'] for row in self._fetch_in(
+                cursor, "SELECT role_id FROM role_closure WHERE ancestor_id IN ({})", affected
+            )
+        )
+        
+        parents: Dict[str, List[str]] = {}
+        own: Dict[str, Dict[ResourceType, Set[Permission]]] = {}
+        stored: Dict[str, Optional[str]] = {}
+        query = "SELECT id, parent_ids, permissions, effective_permissions FROM roles WHERE id IN ({})"
+        for row in self._fetch_in(cursor, query, affected):
+            parents[row['id']] = json.loads(row['parent_ids']) if row['parent_ids'] else []
+            own[row['id']] = self._decode_permissions(row['permissions'])
+            stored[row['id']] = row['effective_permissions']
+        affected = set(parents)
+        
+        # Уже материализованные родители вне пересчитываемого множества
+        ancestors: Dict[str, Set[str]] = {}
+        effective: Dict[str, Dict[ResourceType, Set[Permission]]] = {}
+        external = {parent_id for ids in parents.values() for parent_id in ids if parent_id not in affected}
+        for row in self._fetch_in(cursor, "SELECT id, effective_permissions FROM roles WHERE id IN ({})", external):
+            effective[row['id']] = self._decode_permissions(row['effective_permissions'])
+            ancestors[row['id']] = {row['id']}
+        if structure_changed:
+            query = "SELECT role_id, ancestor_id FROM role_closure WHERE role_id IN ({})"
+            for row in self._fetch_in(cursor, query, external):
+                ancestors[row['role_id']].add(row['ancestor_id'])
+        
+        # Топологический порядок (родители раньше детей), итеративно — глубина не ограничена
+        order: List[str] = []
+        state: Dict[str, int] = {}
+        for root in affected:
+            stack = [(root, False)]
+            while stack:
+                role_id, expanded = stack.pop()
+                if expanded:
+                    state[role_id] = 2
+                    order.append(role_id)
+                    continue
+                if role_id in state:
+                    continue
+                state[role_id] = 1
+                stack.append((role_id, True))
+                for parent_id in parents[role_id]:
+                    if parent_id in affected and parent_id not in state:
+                        stack.append((parent_id, False))
+        
+        for role_id in order:
+            role_ancestors = {role_id}
+            role_permissions = {resource: set(perms) for resource, perms in own[role_id].items()}
+            for parent_id in parents[role_id]:
+                if parent_id not in ancestors:
+                    continue  # Удаленный родитель или цикл
+                role_ancestors |= ancestors[parent_id]
+                for resource, perms in effective[parent_id].items():
+                    role_permissions.setdefault(resource, set()).update(perms)
+            ancestors[role_id] = role_ancestors
+            effective[role_id] = role_permissions
+        
+        if structure_changed:
+            closure = {(role_id, ancestor_id) for role_id in affected for ancestor_id in ancestors[role_id]}
+            existing = {
+                (row['role_id'], row['ancestor_id']) for row in self._fetch_in(
+                    cursor, "SELECT role_id, ancestor_id FROM role_closure WHERE role_id IN ({})", affected
+                )
+            }
+            cursor.executemany(
+                "DELETE FROM role_closure WHERE role_id = ? AND ancestor_id = ?",
+                list(existing - closure)
+            )
+            cursor.executemany(
+                "INSERT INTO role_closure (role_id, ancestor_id) VALUES (?, ?)",
+                list(closure - existing)
+            )
+        
+        changed = []
+        updates = []
+        for role_id in affected:
+            encoded = self._encode_permissions(effective[role_id])
+            if encoded != stored[role_id]:
+                updates.append((encoded, role_id))
+                changed.append(role_id)
+            elif role_id in roots:
+                changed.append(role_id)
+        cursor.executemany("UPDATE roles SET effective_permissions = ? WHERE id = ?", updates)
+        
+        return changed
+    
+    def get_role_ancestors(self, role_id: str) -> List[str]:
+        """
+        Все предки роли (по материализованному замыканию).
+        
+        Args:
+            role_id: ID роли
+        
+        Returns:
+            ID предков (без самой роли)
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT ancestor_id FROM role_closure WHERE role_id = ? AND ancestor_id != ? ORDER BY ancestor_id",
+                    (role_id, role_id)
+                )
+                return [row['ancestor_id'] for row in cursor.fetchall()]
+        
+        except Exception as e:
+            logger.error(f"Error getting ancestors of role {role_id}: {e}")
+            return []
+    
+    def get_role_descendants(self, role_id: str) -> List[str]:
+        """
+        Все потомки роли (по материализованному замыканию).
+        
+        Args:
+            role_id: ID роли
+        
+        Returns:
+            ID потомков (без самой роли)
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT role_id FROM role_closure WHERE ancestor_id = ? AND role_id != ? ORDER BY role_id",
+                    (role_id, role_id)
+                )
+                return [row['role_id'] for row in cursor.fetchall()]
+        
+        except Exception as e:
+            logger.error(f"Error getting descendants of role {role_id}: {e}")
+            return []
+    
+    @staticmethod
+    def _fetch_change_version(cursor: sqlite3.Cursor) -> int:
+        cursor.execute("SELECT version FROM rbac_changes WHERE id = 1")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    
+    def _read_change_version(self) -> int:
+        return self._fetch_change_version(self._watch_conn.cursor())
+    
+    def _record_own_change(self, version_before: int, version_after: int) -> None:
+        """
+        Учет собственного коммита: его изменения уже разосланы точечно,
+        поэтому check_external_changes не должен сбрасывать из-за него весь кеш.
+        
+        Args:
+            version_before: Счетчик rbac_changes в начале транзакции записи
+            version_after: Счетчик перед ее коммитом
+        """
+        with self._watch_lock:
+            # Если до транзакции были непрочитанные чужие изменения,
+            # отметка не сдвигается — их найдет следующая проверка
+            if self._change_version == version_before:
+                self._change_version = version_after
+    
+    def check_external_changes(self) -> bool:
+        """
+        Проверка изменений ролей и пользователей, сделанных через другие
+        соединения (в том числе другими процессами).
+        
+        При изменениях кеш хранилища сбрасывается, а подписчики получают
+        событие kind='all'.
+        
+        Returns:
+            True если были изменения
+        """
+        with self._watch_lock:
+            data_version = self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return False
+            self._data_version = data_version
+            
+            change_version = self._read_change_version()
+            if change_version == self._change_version:
+                return False
+            self._change_version = change_version
+        
+        self._cache.clear()
+        self._notify('all', '')
+        return True
+    
+    def subscribe(self, callback: Callable[[str, str], None]) -> None:
+        """
+        Подписка на изменения ролей и пользователей.
+        
+        Args:
+            callback: Функция (kind, entity_id), kind — 'role', 'user'
+                или 'all' (изменения из другого процесса, entity_id пуст)
+        """
+        self._listeners.append(callback)
+    
+    def unsubscribe(self, callback: Callable[[str, str], None]) -> None:
+        """Отписка от изменений."""
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+    
+    def _notify(self, kind: str, entity_id: str) -> None:
+        """Оповещение подписчиков об изменении."""
+        for callback in list(self._listeners):
+            try:
+                callback(kind, entity_id)
+            except Exception as e:
+                logger.error(f"Error in RBAC change listener: {e}")
+    
+    def close(self) -> None:
+        """Закрытие соединения, отслеживающего изменения."""
+        with self._watch_lock:
+            self._watch_conn.close()
+    
     @contextmanager
     def _get_connection(self):
         """Контекстный менеджер для подключения к БД."""
@@ -284,14 +656,40 @@ class RBACStorage:
             conn.close()
     
     def save_role(self, role: Role) -> bool:
-        """Сохранение роли."""
+        """Сохранение роли с пересчетом иерархии ее потомков."""
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                version_before = self._fetch_change_version(cursor)
+                
+                # Родители должны существовать и не быть потомками роли
+                parent_ids = list(dict.fromkeys(role.parent_ids))
+                if parent_ids:
+                    existing = {
+                        row['id'] for row in self._fetch_in(cursor, "SELECT id FROM roles WHERE id IN ({})", parent_ids)
+                    }
+                    unknown = [parent_id for parent_id in parent_ids if parent_id not in existing]
+                    if unknown:
+                        conn.rollback()
+                        logger.error(f"Unknown parent roles for {role.id}: {unknown}")
+                        return False
+                    
+                    cursor.execute("SELECT role_id FROM role_closure WHERE ancestor_id = ?", (role.id,))
+                    descendants = {row['role_id'] for row in cursor.fetchall()} | {role.id}
+                    cyclic = [parent_id for parent_id in parent_ids if parent_id in descendants]
+                    if cyclic:
+                        conn.rollback()
+                        logger.error(f"Role hierarchy cycle: {role.id} -> {cyclic}")
+                        return False
+                
+                cursor.execute("SELECT parent_ids FROM roles WHERE id = ?", (role.id,))
+                row = cursor.fetchone()
+                structure_changed = row is None or (json.loads(row['parent_ids']) if row['parent_ids'] else []) != parent_ids
                 
                 cursor.execute("""
-                    INSERT OR REPLACE INTO roles (id, name, description, permissions, is_system)
-                    VALUES (?, ?, ?, ?, ?)
+                    INSERT OR REPLACE INTO roles (id, name, description, permissions, is_system, parent_ids)
+                    VALUES (?, ?, ?, ?, ?, ?)
                 """, (
                     role.id,
                     role.name,
@@ -300,14 +698,21 @@ class RBACStorage:
                         resource.value: list(perms)
                         for resource, perms in role.permissions.items()
                     }),
-                    role.is_system
+                    role.is_system,
+                    json.dumps(parent_ids)
                 ))
                 
+                affected = self._recompute_hierarchy(conn, [role.id], structure_changed)
+                version_after = self._fetch_change_version(cursor)
                 conn.commit()
+                self._record_own_change(version_before, version_after)
                 
-                # Инвалидируем кеш
-                self._cache.pop(f"role_{role.id}", None)
+                # Инвалидируем кеш роли и потомков с изменившимися разрешениями
+                for role_id in affected:
+                    self._cache.pop(f"role_{role_id}", None)
                 self._cache.pop("all_roles", None)
+                for role_id in affected:
+                    self._notify('role', role_id)
                 
                 logger.info(f"Role saved: {role.name}")
                 return True
@@ -339,7 +744,8 @@ class RBACStorage:
                         name=row['name'],
                         description=row['description'],
                         is_system=bool(row['is_system']),
-                        created_at=datetime.fromisoformat(row['created_at'])
+                        created_at=datetime.fromisoformat(row['created_at']),
+                        parent_ids=json.loads(row['parent_ids']) if row['parent_ids'] else []
                     )
                     
                     # Загружаем разрешения
@@ -348,6 +754,13 @@ class RBACStorage:
                         resource = ResourceType(resource_str)
                         role.permissions[resource] = {Permission(p) for p in perms_list}
                     
+                    if row['effective_permissions'] is not None:
+                        role.effective_permissions = self._decode_permissions(row['effective_permissions'])
+                    else:
+                        role.effective_permissions = {
+                            resource: set(perms) for resource, perms in role.permissions.items()
+                        }
+                    
                     # Кешируем
                     self._cache[cache_key] = {
                         'data': role,
@@ -397,6 +810,8 @@ class RBACStorage:
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                version_before = self._fetch_change_version(cursor)
                 
                 cursor.execute("""
                     INSERT OR REPLACE INTO users (id, username, email, is_active, roles)
@@ -409,10 +824,13 @@ class RBACStorage:
                     json.dumps(user.role_ids)
                 ))
                 
+                version_after = self._fetch_change_version(cursor)
                 conn.commit()
+                self._record_own_change(version_before, version_after)
                 
                 # Инвалидируем кеш
                 self._cache.pop(f"user_{user.id}", None)
+                self._notify('user', user.id)
                 
                 logger.info(f"User saved: {user.username}")
                 return True
@@ -473,24 +891,60 @@ class RBACStorage:
         user_agent: Optional[str] = None
     ) -> bool:
         """Логирование аудита."""
+        return self.log_audit_batch([self.build_audit_row(
+            user_id, action, resource_type, resource_id, details, ip_address, user_agent
+        )])
+    
+    @staticmethod
+    def build_audit_row(
+        user_id: Optional[str],
+        action: str,
+        resource_type: Optional[ResourceType] = None,
+        resource_id: Optional[str] = None,
+        details: Optional[Dict[str, Any]] = None,
+        ip_address: Optional[str] = None,
+        user_agent: Optional[str] = None
+    ) -> Tuple:
+        """
+        Строка audit_log для вставки.
+        
+        Время фиксируется в момент события (в формате CURRENT_TIMESTAMP),
+        а не в момент записи, поэтому отложенная запись не искажает его.
+        """
+        return (
+            str(uuid.uuid4()),
+            user_id,
+            action,
+            resource_type.value if resource_type else None,
+            resource_id,
+            json.dumps(details) if details else None,
+            ip_address,
+            user_agent,
+            datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        )
+    
+    def log_audit_batch(self, rows: List[Tuple]) -> bool:
+        """
+        Запись пачки событий аудита одной транзакцией.
+        
+        Args:
+            rows: Строки из build_audit_row
+        
+        Returns:
+            True если успешно
+        """
+        if not rows:
+            return True
+        
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 
-                cursor.execute("""
+                cursor.executemany("""
                     INSERT INTO audit_log 
-                    (id, user_id, action, resource_type, resource_id, details, ip_address, user_agent)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    str(uuid.uuid4()),
-                    user_id,
-                    action,
-                    resource_type.value if resource_type else None,
-                    resource_id,
-                    json.dumps(details) if details else None,
-                    ip_address,
-                    user_agent
-                ))
+                    (id, user_id, action, resource_type, resource_id, details, ip_address, user_agent, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
                 
                 conn.commit()
                 return True
@@ -500,11 +954,396 @@ class RBACStorage:
             return False
 
 
+class AuditWriter:
+    """
+    Фоновая пакетная запись аудита.
+    
+    События складываются в ограниченную очередь и записываются фоновым
+    потоком пачками: не позже flush_interval после первого события пачки
+    или сразу по набору batch_size. Если очередь переполнена, событие
+    записывается синхронно в вызывающем потоке (события не теряются).
+    Успешные проверки можно сэмплировать через granted_sample_rate;
+    отказы пишутся всегда. При остановке процесса очередь дописывается.
+    
+    Сервисы, создаваемые на каждый запрос, должны использовать общий
+    писатель хранилища (shared), а не запускать по потоку на сервис.
+    """
+    
+    _STOP = object()
+    
+    # Общие писатели по хранилищам (живут до конца процесса)
+    _shared: Dict[RBACStorage, 'AuditWriter'] = {}
+    _shared_lock = threading.Lock()
+    
+    def __init__(
+        self,
+        storage: RBACStorage,
+        flush_interval: float = 0.05,
+        batch_size: int = 500,
+        max_queue_size: int = 10000,
+        granted_sample_rate: float = 1.0
+    ):
+        """
+        Инициализация.
+        
+        Args:
+            storage: Хранилище RBAC
+            flush_interval: Максимальная задержка записи (секунды)
+            batch_size: Максимальный размер пачки
+            max_queue_size: Емкость очереди
+            granted_sample_rate: Доля записываемых успешных проверок (0..1)
+        """
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.granted_sample_rate = granted_sample_rate
+        
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {
+            'enqueued': 0,
+            'written': 0,
+            'batches': 0,
+            'sampled_out': 0,
+            'overflow': 0,
+            'errors': 0
+        }
+        
+        self._thread = threading.Thread(target=self._run, name="rbac-audit-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    @classmethod
+    def shared(cls, storage: RBACStorage) -> 'AuditWriter':
+        """
+        Общий фоновый писатель для хранилища: один поток на хранилище,
+        сколько бы сервисов его ни использовало.
+        
+        Args:
+            storage: Хранилище RBAC
+        
+        Returns:
+            Работающий писатель
+        """
+        with cls._shared_lock:
+            writer = cls._shared.get(storage)
+            if writer is None or writer._closed:
+                writer = cls._shared[storage] = cls(storage)
+            return writer
+    
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += value
+    
+    def log(
+        self,
+        user_id: Optional[str],
+        action: str,
+        resource_type: Optional[ResourceType] = None,
+        resource_id: Optional[str] = None,
+        details: Optional[Dict[str, Any]] = None,
+        ip_address: Optional[str] = None,
+        user_agent: Optional[str] = None,
+        sampled: bool = False
+    ) -> bool:
+        """
+        Постановка события аудита в очередь.
+        
+        Args:
+            user_id: ID пользователя
+            action: Действие
+            resource_type: Тип ресурса
+            resource_id: ID ресурса
+            details: Детали
+            ip_address: IP адрес
+            user_agent: User agent
+            sampled: Событие подлежит сэмплированию (успешная проверка)
+        
+        Returns:
+            True если событие принято
+        """
+        if sampled and self.granted_sample_rate < 1.0 and random.random() >= self.granted_sample_rate:
+            self._count('sampled_out')
+            return True
+        
+        row = self.storage.build_audit_row(
+            user_id, action, resource_type, resource_id, details, ip_address, user_agent
+        )
+        
+        # Под блокировкой: close() не может дочитать очередь между проверкой
+        # _closed и постановкой события
+        with self._lock:
+            if not self._closed:
+                try:
+                    self._queue.put_nowait(row)
+                    self.stats['enqueued'] += 1
+                    return True
+                except queue.Full:
+                    self.stats['overflow'] += 1
+        
+        return self._write([row])
+    
+    def flush(self) -> None:
+        """Ожидание записи всех событий, поставленных в очередь."""
+        if self._thread.is_alive():
+            self._queue.join()
+    
+    def close(self) -> None:
+        """Остановка потока с записью оставшихся событий."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        
+        self._queue.put(self._STOP)
+        self._thread.join()
+        atexit.unregister(self.close)
+        
+        # События, поставленные в очередь одновременно с остановкой
+        rows = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                rows.append(item)
+        self._write(rows)
+    
+    def _write(self, rows: List[Tuple]) -> bool:
+        if not rows:
+            return True
+        if self.storage.log_audit_batch(rows):
+            with self._lock:
+                self.stats['written'] += len(rows)
+                self.stats['batches'] += 1
+            return True
+        self._count('errors', len(rows))
+        return False
+    
+    def _run(self) -> None:
+        """Цикл фонового потока."""
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is self._STOP:
+                self._queue.task_done()
+                break
+            
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f"Error writing audit batch: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
 class RBACService:
     """Сервис управления доступом на основе ролей."""
     
-    def __init__(self, storage: Optional[RBACStorage] = None):
+    # Действия, которые владелец всегда может выполнять со своим ресурсом
+    OWNER_PERMISSIONS = (Permission.VIEW, Permission.EDIT)
+    
+    # Сколько ID ресурсов (owned/denied) сохранять в одной записи аудита
+    AUDIT_ID_LIMIT = 100
+    
+    def __init__(
+        self,
+        storage: Optional[RBACStorage] = None,
+        audit_writer: Optional[AuditWriter] = None,
+        async_audit: bool = True,
+        change_check_interval: float = 0.5
+    ):
+        """
+        Инициализация.
+        
+        Args:
+            storage: Хранилище RBAC
+            audit_writer: Фоновая запись аудита (по умолчанию общая для
+                хранилища, см. AuditWriter.shared); переданный писатель
+                закрывается в close()
+            async_audit: False — писать аудит синхронно, без фонового потока
+            change_check_interval: Минимальный интервал между проверками
+                изменений в БД из других процессов (секунды). Изменения,
+                сделанные другими процессами, видны не позже чем через этот
+                интервал; изменения через этот экземпляр — сразу. 0 — сверка
+                с БД при каждой проверке разрешения
+        """
         self.storage = storage or RBACStorage()
+        self._owns_audit_writer = audit_writer is not None
+        if audit_writer is None and async_audit:
+            audit_writer = AuditWriter.shared(self.storage)
+        self.audit_writer = audit_writer
+        
+        # Скомпилированные разрешения: user_id -> (маска или None для
+        # неактивного пользователя, role_ids); role_id -> (маска, имя роли)
+        self._user_permissions: Dict[str, Tuple[Optional[int], Tuple[str, ...]]] = {}
+        self._role_permissions: Dict[str, Tuple[int, Optional[str]]] = {}
+        # Обратный индекс для точечной инвалидации: role_id -> user_id
+        self._role_users: Dict[str, Set[str]] = {}
+        self._permissions_lock = threading.RLock()
+        
+        # Изменения из других процессов проверяются не чаще этого интервала
+        self.change_check_interval = change_check_interval
+        self._last_change_check = time.monotonic()
+        
+        self.storage.subscribe(self._on_storage_change)
+    
+    def _check_external_changes(self) -> None:
+        """Сверка с БД: чужие изменения сбрасывают кеш через _on_storage_change."""
+        now = time.monotonic()
+        if now - self._last_change_check < self.change_check_interval:
+            return
+        self._last_change_check = now
+        self.storage.check_external_changes()
+    
+    def _get_role_entry(self, role_id: str) -> Tuple[int, Optional[str]]:
+        """Маска и имя роли (из кеша или хранилища)."""
+        entry = self._role_permissions.get(role_id)
+        if entry is not None:
+            return entry
+        
+        with self._permissions_lock:
+            entry = self._role_permissions.get(role_id)
+            if entry is None:
+                role = self.storage.get_role(role_id)
+                entry = (permissions_to_mask(role.effective_permissions), role.name) if role else (0, None)
+                self._role_permissions[role_id] = entry
+            return entry
+    
+    def _get_user_entry(self, user_id: str) -> Optional[Tuple[Optional[int], Tuple[str, ...]]]:
+        """
+        Скомпилированные разрешения пользователя.
+        
+        Args:
+            user_id: ID пользователя
+        
+        Returns:
+            (маска или None для неактивного пользователя, role_ids)
+            или None если пользователь не найден
+        """
+        self._check_external_changes()
+        
+        entry = self._user_permissions.get(user_id)
+        if entry is not None:
+            return entry
+        
+        # Вычисляем под блокировкой: инвалидация, пришедшая во время
+        # вычисления, дождется его и удалит результат
+        with self._permissions_lock:
+            entry = self._user_permissions.get(user_id)
+            if entry is not None:
+                return entry
+            
+            user = self.storage.get_user(user_id)
+            if not user:
+                return None
+            
+            if user.is_active:
+                role_ids = tuple(user.role_ids)
+                mask = 0
+                for role_id in role_ids:
+                    mask |= self._get_role_entry(role_id)[0]
+            else:
+                role_ids = ()
+                mask = None
+            
+            entry = (mask, role_ids)
+            self._user_permissions[user_id] = entry
+            for role_id in role_ids:
+                self._role_users.setdefault(role_id, set()).add(user_id)
+            return entry
+    
+    def _on_storage_change(self, kind: str, entity_id: str) -> None:
+        """Обработка изменений в хранилище."""
+        if kind == 'user':
+            self.invalidate_user(entity_id)
+        elif kind == 'role':
+            self.invalidate_role(entity_id)
+        elif kind == 'all':
+            with self._permissions_lock:
+                self._user_permissions.clear()
+                self._role_permissions.clear()
+                self._role_users.clear()
+    
+    def invalidate_user(self, user_id: str) -> None:
+        """
+        Сброс скомпилированных разрешений пользователя.
+        
+        Args:
+            user_id: ID пользователя
+        """
+        with self._permissions_lock:
+            entry = self._user_permissions.pop(user_id, None)
+            if entry is None:
+                return
+            for role_id in entry[1]:
+                users = self._role_users.get(role_id)
+                if users is not None:
+                    users.discard(user_id)
+                    if not users:
+                        del self._role_users[role_id]
+    
+    def invalidate_role(self, role_id: str) -> None:
+        """
+        Сброс скомпилированных разрешений роли и ее пользователей.
+        
+        Args:
+            role_id: ID роли
+        """
+        with self._permissions_lock:
+            self._role_permissions.pop(role_id, None)
+            for user_id in list(self._role_users.get(role_id, ())):
+                self.invalidate_user(user_id)
+    
+    def _log_audit(self, sampled: bool = False, **kwargs) -> None:
+        """Запись аудита через фоновую очередь (или синхронно)."""
+        if self.audit_writer is not None:
+            self.audit_writer.log(sampled=sampled, **kwargs)
+        else:
+            self.storage.log_audit(**kwargs)
+    
+    def flush_audit(self) -> None:
+        """Ожидание записи накопленного аудита."""
+        if self.audit_writer is not None:
+            self.audit_writer.flush()
+    
+    def close(self) -> None:
+        """Запись оставшегося аудита и отписка от хранилища."""
+        self.storage.unsubscribe(self._on_storage_change)
+        if self.audit_writer is None:
+            return
+        if self._owns_audit_writer:
+            self.audit_writer.close()
+        else:
+            # Общий писатель продолжает работать для других сервисов
+            self.audit_writer.flush()
+    
+    def _find_granting_role(self, role_ids: Tuple[str, ...], bit: int) -> Optional[str]:
+        """Имя первой роли пользователя, дающей разрешение."""
+        for role_id in role_ids:
+            mask, name = self._get_role_entry(role_id)
+            if mask & bit:
+                return name
+        return None
     
     def check_permission(
         self,
@@ -527,10 +1366,10 @@ class RBACService:
         Returns:
             True если доступ разрешен
         """
-        user = self.storage.get_user(user_id)
-        if not user or not user.is_active:
+        entry = self._get_user_entry(user_id)
+        if entry is None or entry[0] is None:
             if log_audit:
-                self.storage.log_audit(
+                self._log_audit(
                     user_id=user_id,
                     action=f"permission_denied:user_not_found",
                     resource_type=resource,
@@ -543,28 +1382,28 @@ class RBACService:
                 )
             return False
         
-        # Проверяем разрешения для каждой роли пользователя
-        for role_id in user.role_ids:
-            role = self.storage.get_role(role_id)
-            if role and role.has_permission(resource, permission):
-                if log_audit:
-                    self.storage.log_audit(
-                        user_id=user_id,
-                        action=f"permission_granted:{permission.value}",
-                        resource_type=resource,
-                        resource_id=audit_context.get('resource_id') if audit_context else None,
-                        details={
-                            'permission': permission.value,
-                            'resource': resource.value,
-                            'role': role.name,
-                            'context': audit_context
-                        }
-                    )
-                return True
+        mask, role_ids = entry
+        bit = _PERMISSION_BITS[(resource, permission)]
+        if mask & bit:
+            if log_audit:
+                self._log_audit(
+                    sampled=True,
+                    user_id=user_id,
+                    action=f"permission_granted:{permission.value}",
+                    resource_type=resource,
+                    resource_id=audit_context.get('resource_id') if audit_context else None,
+                    details={
+                        'permission': permission.value,
+                        'resource': resource.value,
+                        'role': self._find_granting_role(role_ids, bit),
+                        'context': audit_context
+                    }
+                )
+            return True
         
         # Доступ запрещен
         if log_audit:
-            self.storage.log_audit(
+            self._log_audit(
                 user_id=user_id,
                 action=f"permission_denied:{permission.value}",
                 resource_type=resource,
@@ -572,7 +1411,7 @@ class RBACService:
                 details={
                     'permission': permission.value,
                     'resource': resource.value,
-                    'user_roles': user.role_ids,
+                    'user_roles': list(role_ids),
                     'context': audit_context
                 }
             )
@@ -583,7 +1422,8 @@ class RBACService:
         self,
         name: str,
         description: str,
-        permissions: Dict[ResourceType, Set[Permission]]
+        permissions: Dict[ResourceType, Set[Permission]],
+        parent_ids: Optional[List[str]] = None
     ) -> Optional[Role]:
         """
         Создание новой роли.
@@ -592,7 +1432,8 @@ class RBACService:
             name: Имя роли
             description: Описание
             permissions: Разрешения
-            
+            parent_ids: Родительские роли
+        
         Returns:
             Созданная роль или None
         """
@@ -608,13 +1449,14 @@ class RBACService:
             id=role_id,
             name=name,
             description=description,
-            permissions=permissions
+            permissions=permissions,
+            parent_ids=list(parent_ids or [])
         )
         
         success = self.storage.save_role(role)
         if success:
             logger.info(f"Role created: {name}")
-            return role
+            return self.storage.get_role(role_id) or role
         
         return None
     
@@ -644,7 +1486,7 @@ class RBACService:
             success = self.storage.save_user(user)
             
             if success:
-                self.storage.log_audit(
+                self._log_audit(
                     user_id=user_id,
                     action="role_assigned",
                     details={
@@ -685,7 +1527,7 @@ class RBACService:
                 success = self.storage.save_user(user)
                 
                 if success:
-                    self.storage.log_audit(
+                    self._log_audit(
                         user_id=user_id,
                         action="role_revoked",
                         details={
@@ -727,7 +1569,7 @@ class RBACService:
         success = self.storage.save_role(role)
         
         if success:
-            self.storage.log_audit(
+            self._log_audit(
                 user_id=None,  # Системное действие
                 action="role_permissions_updated",
                 details={
@@ -743,6 +1585,47 @@ class RBACService:
         
         return success
     
+    def set_role_parents(self, role_id: str, parent_ids: List[str]) -> bool:
+        """
+        Изменение родительских ролей.
+        
+        Args:
+            role_id: ID роли
+            parent_ids: Новые родительские роли
+        
+        Returns:
+            True если успешно (False для неизвестных родителей и циклов)
+        """
+        role = self.storage.get_role(role_id)
+        if not role:
+            logger.error(f"Role not found: {role_id}")
+            return False
+        
+        if role.is_system:
+            logger.warning(f"Cannot modify system role: {role_id}")
+            return False
+        
+        old_parent_ids = role.parent_ids
+        role.parent_ids = list(parent_ids)
+        success = self.storage.save_role(role)
+        
+        if success:
+            self._log_audit(
+                user_id=None,  # Системное действие
+                action="role_parents_updated",
+                details={
+                    'role_id': role_id,
+                    'role_name': role.name,
+                    'old_parent_ids': old_parent_ids,
+                    'new_parent_ids': role.parent_ids
+                }
+            )
+            logger.info(f"Role parents updated: {role_id}")
+        else:
+            role.parent_ids = old_parent_ids
+        
+        return success
+    
     def get_user_permissions(self, user_id: str) -> Dict[ResourceType, Set[Permission]]:
         """
         Получение всех разрешений пользователя.
@@ -753,21 +1636,11 @@ class RBACService:
         Returns:
             Словарь разрешений по типам ресурсов
         """
-        user = self.storage.get_user(user_id)
-        if not user or not user.is_active:
+        entry = self._get_user_entry(user_id)
+        if entry is None or entry[0] is None:
             return {}
         
-        all_permissions: Dict[ResourceType, Set[Permission]] = {}
-        
-        for role_id in user.role_ids:
-            role = self.storage.get_role(role_id)
-            if role:
-                for resource, permissions in role.permissions.items():
-                    if resource not in all_permissions:
-                        all_permissions[resource] = set()
-                    all_permissions[resource].update(permissions)
-        
-        return all_permissions
+        return mask_to_permissions(entry[0])
     
     def can_user_access_resource(
         self,
@@ -799,7 +1672,7 @@ class RBACService:
         )
         
         if not has_permission:
-            self.storage.log_audit(
+            self._log_audit(
                 user_id=user_id,
                 action=f"resource_access_denied:{action.value}",
                 resource_type=resource_type,
@@ -815,8 +1688,9 @@ class RBACService:
         # Проверяем владение ресурсом (если пользователь владелец, у него могут быть дополнительные права)
         if resource_owner_id and user_id == resource_owner_id:
             # Владелец всегда может просматривать и редактировать свой ресурс
-            if action in [Permission.VIEW, Permission.EDIT]:
-                self.storage.log_audit(
+            if action in self.OWNER_PERMISSIONS:
+                self._log_audit(
+                    sampled=True,
                     user_id=user_id,
                     action=f"resource_access_granted:owner_{action.value}",
                     resource_type=resource_type,
@@ -842,6 +1716,86 @@ class RBACService:
             log_audit=True,
             audit_context=audit_context
         )
+    
+    def filter_accessible(
+        self,
+        user_id: str,
+        resource_type: ResourceType,
+        resource_ids: Iterable[str],
+        permission: Permission,
+        resource_owners: Optional[Dict[str, Optional[str]]] = None,
+        owner_lookup: Optional[Callable[[List[str]], Dict[str, Optional[str]]]] = None,
+        log_audit: bool = True
+    ) -> List[str]:
+        """
+        Пакетная проверка доступа для списков ресурсов.
+        
+        Разрешения пользователя разрешаются один раз, правила доступа
+        (как в can_user_access_resource) применяются ко всей пачке за один
+        проход, аудит пишется одним событием на пачку.
+        
+        Args:
+            user_id: ID пользователя
+            resource_type: Тип ресурса
+            resource_ids: ID ресурсов
+            permission: Действие
+            resource_owners: Владельцы ресурсов (resource_id -> owner_id)
+            owner_lookup: Загрузка владельцев одним запросом для всей пачки;
+                владение на решение не влияет и отмечается только в аудите,
+                поэтому функция вызывается лишь при log_audit
+            log_audit: Логировать результат (списки owned/denied в записи
+                ограничены AUDIT_ID_LIMIT)
+        
+        Returns:
+            Доступные ID ресурсов в исходном порядке (без повторов)
+        """
+        resource_ids = list(dict.fromkeys(resource_ids))
+        if not resource_ids:
+            return []
+        
+        entry = self._get_user_entry(user_id)
+        mask = entry[0] if entry is not None else None
+        has_permission = mask is not None and bool(mask & _PERMISSION_BITS[(resource_type, permission)])
+        
+        allowed = resource_ids if has_permission else []
+        
+        if log_audit:
+            owned: List[str] = []
+            if has_permission and permission in self.OWNER_PERMISSIONS:
+                if resource_owners is None and owner_lookup is not None:
+                    try:
+                        resource_owners = owner_lookup(resource_ids)
+                    except Exception as e:
+                        logger.error(f"Error loading resource owners: {e}")
+                resource_owners = resource_owners or {}
+                owned = [
+                    resource_id for resource_id in resource_ids
+                    if resource_owners.get(resource_id) == user_id
+                ]
+            
+            denied = [] if has_permission else resource_ids
+            details: Dict[str, Any] = {
+                'action': permission.value,
+                'requested': len(resource_ids),
+                'allowed': len(allowed),
+                'owned_count': len(owned),
+                'owned': owned[:self.AUDIT_ID_LIMIT],
+                'denied': denied[:self.AUDIT_ID_LIMIT]
+            }
+            if mask is None:
+                details['reason'] = 'user_not_found_or_inactive'
+            elif not has_permission:
+                details['reason'] = 'no_permission'
+            
+            self._log_audit(
+                sampled=not denied,
+                user_id=user_id,
+                action=f"resource_access_filtered:{permission.value}",
+                resource_type=resource_type,
+                details=details
+            )
+        
+        return allowed
 
 
 class PermissionDecorator:
@@ -910,4 +1864,58 @@ class PermissionDecorator:
             
             return wrapper
         
-        return decorator
\ No newline at end of file
+        return decorator
+
+
+def benchmark_audit(
+    storage: RBACStorage,
+    user_id: str,
+    resource: ResourceType = ResourceType.ARTICLE,
+    permission: Permission = Permission.VIEW,
+    iterations: int = 2000,
+    granted_sample_rate: float = 1.0
+) -> Dict[str, float]:
+    """
+    Сравнение пропускной способности check_permission с синхронной и
+    фоновой записью аудита.
+    
+    Args:
+        storage: Хранилище RBAC
+        user_id: ID пользователя для проверок
+        resource: Тип ресурса
+        permission: Проверяемое разрешение
+        iterations: Количество проверок в каждом режиме
+        granted_sample_rate: Доля записываемых успешных проверок в фоновом режиме
+    
+    Returns:
+        Проверок в секунду для каждого режима и ускорение
+    """
+    results = {}
+    
+    modes = (
+        ('sync', lambda: RBACService(storage, async_audit=False)),
+        ('async', lambda: RBACService(
+            storage,
+            audit_writer=AuditWriter(storage, granted_sample_rate=granted_sample_rate)
+        ))
+    )
+    for mode, create_service in modes:
+        service = create_service()
+        try:
+            # Прогрев кеша разрешений
+            service.check_permission(user_id, resource, permission, log_audit=False)
+            
+            start = time.perf_counter()
+            for _ in range(iterations):
+                service.check_permission(user_id, resource, permission)
+            elapsed = time.perf_counter() - start
+        finally:
+            service.close()
+        
+        results[f'{mode}_checks_per_sec'] = iterations / elapsed if elapsed > 0 else 0.0
+    
+    results['speedup'] = (
+        results['async_checks_per_sec'] / results['sync_checks_per_sec']
+        if results['sync_checks_per_sec'] else 0.0
+    )
+    return results
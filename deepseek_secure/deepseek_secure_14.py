@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional, Any, Union
+from typing import Dict, List, Optional, Any, Set, Tuple
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from enum import Enum
@@ -6,11 +6,17 @@ import sqlite3
 from contextlib import contextmanager
 import logging
 import json
+import math
+import os
 import threading
 import time
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import groupby, repeat
 import hashlib
-import asyncio
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -132,11 +138,974 @@ class EventValidator:
         return len(errors) == 0, errors
 
 
+# Начало отсчета временных меток в колонках (микросекунды, наивное локальное время)
+_EPOCH = datetime(1970, 1, 1)
+_HOUR_US = 3600 * 10 ** 6
+
+
+def _naive(value: datetime) -> datetime:
+    """Приведение времени с часовым поясом к наивному локальному."""
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def _to_micros(value: datetime) -> int:
+    """Время в микросекундах от _EPOCH."""
+    return (_naive(value) - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(value: int) -> datetime:
+    """Время из микросекунд от _EPOCH."""
+    return _EPOCH + timedelta(microseconds=value)
+
+
+def _bitmap(codes) -> int:
+    """Битовое множество кодов словаря (код 0 — нет значения — не входит)."""
+    codes = set(codes)
+    codes.discard(0)
+    if not codes:
+        return 0
+    
+    low = min(codes)
+    bits = bytearray(((max(codes) - low) >> 3) + 1)
+    for code in codes:
+        code -= low
+        bits[code >> 3] |= 1 << (code & 7)
+    return int.from_bytes(bits, 'little') << low
+
+
+def _pack_bitmap(bitmap: int) -> Tuple[int, bytes]:
+    """Сжатое представление битового множества: (смещение, данные)."""
+    if not bitmap:
+        return 0, b''
+    offset = (bitmap & -bitmap).bit_length() - 1
+    bitmap >>= offset
+    return offset, zlib.compress(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'), 1)
+
+
+def _unpack_bitmap(offset: int, data: bytes) -> int:
+    if not data:
+        return 0
+    return int.from_bytes(zlib.decompress(data), 'little') << offset
+
+
+# Формат периода (как в SQL-группировке) и шаг, которым периоды разбиваются
+_PERIOD_FORMATS: Dict[str, Tuple[str, timedelta]] = {
+    'hour': ('%Y-%m-%d %H:00:00', timedelta(hours=1)),
+    'day': ('%Y-%m-%d', timedelta(days=1)),
+    'week': ('%Y-W%W', timedelta(days=1)),
+    'month': ('%Y-%m', timedelta(days=1))
+}
+
+
+class HyperLogLog:
+    """
+    HyperLogLog: оценка числа уникальных значений.
+    
+    2^precision однобайтовых регистров, стандартная ошибка
+    ~1.04 / sqrt(2^precision) (1.6% при precision=12). Скетчи одной
+    точности объединяются поэлементным максимумом без потери точности,
+    поэтому уникальные за день/неделю/месяц получаются из часовых скетчей.
+    """
+    
+    DEFAULT_PRECISION = 12
+    
+    def __init__(self, precision: int = DEFAULT_PRECISION, registers: Optional[bytearray] = None):
+        """
+        Инициализация.
+        
+        Args:
+            precision: Число бит хеша для номера регистра (4..16)
+            registers: Готовые регистры (при загрузке)
+        """
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.size)
+        # Гистограмма значений регистров для count(): строится при первой
+        # оценке и дальше поддерживается в add_hash
+        self._histogram: Optional[List[int]] = None
+    
+    @staticmethod
+    def hash_value(value: str) -> int:
+        """64-битный хеш значения."""
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+    
+    def add(self, value: str) -> None:
+        """Добавление значения."""
+        self.add_hash(self.hash_value(value))
+    
+    def add_hash(self, hashed: int) -> None:
+        """Добавление значения по готовому хешу (hash_value)."""
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        previous = self.registers[index]
+        if rank > previous:
+            self.registers[index] = rank
+            if self._histogram is not None:
+                self._histogram[previous] -= 1
+                self._histogram[rank] += 1
+    
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        """Объединение с другим скетчем (на месте)."""
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HyperLogLog sketches: precision {self.precision} != {other.precision}")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        self._histogram = None
+        return self
+    
+    @staticmethod
+    def _sigma(x: float) -> float:
+        if x == 1.0:
+            return math.inf
+        power, total = 1.0, x
+        while True:
+            x *= x
+            previous = total
+            total += x * power
+            power += power
+            if total == previous:
+                return total
+    
+    @staticmethod
+    def _tau(x: float) -> float:
+        if x == 0.0 or x == 1.0:
+            return 0.0
+        power, total = 1.0, 1.0 - x
+        while True:
+            x = math.sqrt(x)
+            previous = total
+            power *= 0.5
+            total -= (1.0 - x) ** 2 * power
+            if total == previous:
+                return total / 3.0
+    
+    def count(self) -> int:
+        """
+        Оценка числа уникальных значений.
+        
+        Улучшенная оценка Эртла по гистограмме регистров: без смещения во
+        всем диапазоне, без таблиц поправок и переключения на linear counting.
+        """
+        size = self.size
+        max_rank = 64 - self.precision + 1
+        histogram = self._histogram
+        if histogram is None:
+            registers = self.registers
+            histogram = self._histogram = [registers.count(rank) for rank in range(max_rank + 1)]
+        
+        total = size * self._tau(1.0 - histogram[max_rank] / size)
+        for rank in range(max_rank - 1, 0, -1):
+            total = (total + histogram[rank]) * 0.5
+        total += size * self._sigma(histogram[0] / size)
+        
+        return int(round(size * size / (2 * math.log(2) * total)))
+    
+    def to_bytes(self) -> bytes:
+        """Сериализация (сжатые регистры)."""
+        return zlib.compress(bytes([self.precision]) + bytes(self.registers))
+    
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        """Десериализация."""
+        raw = zlib.decompress(data)
+        return cls(raw[0], bytearray(raw[1:]))
+
+
+@dataclass
+class Rollup:
+    """Агрегат бакета (тип события, час/день)."""
+    count: int = 0
+    unique_users: int = 0
+    value_sum: float = 0.0
+    sketch: HyperLogLog = field(default_factory=HyperLogLog)
+
+
+@dataclass
+class EventSegment:
+    """Колоночный сегмент дневной партиции, отсортированный по (тип, время)."""
+    id: int
+    day: str
+    row_count: int
+    min_ts: int
+    max_ts: int
+    # Код типа события -> (начало, конец) диапазона строк
+    type_ranges: Dict[int, Tuple[int, int]]
+    # Код типа -> часы [(начало часа, начало, конец, уникальных пользователей, сессий)]
+    type_hours: Dict[int, List[Tuple[int, int, int, int, int]]] = field(default_factory=dict)
+    timestamps: Optional[array] = None  # 'q': микросекунды от _EPOCH
+    users: Optional[array] = None  # 'I': коды словаря, 0 — нет значения
+    sessions: Optional[array] = None  # 'I'
+    # Код типа -> (битовое множество пользователей, битовое множество сессий)
+    bitmaps: Dict[int, Tuple[int, int]] = field(default_factory=dict)
+
+
+class EventPartitionStore:
+    """
+    Колоночное хранилище событий с дневными партициями.
+    
+    Партиция дня состоит из неизменяемых сегментов: каждый сброс буфера
+    добавляет сегмент, строки которого отсортированы по (тип события,
+    время). Колонки хранятся типизированными массивами (array), а
+    event_type, user_id и session_id — кодами общего словаря. По
+    метаданным сегмента (min/max времени, диапазоны строк типов) сегменты
+    отбрасываются без чтения колонок, а границы периодов находятся
+    бинарным поиском.
+    
+    Для уникальных значений сегмент хранит по каждому типу битовые
+    множества пользователей и сессий за день (объединение — побитовое
+    ИЛИ) и количество уникальных значений по часам. Сегменты одного
+    порядка размера сливаются, а прошедшие дни — в один сегмент.
+    """
+    
+    COMPACTION_FANOUT = 8
+    BACKFILL_CHUNK = 50000
+    # Сколько кодов словаря держать в памяти (по каждому виду)
+    DICTIONARY_CACHE_SIZE = 1000000
+    
+    def __init__(self, storage: 'EventStorage', cache_size: int = 256):
+        """
+        Инициализация.
+        
+        Args:
+            storage: Хранилище событий (соединения с БД)
+            cache_size: Количество декодированных сегментов в памяти
+        """
+        self.storage = storage
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self._codes: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self._segment_cache: 'OrderedDict[int, EventSegment]' = OrderedDict()
+    
+    @staticmethod
+    def init_schema(cursor: sqlite3.Cursor) -> None:
+        """Создание таблиц партиций."""
+        # Словарь кодов: event_type, user, session
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS event_dictionary (
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                code INTEGER NOT NULL,
+                PRIMARY KEY (kind, value)
+            ) WITHOUT ROWID
+        """)
+        # Код однозначно задает значение: при гонке писателей вставка
+        # повторного кода откатит транзакцию, а не испортит данные
+        try:
+            cursor.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_event_dictionary_code ON event_dictionary(kind, code)"
+            )
+        except sqlite3.IntegrityError as e:
+            logger.error(f"Event dictionary has duplicate codes, unique index not created: {e}")
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS event_segments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                day TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                min_ts INTEGER NOT NULL,
+                max_ts INTEGER NOT NULL,
+                type_index TEXT NOT NULL,  -- JSON {код: {range, hours}}
+                timestamps BLOB NOT NULL,
+                users BLOB NOT NULL,
+                sessions BLOB NOT NULL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_event_segments_day ON event_segments(day, min_ts, max_ts)")
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS event_segment_bitmaps (
+                segment_id INTEGER NOT NULL,
+                type_code INTEGER NOT NULL,
+                users_offset INTEGER NOT NULL,
+                users BLOB NOT NULL,
+                sessions_offset INTEGER NOT NULL,
+                sessions BLOB NOT NULL,
+                PRIMARY KEY (segment_id, type_code)
+            )
+        """)
+    
+    def _lookup_codes(self, cursor: sqlite3.Cursor, kind: str, values: List[str]) -> Dict[str, int]:
+        """Чтение кодов значений из словаря (найденные значения)."""
+        found: Dict[str, int] = {}
+        for start in range(0, len(values), 500):
+            chunk = values[start:start + 500]
+            cursor.execute(
+                f"SELECT value, code FROM event_dictionary WHERE kind = ? AND value IN ({', '.join('?' * len(chunk))})",
+                [kind, *chunk]
+            )
+            for row in cursor.fetchall():
+                found[row['value']] = row['code']
+        return found
+    
+    def _cache_codes(self, kind: str, found: Dict[str, int]) -> None:
+        """Добавление кодов в кеш; переполненный кеш сбрасывается целиком."""
+        codes = self._codes[kind]
+        if len(codes) + len(found) > self.DICTIONARY_CACHE_SIZE:
+            codes.clear()
+        codes.update(found)
+    
+    def _encode_values(self, cursor: sqlite3.Cursor, kind: str, values: Set[Optional[str]]) -> Dict[Optional[str], int]:
+        """
+        Коды значений; новые значения добавляются в словарь.
+        
+        Коды новых значений выделяются от MAX(code), прочитанного в той же
+        транзакции записи, поэтому писатели из разных процессов не выдают
+        один код разным значениям.
+        
+        Args:
+            cursor: Курсор открытой транзакции записи (BEGIN IMMEDIATE)
+            kind: Вид значений ('event_type', 'user', 'session')
+            values: Значения
+        
+        Returns:
+            Значение -> код (None -> 0)
+        """
+        codes = self._codes[kind]
+        result: Dict[Optional[str], int] = {}
+        missing = []
+        for value in values:
+            if value is None:
+                continue
+            code = codes.get(value)
+            if code is None:
+                missing.append(value)
+            else:
+                result[value] = code
+        
+        if missing:
+            found = self._lookup_codes(cursor, kind, missing)
+            new_values = [value for value in missing if value not in found]
+            if new_values:
+                cursor.execute("SELECT MAX(code) AS code FROM event_dictionary WHERE kind = ?", (kind,))
+                next_code = (cursor.fetchone()['code'] or 0) + 1
+                rows = [(kind, value, next_code + offset) for offset, value in enumerate(new_values)]
+                cursor.executemany("INSERT INTO event_dictionary (kind, value, code) VALUES (?, ?, ?)", rows)
+                found.update((value, code) for _, value, code in rows)
+            
+            # Кеш пополняется после того, как результат собран: сброс
+            # переполненного кеша не теряет уже найденные коды
+            result.update(found)
+            self._cache_codes(kind, found)
+        
+        result[None] = 0
+        return result
+    
+    def get_code(self, kind: str, value: str) -> int:
+        """Код значения в словаре (0 если значение не встречалось)."""
+        with self._lock:
+            code = self._codes[kind].get(value)
+            if code is None:
+                with self.storage._get_connection() as conn:
+                    found = self._lookup_codes(conn.cursor(), kind, [value])
+                self._cache_codes(kind, found)
+                code = found.get(value, 0)
+            return code
+    
+    def reset(self) -> None:
+        """Сброс кеша словаря (после отката транзакции)."""
+        with self._lock:
+            self._codes.clear()
+    
+    def append(self, cursor: sqlite3.Cursor, events: List[Event]) -> None:
+        """
+        Добавление событий в партиции в транзакции вызывающего.
+        
+        Args:
+            cursor: Курсор открытой транзакции
+            events: События
+        """
+        self._append_records(cursor, (
+            (event.event_type.value, event.timestamp, event.user_id, event.session_id)
+            for event in events
+        ))
+    
+    def _append_records(self, cursor: sqlite3.Cursor, records) -> None:
+        records = list(records)
+        with self._lock:
+            type_codes = self._encode_values(cursor, 'event_type', {record[0] for record in records})
+            user_codes = self._encode_values(cursor, 'user', {record[2] for record in records})
+            session_codes = self._encode_values(cursor, 'session', {record[3] for record in records})
+            
+            by_day: Dict[str, List[Tuple[int, int, int, int]]] = defaultdict(list)
+            for event_type, timestamp, user_id, session_id in records:
+                timestamp = _naive(timestamp)
+                by_day[timestamp.strftime('%Y-%m-%d')].append((
+                    type_codes[event_type],
+                    (timestamp - _EPOCH) // timedelta(microseconds=1),
+                    user_codes[user_id],
+                    session_codes[session_id]
+                ))
+            
+            if not by_day:
+                return
+            
+            for day, rows in by_day.items():
+                rows.sort()
+                self._write_segment(cursor, day, rows)
+                self._compact_day(cursor, day)
+            
+            # Прошедшие дни (в том числе дописанные опоздавшими событиями)
+            # сливаются в один сегмент
+            cursor.execute(
+                "SELECT day FROM event_segments WHERE day < ? GROUP BY day HAVING COUNT(*) > 1",
+                (max(by_day),)
+            )
+            for row in cursor.fetchall():
+                cursor.execute("SELECT id FROM event_segments WHERE day = ?", (row['day'],))
+                self._merge_segments(cursor, row['day'], [r['id'] for r in cursor.fetchall()])
+    
+    def _write_segment(self, cursor: sqlite3.Cursor, day: str, rows: List[Tuple[int, int, int, int]]) -> None:
+        """Запись отсортированных строк (тип, время, пользователь, сессия) сегментом."""
+        timestamps = array('q', [row[1] for row in rows])
+        users = array('I', [row[2] for row in rows])
+        sessions = array('I', [row[3] for row in rows])
+        
+        type_index = {}
+        bitmap_rows = []
+        start = 0
+        for type_code, group in groupby(rows, key=lambda row: row[0]):
+            end = start + sum(1 for _ in group)
+            
+            hours = []
+            index = start
+            while index < end:
+                bucket = timestamps[index] - timestamps[index] % _HOUR_US
+                next_index = bisect_left(timestamps, bucket + _HOUR_US, index, end)
+                hour_users = set(users[index:next_index])
+                hour_users.discard(0)
+                hour_sessions = set(sessions[index:next_index])
+                hour_sessions.discard(0)
+                hours.append([bucket, index, next_index, len(hour_users), len(hour_sessions)])
+                index = next_index
+            
+            type_index[type_code] = {'range': [start, end], 'hours': hours}
+            bitmap_rows.append((
+                type_code,
+                *_pack_bitmap(_bitmap(users[start:end])),
+                *_pack_bitmap(_bitmap(sessions[start:end]))
+            ))
+            start = end
+        
+        cursor.execute("""
+            INSERT INTO event_segments
+            (day, row_count, min_ts, max_ts, type_index, timestamps, users, sessions)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            day,
+            len(rows),
+            min(timestamps),
+            max(timestamps),
+            json.dumps(type_index),
+            timestamps.tobytes(),
+            users.tobytes(),
+            sessions.tobytes()
+        ))
+        segment_id = cursor.lastrowid
+        
+        cursor.executemany("""
+            INSERT INTO event_segment_bitmaps
+            (segment_id, type_code, users_offset, users, sessions_offset, sessions)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(segment_id, *bitmap_row) for bitmap_row in bitmap_rows])
+    
+    def _tier(self, row_count: int) -> int:
+        """Порядок размера сегмента по основанию COMPACTION_FANOUT."""
+        tier = 0
+        while row_count >= self.COMPACTION_FANOUT:
+            row_count //= self.COMPACTION_FANOUT
+            tier += 1
+        return tier
+    
+    def _compact_day(self, cursor: sqlite3.Cursor, day: str) -> None:
+        """Слияние COMPACTION_FANOUT и более сегментов дня одного порядка размера."""
+        while True:
+            cursor.execute("SELECT id, row_count FROM event_segments WHERE day = ?", (day,))
+            tiers: Dict[int, List[int]] = defaultdict(list)
+            for row in cursor.fetchall():
+                tiers[self._tier(row['row_count'])].append(row['id'])
+            
+            segment_ids = next(
+                (ids for _, ids in sorted(tiers.items()) if len(ids) >= self.COMPACTION_FANOUT),
+                None
+            )
+            if segment_ids is None:
+                return
+            self._merge_segments(cursor, day, segment_ids)
+    
+    def _merge_segments(self, cursor: sqlite3.Cursor, day: str, segment_ids: List[int]) -> None:
+        """Замена сегментов дня одним."""
+        # Каждый сегмент — отсортированная серия, сортировка их склейки
+        # сводится к слиянию серий
+        rows = []
+        for segment in self._read_segments(cursor, segment_ids):
+            for type_code, (start, end) in segment.type_ranges.items():
+                rows.extend(zip(
+                    repeat(type_code, end - start),
+                    segment.timestamps[start:end],
+                    segment.users[start:end],
+                    segment.sessions[start:end]
+                ))
+        rows.sort()
+        
+        params = [(segment_id,) for segment_id in segment_ids]
+        cursor.executemany("DELETE FROM event_segments WHERE id = ?", params)
+        cursor.executemany("DELETE FROM event_segment_bitmaps WHERE segment_id = ?", params)
+        for segment_id in segment_ids:
+            self._segment_cache.pop(segment_id, None)
+        self._write_segment(cursor, day, rows)
+    
+    @staticmethod
+    def _segment_from_row(row: sqlite3.Row) -> EventSegment:
+        type_index = json.loads(row['type_index'])
+        segment = EventSegment(
+            id=row['id'],
+            day=row['day'],
+            row_count=row['row_count'],
+            min_ts=row['min_ts'],
+            max_ts=row['max_ts'],
+            type_ranges={int(code): tuple(entry['range']) for code, entry in type_index.items()},
+            type_hours={
+                int(code): [tuple(hour) for hour in entry['hours']]
+                for code, entry in type_index.items()
+            }
+        )
+        if 'timestamps' in row.keys():
+            segment.timestamps = array('q')
+            segment.timestamps.frombytes(row['timestamps'])
+            segment.users = array('I')
+            segment.users.frombytes(row['users'])
+            segment.sessions = array('I')
+            segment.sessions.frombytes(row['sessions'])
+        return segment
+    
+    def _read_segments(
+        self,
+        cursor: sqlite3.Cursor,
+        segment_ids: List[int],
+        columns: bool = True
+    ) -> List[EventSegment]:
+        """Чтение сегментов с битовыми множествами (и колонками, если columns)."""
+        fields = "*" if columns else "id, day, row_count, min_ts, max_ts, type_index"
+        segments = {}
+        for start in range(0, len(segment_ids), 500):
+            chunk = segment_ids[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            
+            cursor.execute(f"SELECT {fields} FROM event_segments WHERE id IN ({placeholders})", chunk)
+            for row in cursor.fetchall():
+                segments[row['id']] = self._segment_from_row(row)
+            
+            cursor.execute(f"SELECT * FROM event_segment_bitmaps WHERE segment_id IN ({placeholders})", chunk)
+            for row in cursor.fetchall():
+                segment = segments.get(row['segment_id'])
+                if segment is not None:
+                    segment.bitmaps[row['type_code']] = (
+                        _unpack_bitmap(row['users_offset'], row['users']),
+                        _unpack_bitmap(row['sessions_offset'], row['sessions'])
+                    )
+        return [segments[segment_id] for segment_id in segment_ids if segment_id in segments]
+    
+    def _load_columns(self, segment: EventSegment) -> EventSegment:
+        """Догрузка колонок сегмента, прочитанного без них."""
+        if segment.timestamps is not None:
+            return segment
+        
+        with self.storage._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT timestamps, users, sessions FROM event_segments WHERE id = ?", (segment.id,))
+            row = cursor.fetchone()
+        
+        with self._lock:
+            if segment.timestamps is None and row is not None:
+                users = array('I')
+                users.frombytes(row['users'])
+                sessions = array('I')
+                sessions.frombytes(row['sessions'])
+                timestamps = array('q')
+                timestamps.frombytes(row['timestamps'])
+                segment.users, segment.sessions, segment.timestamps = users, sessions, timestamps
+        return segment
+    
+    def get_segments(self, start_ts: int, end_ts: int, type_code: Optional[int] = None) -> List[EventSegment]:
+        """
+        Сегменты, пересекающие интервал (с отсечением по метаданным).
+        
+        Args:
+            start_ts: Начало интервала (микросекунды)
+            end_ts: Конец интервала включительно (микросекунды)
+            type_code: Код типа события, который должен быть в сегменте
+        
+        Returns:
+            Сегменты с битовыми множествами; колонки догружаются
+            через _load_columns
+        """
+        start_day = _from_micros(start_ts).strftime('%Y-%m-%d')
+        end_day = _from_micros(end_ts).strftime('%Y-%m-%d')
+        
+        with self.storage._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, day, row_count, min_ts, max_ts, type_index
+                FROM event_segments
+                WHERE day >= ? AND day <= ? AND max_ts >= ? AND min_ts <= ?
+                ORDER BY id
+            """, (start_day, end_day, start_ts, end_ts))
+            metas = [self._segment_from_row(row) for row in cursor.fetchall()]
+            if type_code is not None:
+                metas = [meta for meta in metas if type_code in meta.type_ranges]
+            
+            segments: Dict[int, EventSegment] = {}
+            with self._lock:
+                for meta in metas:
+                    cached = self._segment_cache.get(meta.id)
+                    if cached is not None:
+                        self._segment_cache.move_to_end(meta.id)
+                        segments[meta.id] = cached
+            
+            missing = [meta.id for meta in metas if meta.id not in segments]
+            if missing:
+                loaded = self._read_segments(cursor, missing, columns=False)
+                with self._lock:
+                    for segment in loaded:
+                        segments[segment.id] = segment
+                        self._segment_cache[segment.id] = segment
+                    while len(self._segment_cache) > self.cache_size:
+                        self._segment_cache.popitem(last=False)
+        
+        return [segments[meta.id] for meta in metas if meta.id in segments]
+    
+    def aggregate_metrics(
+        self,
+        event_type: EventType,
+        start_date: datetime,
+        end_date: datetime,
+        group_by: str = 'day'
+    ) -> Dict[str, Any]:
+        """
+        Метрики события по периодам (формат AnalyticsService.get_event_metrics).
+        
+        Количество событий периода — разность двух бинарных поисков по
+        колонке времени. Уникальные пользователи и сессии периодов длиной
+        от дня — объединение битовых множеств сегментов; для часов берутся
+        сохраненные количества. Колонки читаются и срезы массивов
+        разбираются только для сегментов на границах запроса и в днях,
+        которые еще не слиты в один сегмент.
+        
+        Args:
+            event_type: Тип события
+            start_date: Начало периода
+            end_date: Конец периода (включительно)
+            group_by: Группировка ('hour', 'day', 'week', 'month')
+        
+        Returns:
+            Метрики
+        """
+        metrics = {
+            'total_events': 0,
+            'total_users': 0,
+            'total_sessions': 0,
+            'periods': []
+        }
+        
+        type_code = self.get_code('event_type', event_type.value)
+        if not type_code:
+            return metrics
+        
+        period_format, step = _PERIOD_FORMATS.get(group_by, _PERIOD_FORMATS['day'])
+        hourly = step == timedelta(hours=1)
+        start_ts = _to_micros(start_date)
+        end_ts = _to_micros(end_date)
+        
+        segments = self.get_segments(start_ts, end_ts, type_code)
+        segments_per_day = Counter(segment.day for segment in segments)
+        
+        # Период -> [количество, пользователи, сессии]: битовые множества
+        # для периодов от дня, множества или готовые количества для часов
+        periods: Dict[str, List[Any]] = {}
+        all_users = 0
+        all_sessions = 0
+        
+        for segment in segments:
+            begin, end = segment.type_ranges[type_code]
+            exact = segments_per_day[segment.day] == 1
+            if start_ts <= segment.min_ts and segment.max_ts <= end_ts:
+                low, high = begin, end
+            else:
+                self._load_columns(segment)
+                low = bisect_left(segment.timestamps, start_ts, begin, end)
+                high = bisect_right(segment.timestamps, end_ts, begin, end)
+                if low >= high:
+                    continue
+            
+            if low == begin and high == end:
+                users_bitmap, sessions_bitmap = segment.bitmaps[type_code]
+            else:
+                users_bitmap = _bitmap(segment.users[low:high])
+                sessions_bitmap = _bitmap(segment.sessions[low:high])
+            all_users |= users_bitmap
+            all_sessions |= sessions_bitmap
+            
+            if not hourly:
+                label = datetime.strptime(segment.day, '%Y-%m-%d').strftime(period_format)
+                period = periods.setdefault(label, [0, 0, 0])
+                period[0] += high - low
+                period[1] |= users_bitmap
+                period[2] |= sessions_bitmap
+                continue
+            
+            if not exact:
+                self._load_columns(segment)
+            for bucket, hour_start, hour_end, hour_users, hour_sessions in segment.type_hours[type_code]:
+                hour_start_clipped = max(hour_start, low)
+                hour_end_clipped = min(hour_end, high)
+                if hour_start_clipped >= hour_end_clipped:
+                    continue
+                
+                label = _from_micros(bucket).strftime(period_format)
+                if exact and hour_start_clipped == hour_start and hour_end_clipped == hour_end:
+                    periods[label] = [hour_end - hour_start, hour_users, hour_sessions]
+                    continue
+                
+                period = periods.setdefault(label, [0, set(), set()])
+                period[0] += hour_end_clipped - hour_start_clipped
+                period[1].update(segment.users[hour_start_clipped:hour_end_clipped])
+                period[2].update(segment.sessions[hour_start_clipped:hour_end_clipped])
+        
+        for label in sorted(periods):
+            count, users, sessions = periods[label]
+            if isinstance(users, set):
+                users.discard(0)
+                sessions.discard(0)
+                unique_users, unique_sessions = len(users), len(sessions)
+            elif hourly:
+                unique_users, unique_sessions = users, sessions
+            else:
+                unique_users, unique_sessions = users.bit_count(), sessions.bit_count()
+            
+            metrics['periods'].append({
+                'period': label,
+                'event_count': count,
+                'unique_users': unique_users,
+                'unique_sessions': unique_sessions
+            })
+            metrics['total_events'] += count
+        
+        metrics['total_users'] = all_users.bit_count()
+        metrics['total_sessions'] = all_sessions.bit_count()
+        return metrics
+    
+    def backfill(self, conn: sqlite3.Connection) -> int:
+        """
+        Построение партиций по строкам таблицы events (миграция).
+        
+        Args:
+            conn: Соединение (изменения фиксируются по частям)
+        
+        Returns:
+            Количество обработанных событий
+        """
+        cursor = conn.cursor()
+        last_rowid = 0
+        total = 0
+        
+        while True:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                SELECT rowid, event_type, user_id, session_id, timestamp
+                FROM events WHERE rowid > ? ORDER BY rowid LIMIT ?
+            """, (last_rowid, self.BACKFILL_CHUNK))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.commit()
+                break
+            
+            self._append_records(cursor, (
+                (row['event_type'], datetime.fromisoformat(row['timestamp']), row['user_id'], row['session_id'])
+                for row in rows
+            ))
+            conn.commit()
+            
+            last_rowid = rows[-1]['rowid']
+            total += len(rows)
+        
+        return total
+
+
+class RollupStore:
+    """
+    Материализованные часовые и дневные агрегаты событий.
+    
+    При сбросе буфера агрегаты затронутых бакетов (тип события, час/день)
+    обновляются в памяти — количество, сумма числового
+    properties['value'] и HLL-скетч пользователей — и записываются в
+    event_aggregations и event_sketches в той же транзакции, что и сами
+    события. Бакет читается заново внутри транзакции записи (BEGIN
+    IMMEDIATE), поэтому сбросы из других процессов не теряются. Пересчет
+    по сырым событиям (EventAggregator) нужен только для восстановления.
+    """
+    
+    GRANULARITIES = ('hourly', 'daily')
+    VALUE_PROPERTY = 'value'
+    
+    def __init__(self, storage: 'EventStorage'):
+        """
+        Инициализация.
+        
+        Args:
+            storage: Хранилище событий
+        """
+        self.storage = storage
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def bucket_start(granularity: str, timestamp: datetime) -> datetime:
+        """Начало бакета для времени события."""
+        timestamp = _naive(timestamp).replace(minute=0, second=0, microsecond=0)
+        if granularity == 'daily':
+            timestamp = timestamp.replace(hour=0)
+        return timestamp
+    
+    @classmethod
+    def event_value(cls, event: Event) -> Optional[float]:
+        """Числовое значение события для sum_value/avg_value."""
+        value = event.properties.get(cls.VALUE_PROPERTY) if event.properties else None
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        return None
+    
+    def _read_bucket(self, cursor: sqlite3.Cursor, key: Tuple[str, datetime, str]) -> Rollup:
+        """Текущий агрегат бакета из БД (пустой, если бакета нет)."""
+        granularity, period_start, event_type = key
+        rollup = Rollup()
+        
+        cursor.execute("""
+            SELECT count, unique_users, sum_value
+            FROM event_aggregations
+            WHERE aggregation_type = ? AND period_start = ? AND event_type = ?
+            AND dimension_key = 'all' AND dimension_value = 'all'
+        """, (granularity, period_start, event_type))
+        row = cursor.fetchone()
+        if row is not None:
+            rollup.count, rollup.unique_users, rollup.value_sum = row[0], row[1], row[2] or 0.0
+        
+        cursor.execute("""
+            SELECT sketch FROM event_sketches
+            WHERE granularity = ? AND period_start = ? AND event_type = ?
+        """, (granularity, period_start, event_type))
+        row = cursor.fetchone()
+        if row is not None:
+            rollup.sketch = HyperLogLog.from_bytes(row[0])
+        return rollup
+    
+    def apply(self, cursor: sqlite3.Cursor, events: List[Event]) -> None:
+        """
+        Обновление агрегатов событиями в транзакции вызывающего.
+        
+        Args:
+            cursor: Курсор транзакции записи (BEGIN IMMEDIATE): агрегаты
+                читаются и перезаписываются без вмешательства других писателей
+            events: События
+        """
+        with self._lock:
+            touched: Dict[Tuple[str, datetime, str], Rollup] = {}
+            
+            for event in events:
+                value = self.event_value(event)
+                hashed = HyperLogLog.hash_value(event.user_id) if event.user_id is not None else None
+                
+                for granularity in self.GRANULARITIES:
+                    key = (granularity, self.bucket_start(granularity, event.timestamp), event.event_type.value)
+                    rollup = touched.get(key)
+                    if rollup is None:
+                        rollup = touched[key] = self._read_bucket(cursor, key)
+                    
+                    rollup.count += 1
+                    if value is not None:
+                        rollup.value_sum += value
+                    if hashed is not None:
+                        rollup.sketch.add_hash(hashed)
+            
+            for rollup in touched.values():
+                rollup.unique_users = rollup.sketch.count()
+            
+            self.write(cursor, touched)
+    
+    def write(self, cursor: sqlite3.Cursor, rollups: Dict[Tuple[str, datetime, str], Rollup]) -> None:
+        """
+        Запись агрегатов и скетчей бакетов.
+        
+        Args:
+            cursor: Курсор открытой транзакции
+            rollups: (гранулярность, начало периода, тип события) -> агрегат
+        """
+        cursor.executemany("""
+            INSERT OR REPLACE INTO event_aggregations 
+            (aggregation_type, period_start, event_type, dimension_key, 
+             dimension_value, count, unique_users, sum_value, avg_value)
+            VALUES (?, ?, ?, 'all', 'all', ?, ?, ?, ?)
+        """, [
+            (
+                granularity,
+                period_start,
+                event_type,
+                rollup.count,
+                rollup.unique_users,
+                rollup.value_sum,
+                rollup.value_sum / rollup.count if rollup.count else 0.0
+            )
+            for (granularity, period_start, event_type), rollup in rollups.items()
+        ])
+        
+        cursor.executemany("""
+            INSERT OR REPLACE INTO event_sketches 
+            (granularity, period_start, event_type, sketch)
+            VALUES (?, ?, ?, ?)
+        """, [
+            (granularity, period_start, event_type, rollup.sketch.to_bytes())
+            for (granularity, period_start, event_type), rollup in rollups.items()
+        ])
+    
+    def replace(
+        self,
+        cursor: sqlite3.Cursor,
+        granularity: str,
+        start: datetime,
+        end: datetime,
+        rollups: Dict[Tuple[str, datetime, str], Rollup]
+    ) -> None:
+        """
+        Замена агрегатов периода [start, end) пересчитанными.
+        
+        Args:
+            cursor: Курсор открытой транзакции
+            granularity: 'hourly' или 'daily'
+            start: Начало периода
+            end: Конец периода
+            rollups: Пересчитанные агрегаты
+        """
+        cursor.execute("""
+            DELETE FROM event_aggregations
+            WHERE aggregation_type = ? AND dimension_key = 'all'
+            AND period_start >= ? AND period_start < ?
+        """, (granularity, start, end))
+        cursor.execute("""
+            DELETE FROM event_sketches
+            WHERE granularity = ? AND period_start >= ? AND period_start < ?
+        """, (granularity, start, end))
+        
+        self.write(cursor, rollups)
+
+
 class EventStorage:
     """Хранилище событий."""
     
     def __init__(self, db_path: str = "analytics.db"):
         self.db_path = db_path
+        self.partitions = EventPartitionStore(self)
+        self.rollups = RollupStore(self)
+        self._write_lock = threading.Lock()
         self._init_database()
         self._buffer: List[Event] = []
         self._buffer_lock = threading.RLock()
@@ -180,6 +1149,17 @@ class EventStorage:
                 )
             """)
             
+            # HLL-скетчи уникальных пользователей по (тип события, час/день)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS event_sketches (
+                    granularity TEXT,
+                    period_start TIMESTAMP,
+                    event_type TEXT,
+                    sketch BLOB,
+                    PRIMARY KEY (granularity, period_start, event_type)
+                )
+            """)
+            
             # Индексы
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events(timestamp)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_events_type ON events(event_type, timestamp)")
@@ -201,7 +1181,17 @@ class EventStorage:
                 )
             """)
             
+            # Колоночные дневные партиции
+            self.partitions.init_schema(cursor)
+            
             conn.commit()
+            
+            # Миграция: партиции для событий, записанных до их появления
+            cursor.execute("SELECT EXISTS(SELECT 1 FROM event_segments) AS has_segments")
+            if not cursor.fetchone()['has_segments']:
+                migrated = self.partitions.backfill(conn)
+                if migrated:
+                    logger.info(f"Built event partitions for {migrated} events")
     
     @contextmanager
     def _get_connection(self):
@@ -242,15 +1232,18 @@ class EventStorage:
             self._buffer.clear()
         
         try:
-            with self._get_connection() as conn:
+            with self._write_lock, self._get_connection() as conn:
                 cursor = conn.cursor()
+                # Блокировка записи сразу: коды словаря и агрегаты читаются
+                # и пишутся без вмешательства других процессов
+                cursor.execute("BEGIN IMMEDIATE")
                 
-                for event in events_to_save:
-                    cursor.execute("""
-                        INSERT INTO events 
-                        (id, event_type, user_id, session_id, timestamp, properties, context)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """, (
+                cursor.executemany("""
+                    INSERT INTO events 
+                    (id, event_type, user_id, session_id, timestamp, properties, context)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [
+                    (
                         event.id,
                         event.event_type.value,
                         event.user_id,
@@ -258,13 +1251,20 @@ class EventStorage:
                         event.timestamp,
                         json.dumps(event.properties) if event.properties else None,
                         json.dumps(event.context) if event.context else None
-                    ))
+                    )
+                    for event in events_to_save
+                ])
+                
+                self.partitions.append(cursor, events_to_save)
+                self.rollups.apply(cursor, events_to_save)
                 
                 conn.commit()
                 logger.debug(f"Flushed {len(events_to_save)} events to database")
                 
         except Exception as e:
             logger.error(f"Error flushing event buffer: {e}")
+            # Коды словаря из откаченной транзакции недействительны
+            self.partitions.reset()
             # Возвращаем события в буфер при ошибке
             with self._buffer_lock:
                 self._buffer.extend(events_to_save)
@@ -314,7 +1314,8 @@ class EventStorage:
         start_date: Optional[datetime] = None,
         end_date: Optional[datetime] = None,
         limit: int = 1000,
-        offset: int = 0
+        offset: int = 0,
+        include_payload: bool = True
     ) -> List[Event]:
         """
         Получение событий с фильтрами.
@@ -326,7 +1327,8 @@ class EventStorage:
             end_date: Конец периода
             limit: Максимальное количество
             offset: Смещение
-            
+            include_payload: Загружать properties и context (JSON)
+        
         Returns:
             Список событий
         """
@@ -334,7 +1336,8 @@ class EventStorage:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
                 
-                query = "SELECT * FROM events WHERE 1=1"
+                columns = "*" if include_payload else "id, event_type, user_id, session_id, timestamp"
+                query = f"SELECT {columns} FROM events WHERE 1=1"
                 params = []
                 
                 if event_type:
@@ -366,8 +1369,8 @@ class EventStorage:
                         user_id=row['user_id'],
                         session_id=row['session_id'],
                         timestamp=datetime.fromisoformat(row['timestamp']),
-                        properties=json.loads(row['properties']) if row['properties'] else {},
-                        context=json.loads(row['context']) if row['context'] else {}
+                        properties=json.loads(row['properties']) if include_payload and row['properties'] else {},
+                        context=json.loads(row['context']) if include_payload and row['context'] else {}
                     )
                     events.append(event)
                 
@@ -433,46 +1436,73 @@ class EventAggregator:
     def __init__(self, storage: EventStorage):
         self.storage = storage
     
+    def _scan_hours(
+        self,
+        cursor: sqlite3.Cursor,
+        start: datetime,
+        end: datetime
+    ) -> Dict[Tuple[str, datetime, str], Rollup]:
+        """
+        Один проход по сырым событиям интервала.
+        
+        Returns:
+            ('hourly', час, тип события) -> агрегат (уникальные пользователи —
+            оценка по скетчу, как и при сбросе буфера)
+        """
+        cursor.execute("""
+            SELECT 
+                substr(timestamp, 1, 13) as hour,
+                event_type,
+                user_id,
+                COUNT(*) as event_count,
+                SUM(CASE WHEN json_type(properties, '$.value') IN ('integer', 'real')
+                    THEN json_extract(properties, '$.value') ELSE 0 END) as value_sum
+            FROM events 
+            WHERE timestamp >= ? AND timestamp < ?
+            GROUP BY hour, event_type, user_id
+        """, (start, end))
+        
+        rollups: Dict[Tuple[str, datetime, str], Rollup] = {}
+        hours: Dict[str, datetime] = {}
+        for row in cursor.fetchall():
+            hour = hours.get(row['hour'])
+            if hour is None:
+                hour = hours[row['hour']] = datetime.strptime(row['hour'].replace('T', ' '), '%Y-%m-%d %H')
+            
+            key = ('hourly', hour, row['event_type'])
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollups[key] = Rollup()
+            rollup.count += row['event_count']
+            rollup.value_sum += row['value_sum'] or 0.0
+            if row['user_id'] is not None:
+                rollup.sketch.add(row['user_id'])
+        
+        for rollup in rollups.values():
+            rollup.unique_users = rollup.sketch.count()
+        
+        return rollups
+    
     def aggregate_hourly(self, date: datetime):
         """
-        Агрегация событий по часам.
+        Агрегация событий по часам (пересчет для восстановления).
         
         Args:
             date: Дата для агрегации
         """
         hour_start = date.replace(minute=0, second=0, microsecond=0)
+        hour_end = hour_start + timedelta(hours=1)
         
         try:
             with self.storage._get_connection() as conn:
                 cursor = conn.cursor()
                 
-                # Получаем события за час
-                cursor.execute("""
-                    SELECT 
-                        event_type,
-                        user_id,
-                        COUNT(*) as event_count,
-                        COUNT(DISTINCT user_id) as unique_users
-                    FROM events 
-                    WHERE timestamp >= ? AND timestamp < ?
-                    GROUP BY event_type
-                """, (hour_start, hour_start + timedelta(hours=1)))
-                
-                for row in cursor.fetchall():
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO event_aggregations 
-                        (aggregation_type, period_start, event_type, dimension_key, 
-                         dimension_value, count, unique_users)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        'hourly',
-                        hour_start,
-                        row['event_type'],
-                        'all',
-                        'all',
-                        row['event_count'],
-                        row['unique_users']
-                    ))
+                with self.storage._write_lock:
+                    # Сканирование и замена в одной транзакции записи: события,
+                    # сброшенные другим процессом, не попадут между ними
+                    cursor.execute("BEGIN IMMEDIATE")
+                    rollups = self._scan_hours(cursor, hour_start, hour_end)
+                    self.storage.rollups.replace(cursor, 'hourly', hour_start, hour_end, rollups)
                 
                 conn.commit()
                 logger.debug(f"Aggregated hourly data for {hour_start}")
@@ -484,41 +1514,38 @@ class EventAggregator:
         """
         Агрегация событий по дням.
         
+        Агрегаты обновляются при сбросе буфера (RollupStore); пересчет
+        нужен для восстановления. Часовые агрегаты дня пересчитываются
+        одним проходом, дневные уникальные пользователи — объединение
+        часовых скетчей.
+        
         Args:
             date: Дата для агрегации
         """
         day_start = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        day_end = day_start + timedelta(days=1)
         
         try:
             with self.storage._get_connection() as conn:
                 cursor = conn.cursor()
                 
                 # Основные метрики по типам событий
-                cursor.execute("""
-                    SELECT 
-                        event_type,
-                        COUNT(*) as event_count,
-                        COUNT(DISTINCT user_id) as unique_users
-                    FROM events 
-                    WHERE timestamp >= ? AND timestamp < ?
-                    GROUP BY event_type
-                """, (day_start, day_start + timedelta(days=1)))
-                
-                for row in cursor.fetchall():
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO event_aggregations 
-                        (aggregation_type, period_start, event_type, dimension_key, 
-                         dimension_value, count, unique_users)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        'daily',
-                        day_start,
-                        row['event_type'],
-                        'all',
-                        'all',
-                        row['event_count'],
-                        row['unique_users']
-                    ))
+                with self.storage._write_lock:
+                    cursor.execute("BEGIN IMMEDIATE")
+                    hourly = self._scan_hours(cursor, day_start, day_end)
+                    self.storage.rollups.replace(cursor, 'hourly', day_start, day_end, hourly)
+                    
+                    daily: Dict[Tuple[str, datetime, str], Rollup] = {}
+                    for (_, _, event_type), hour_rollup in hourly.items():
+                        rollup = daily.get(('daily', day_start, event_type))
+                        if rollup is None:
+                            rollup = daily[('daily', day_start, event_type)] = Rollup()
+                        rollup.count += hour_rollup.count
+                        rollup.value_sum += hour_rollup.value_sum
+                        rollup.sketch.merge(hour_rollup.sketch)
+                    for rollup in daily.values():
+                        rollup.unique_users = rollup.sketch.count()
+                    self.storage.rollups.replace(cursor, 'daily', day_start, day_end, daily)
                 
                 # Агрегация по пользователям
                 cursor.execute("""
@@ -553,6 +1580,343 @@ class EventAggregator:
                 
         except Exception as e:
             logger.error(f"Error aggregating daily data: {e}")
+    
+    def get_unique_users(
+        self,
+        event_type: Optional[EventType],
+        start_date: datetime,
+        end_date: datetime,
+        group_by: str = 'day'
+    ) -> Dict[str, Any]:
+        """
+        Уникальные пользователи по периодам из скетчей (без чтения событий).
+        
+        Для группировки по дням/неделям/месяцам используются дневные
+        скетчи, а для дней без них и для последнего дня, если интервал
+        кончается внутри него, — объединение часовых. Начало интервала
+        округляется вниз до часа (до дня для day/week/month), конец — вверх
+        до часа.
+        
+        Args:
+            event_type: Тип события (None — все типы)
+            start_date: Начало периода
+            end_date: Конец периода
+            group_by: Группировка ('hour', 'day', 'week', 'month')
+        
+        Returns:
+            Уникальные пользователи по периодам и за весь интервал
+        """
+        period_format, _ = _PERIOD_FORMATS.get(group_by, _PERIOD_FORMATS['day'])
+        hourly = group_by == 'hour'
+        start = start_date.replace(minute=0, second=0, microsecond=0)
+        if not hourly:
+            start = start.replace(hour=0)
+        
+        try:
+            with self.storage._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                query = """
+                    SELECT granularity, period_start, sketch
+                    FROM event_sketches
+                    WHERE period_start >= ? AND period_start < ?
+                """
+                params: List[Any] = [start, end_date]
+                
+                if hourly:
+                    query += " AND granularity = 'hourly'"
+                else:
+                    query += " AND granularity IN ('hourly', 'daily')"
+                
+                if event_type:
+                    query += " AND event_type = ?"
+                    params.append(event_type.value)
+                
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+            
+            # Дневной скетч последнего дня учел бы пользователей после end_date
+            partial_day = (
+                end_date.strftime('%Y-%m-%d')
+                if end_date != end_date.replace(hour=0, minute=0, second=0, microsecond=0)
+                else None
+            )
+            covered_days = {
+                row['period_start'][:10] for row in rows
+                if row['granularity'] == 'daily' and row['period_start'][:10] != partial_day
+            }
+            
+            periods: Dict[str, HyperLogLog] = {}
+            total = HyperLogLog()
+            for row in rows:
+                day = row['period_start'][:10]
+                if row['granularity'] == 'hourly' and day in covered_days:
+                    continue
+                if row['granularity'] == 'daily' and day not in covered_days:
+                    continue
+                
+                sketch = HyperLogLog.from_bytes(row['sketch'])
+                period = datetime.fromisoformat(row['period_start']).strftime(period_format)
+                if period in periods:
+                    periods[period].merge(sketch)
+                else:
+                    periods[period] = sketch
+                total.merge(sketch)
+            
+            return {
+                'event_type': event_type.value if event_type else 'all',
+                'group_by': group_by,
+                'periods': [
+                    {'period': period, 'unique_users': periods[period].count()}
+                    for period in sorted(periods)
+                ],
+                'total_unique_users': total.count()
+            }
+        
+        except Exception as e:
+            logger.error(f"Error getting unique users: {e}")
+            return {}
+
+
+# Упаковка события воронки в один int для быстрой сортировки:
+# идентификатор << 64 | время << 8 | индекс типа шага
+_FUNNEL_TS_MASK = (1 << 56) - 1
+
+
+def _duration_stats(values: List[float]) -> Dict[str, Any]:
+    """Распределение времени конверсии (секунды)."""
+    if not values:
+        return {'count': 0}
+    
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    
+    def percentile(q: float) -> float:
+        return ordered[int(q * last + 0.5)]
+    
+    return {
+        'count': len(ordered),
+        'avg': sum(ordered) / len(ordered),
+        'min': ordered[0],
+        'p25': percentile(0.25),
+        'median': percentile(0.5),
+        'p75': percentile(0.75),
+        'p90': percentile(0.9),
+        'max': ordered[-1]
+    }
+
+
+def _funnel_shard(task: Tuple) -> Optional[Tuple[List[int], List[array], List[array]]]:
+    """
+    Прогон воронки по одному шарду идентификаторов.
+    
+    Выполняется в отдельном процессе: читает нужные сегменты напрямую из
+    БД, оставляет события своего шарда, сортирует их по (идентификатор,
+    время) и одним проходом продвигает автомат каждого идентификатора.
+    
+    Args:
+        task: (путь к БД, колонка идентификатора, [(id сегмента,
+            [(индекс типа, начало, конец)])], начало и конец интервала (мкс),
+            номер шарда, число шардов, индексы типов шагов, окно (мкс или None))
+    
+    Returns:
+        (число дошедших до каждого шага, время от предыдущего шага,
+        время от первого шага) — время в секундах; None, если сегмент
+        удален слиянием после планирования
+    """
+    db_path, column, segment_slices, start_ts, end_ts, shard, shards, step_types, window_us = task
+    step_count = len(step_types)
+    
+    # Индекс типа -> шаги с этим типом (по убыванию, чтобы одно событие
+    # не продвинуло автомат сразу на несколько шагов)
+    type_steps: Dict[int, List[int]] = defaultdict(list)
+    for step, type_index in enumerate(step_types):
+        type_steps[type_index].insert(0, step)
+    
+    keys = []
+    conn = sqlite3.connect(db_path)
+    try:
+        for segment_id, slices in segment_slices:
+            row = conn.execute(
+                f"SELECT timestamps, {column} FROM event_segments WHERE id = ?",
+                (segment_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            timestamps = array('q')
+            timestamps.frombytes(row[0])
+            identities = array('I')
+            identities.frombytes(row[1])
+            
+            for type_index, begin, end in slices:
+                low = bisect_left(timestamps, start_ts, begin, end)
+                high = bisect_right(timestamps, end_ts, begin, end)
+                keys.extend(
+                    (identity << 64) | (timestamp << 8) | type_index
+                    for identity, timestamp in zip(identities[low:high], timestamps[low:high])
+                    if identity and identity % shards == shard
+                )
+    finally:
+        conn.close()
+    
+    keys.sort()
+    
+    reached = [0] * step_count
+    from_previous = [array('d') for _ in range(step_count)]
+    from_start = [array('d') for _ in range(step_count)]
+    
+    current = None
+    level = 0
+    # Время начала и время последнего события лучшей цепочки, дошедшей до шага
+    chain_start: List[Optional[int]] = [None] * step_count
+    chain_time: List[Optional[int]] = [None] * step_count
+    
+    for key in keys:
+        identity = key >> 64
+        if identity != current:
+            current = identity
+            level = 0
+            chain_start = [None] * step_count
+            chain_time = [None] * step_count
+        
+        if level == step_count:
+            continue
+        
+        timestamp = (key >> 8) & _FUNNEL_TS_MASK
+        for step in type_steps[key & 0xFF]:
+            if step == 0:
+                # Более поздний старт оставляет больше времени на окно
+                chain_start[0] = chain_time[0] = timestamp
+            else:
+                started = chain_start[step - 1]
+                if started is None or (window_us is not None and timestamp - started > window_us):
+                    continue
+                chain_start[step] = started
+                chain_time[step] = timestamp
+            
+            if step == level:
+                reached[step] += 1
+                if step > 0:
+                    from_previous[step].append((timestamp - chain_time[step - 1]) / 1e6)
+                    from_start[step].append((timestamp - chain_start[step]) / 1e6)
+                level += 1
+    
+    return reached, from_previous, from_start
+
+
+class FunnelEngine:
+    """
+    Воронки с учетом порядка шагов и окна конверсии.
+    
+    События шагов берутся из колоночных партиций, делятся на шарды по
+    коду идентификатора и обрабатываются параллельно в процессах; внутри
+    шарда — одна сортировка и один проход автомата по каждому
+    идентификатору (без передачи множеств пользователей между шагами).
+    """
+    
+    IDENTITY_COLUMNS = {'user_id': 'users', 'session_id': 'sessions'}
+    
+    # Сколько раз перепланировать прогон, если сегменты слились во время него
+    PLAN_ATTEMPTS = 5
+    
+    def __init__(self, storage: EventStorage, shards: Optional[int] = None, min_parallel_events: int = 200000):
+        """
+        Инициализация.
+        
+        Args:
+            storage: Хранилище событий
+            shards: Количество шардов (процессов; по умолчанию — число CPU, не больше 4)
+            min_parallel_events: С какого числа событий запускать процессы
+        """
+        self.storage = storage
+        self.shards = max(1, shards or min(4, os.cpu_count() or 1))
+        self.min_parallel_events = min_parallel_events
+    
+    def analyze(
+        self,
+        steps: List[EventType],
+        start_date: datetime,
+        end_date: datetime,
+        conversion_window: Optional[timedelta] = None,
+        identity_field: str = 'user_id'
+    ) -> Tuple[List[int], List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Прогон воронки.
+        
+        Шаг засчитывается, если его событие произошло после предыдущего
+        шага цепочки и не позже conversion_window от ее первого шага.
+        
+        Args:
+            steps: Шаги воронки
+            start_date: Начало периода
+            end_date: Конец периода
+            conversion_window: Максимальное время от первого до последнего шага
+            identity_field: 'user_id' или 'session_id'
+        
+        Returns:
+            (число дошедших до каждого шага, распределения времени от
+            предыдущего шага, распределения времени от первого шага)
+        """
+        column = self.IDENTITY_COLUMNS[identity_field]
+        partitions = self.storage.partitions
+        start_ts = _to_micros(start_date)
+        end_ts = _to_micros(end_date)
+        window_us = conversion_window // timedelta(microseconds=1) if conversion_window is not None else None
+        
+        # Индексы различных типов шагов (помещаются в 8 бит ключа)
+        type_indexes: Dict[int, int] = {}
+        step_types = []
+        for step in steps:
+            code = partitions.get_code('event_type', step.value)
+            step_types.append(type_indexes.setdefault(code, len(type_indexes)))
+        
+        # Сегменты неизменяемы, но слияние может удалить их после
+        # планирования — тогда шард возвращает None и прогон
+        # перепланируется по актуальному списку сегментов
+        for _ in range(self.PLAN_ATTEMPTS):
+            segment_slices = []
+            event_count = 0
+            for segment in partitions.get_segments(start_ts, end_ts):
+                slices = [
+                    (type_index, *segment.type_ranges[code])
+                    for code, type_index in type_indexes.items()
+                    if code in segment.type_ranges
+                ]
+                if slices:
+                    segment_slices.append((segment.id, slices))
+                    event_count += sum(end - begin for _, begin, end in slices)
+            
+            shards = self.shards if event_count >= self.min_parallel_events else 1
+            tasks = [
+                (self.storage.db_path, column, segment_slices, start_ts, end_ts, shard, shards, step_types, window_us)
+                for shard in range(shards)
+            ]
+            
+            if shards > 1:
+                with ProcessPoolExecutor(max_workers=shards) as executor:
+                    results = list(executor.map(_funnel_shard, tasks))
+            else:
+                results = [_funnel_shard(task) for task in tasks]
+            
+            if None not in results:
+                break
+        else:
+            raise RuntimeError("Event segments kept changing during funnel analysis")
+        
+        reached = [0] * len(steps)
+        from_previous: List[array] = [array('d') for _ in steps]
+        from_start: List[array] = [array('d') for _ in steps]
+        for shard_reached, shard_previous, shard_start in results:
+            for step in range(len(steps)):
+                reached[step] += shard_reached[step]
+                from_previous[step].extend(shard_previous[step])
+                from_start[step].extend(shard_start[step])
+        
+        return (
+            reached,
+            [_duration_stats(values) for values in from_previous],
+            [_duration_stats(values) for values in from_start]
+        )
 
 
 class AnalyticsService:
@@ -562,6 +1926,7 @@ class AnalyticsService:
         self.storage = storage or EventStorage()
         self.validator = EventValidator()
         self.aggregator = EventAggregator(self.storage)
+        self.funnel_engine = FunnelEngine(self.storage)
         self._session_cache: Dict[str, Dict[str, Any]] = {}
     
     def track_event(
@@ -673,82 +2038,7 @@ class AnalyticsService:
             Метрики
         """
         try:
-            with self.storage._get_connection() as conn:
-                cursor = conn.cursor()
-                
-                if group_by == 'hour':
-                    time_format = "strftime('%Y-%m-%d %H:00:00', timestamp)"
-                elif group_by == 'day':
-                    time_format = "date(timestamp)"
-                elif group_by == 'week':
-                    time_format = "strftime('%Y-W%W', timestamp)"
-                elif group_by == 'month':
-                    time_format = "strftime('%Y-%m', timestamp)"
-                else:
-                    time_format = "date(timestamp)"
-                
-                cursor.execute(f"""
-                    SELECT 
-                        {time_format} as period,
-                        COUNT(*) as event_count,
-                        COUNT(DISTINCT user_id) as unique_users,
-                        COUNT(DISTINCT session_id) as unique_sessions
-                    FROM events 
-                    WHERE event_type = ? 
-                    AND timestamp >= ? AND timestamp <= ?
-                    GROUP BY period
-                    ORDER BY period
-                """, (event_type.value, start_date, end_date))
-                
-                metrics = {
-                    'total_events': 0,
-                    'total_users': 0,
-                    'total_sessions': 0,
-                    'periods': []
-                }
-                
-                seen_users = set()
-                seen_sessions = set()
-                
-                for row in cursor.fetchall():
-                    period_data = {
-                        'period': row['period'],
-                        'event_count': row['event_count'],
-                        'unique_users': row['unique_users'],
-                        'unique_sessions': row['unique_sessions']
-                    }
-                    
-                    metrics['periods'].append(period_data)
-                    metrics['total_events'] += row['event_count']
-                    
-                    # Для получения уникальных пользователей и сессий за весь период
-                    # нужен отдельный запрос
-                
-                # Получаем уникальных пользователей за весь период
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT user_id) as total_users
-                    FROM events 
-                    WHERE event_type = ? 
-                    AND timestamp >= ? AND timestamp <= ?
-                    AND user_id IS NOT NULL
-                """, (event_type.value, start_date, end_date))
-                
-                total_users_row = cursor.fetchone()
-                metrics['total_users'] = total_users_row['total_users'] if total_users_row else 0
-                
-                # Получаем уникальные сессии
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT session_id) as total_sessions
-                    FROM events 
-                    WHERE event_type = ? 
-                    AND timestamp >= ? AND timestamp <= ?
-                    AND session_id IS NOT NULL
-                """, (event_type.value, start_date, end_date))
-                
-                total_sessions_row = cursor.fetchone()
-                metrics['total_sessions'] = total_sessions_row['total_sessions'] if total_sessions_row else 0
-                
-                return metrics
+            return self.storage.partitions.aggregate_metrics(event_type, start_date, end_date, group_by)
                 
         except Exception as e:
             logger.error(f"Error getting event metrics: {e}")
@@ -759,16 +2049,22 @@ class AnalyticsService:
         steps: List[EventType],
         start_date: datetime,
         end_date: datetime,
-        user_id_field: str = 'user_id'
+        user_id_field: str = 'user_id',
+        conversion_window: Optional[timedelta] = None
     ) -> Dict[str, Any]:
         """
         Анализ воронки событий.
         
+        Шаги учитываются по порядку: пользователь проходит шаг, если
+        совершил его после предыдущего и в пределах conversion_window от
+        первого шага.
+        
         Args:
             steps: Шаги воронки
             start_date: Начало периода
             end_date: Конец периода
-            user_id_field: Поле для идентификации пользователя
+            user_id_field: Поле для идентификации пользователя ('user_id' или 'session_id')
+            conversion_window: Окно конверсии (None — весь период)
             
         Returns:
             Данные воронки
@@ -776,76 +2072,60 @@ class AnalyticsService:
         if len(steps) < 2:
             return {'error': 'At least 2 steps required'}
         
+        if user_id_field not in FunnelEngine.IDENTITY_COLUMNS:
+            return {'error': f'Unsupported user id field: {user_id_field}'}
+        
         try:
-            with self.storage._get_connection() as conn:
-                cursor = conn.cursor()
-                
-                funnel_data = {
-                    'steps': [],
-                    'total_conversion': 0.0,
-                    'drop_offs': []
+            reached, from_previous, from_start = self.funnel_engine.analyze(
+                steps, start_date, end_date, conversion_window, user_id_field
+            )
+            
+            funnel_data = {
+                'steps': [],
+                'total_conversion': 0.0,
+                'drop_offs': [],
+                'conversion_window': conversion_window.total_seconds() if conversion_window else None
+            }
+            
+            total_start_users = reached[0]
+            
+            for i, step in enumerate(steps):
+                step_data = {
+                    'step': step.value,
+                    'user_count': reached[i],
+                    'conversion_from_previous': 0.0,
+                    'conversion_from_start': 0.0
                 }
                 
-                # Получаем пользователей для первого шага
-                step_query = f"""
-                    SELECT DISTINCT {user_id_field}
-                    FROM events 
-                    WHERE event_type = ? 
-                    AND timestamp >= ? AND timestamp <= ?
-                    AND {user_id_field} IS NOT NULL
-                """
-                
-                prev_users = set()
-                total_start_users = 0
-                
-                for i, step in enumerate(steps):
-                    cursor.execute(
-                        step_query,
-                        (step.value, start_date, end_date)
-                    )
-                    
-                    current_users = {row[user_id_field] for row in cursor.fetchall()}
-                    
-                    if i == 0:
-                        total_start_users = len(current_users)
-                        step_users = current_users
-                    else:
-                        # Пользователи, которые прошли все предыдущие шаги
-                        step_users = current_users.intersection(prev_users)
-                    
-                    step_data = {
-                        'step': step.value,
-                        'user_count': len(step_users),
-                        'conversion_from_previous': 0.0,
-                        'conversion_from_start': 0.0
+                if i == 0:
+                    step_data['conversion_from_start'] = 100.0
+                else:
+                    prev_count = reached[i - 1]
+                    if prev_count > 0:
+                        step_data['conversion_from_previous'] = (reached[i] / prev_count) * 100
+                    if total_start_users > 0:
+                        step_data['conversion_from_start'] = (reached[i] / total_start_users) * 100
+                    step_data['time_to_convert'] = {
+                        'from_previous': from_previous[i],
+                        'from_start': from_start[i]
                     }
                     
-                    if i == 0:
-                        step_data['conversion_from_start'] = 100.0
-                    else:
-                        if len(prev_users) > 0:
-                            step_data['conversion_from_previous'] = (len(step_users) / len(prev_users)) * 100
-                        if total_start_users > 0:
-                            step_data['conversion_from_start'] = (len(step_users) / total_start_users) * 100
-                    
-                    funnel_data['steps'].append(step_data)
-                    
-                    if i > 0 and len(prev_users) > 0:
-                        drop_off = len(prev_users) - len(step_users)
+                    if prev_count > 0:
+                        drop_off = prev_count - reached[i]
                         funnel_data['drop_offs'].append({
                             'from_step': steps[i-1].value,
                             'to_step': step.value,
                             'drop_off_count': drop_off,
-                            'drop_off_percentage': (drop_off / len(prev_users)) * 100
+                            'drop_off_percentage': (drop_off / prev_count) * 100
                         })
-                    
-                    prev_users = step_users
-                
-                if total_start_users > 0 and len(prev_users) > 0:
-                    funnel_data['total_conversion'] = (len(prev_users) / total_start_users) * 100
-                
-                return funnel_data
                 
+                funnel_data['steps'].append(step_data)
+            
+            if total_start_users > 0 and reached[-1] > 0:
+                funnel_data['total_conversion'] = (reached[-1] / total_start_users) * 100
+            
+            return funnel_data
+        
         except Exception as e:
             logger.error(f"Error calculating funnel: {e}")
             return {}
@@ -873,7 +2153,8 @@ class AnalyticsService:
             user_id=user_id,
             start_date=start_date,
             end_date=end_date,
-            limit=limit
+            limit=limit,
+            include_payload=False
         )
         
         if not events:
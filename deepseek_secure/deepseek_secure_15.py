@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional, Any, Set, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Any, Set, Tuple
 from dataclasses import dataclass, field
 from enum import Enum
 import sqlite3
@@ -8,8 +8,17 @@ import json
 import re
 import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, groupby
+import heapq
 import math
+import mmap
+import os
+import struct
+import sys
+import uuid
 import jieba  # Для китайского языка, установите: pip install jieba
 import hashlib
 
@@ -176,18 +185,657 @@ class TextTokenizer:
         return ngrams
 
 
-class InvertedIndex:
-    """Обратный индекс."""
+# Поля документа в списках вхождений (бит маски — позиция в списке)
+_FIELD_NAMES = [search_field.value for search_field in SearchField if search_field != SearchField.ALL]
+# Маска полей -> имена полей в ней
+_FIELD_MASK_NAMES = [
+    [name for bit, name in enumerate(_FIELD_NAMES) if mask >> bit & 1]
+    for mask in range(1 << len(_FIELD_NAMES))
+]
+_DOC_TYPES = list(DocumentType)
+_DOC_TYPE_CODES = {doc_type: code for code, doc_type in enumerate(_DOC_TYPES)}
+
+
+def _encode_varint(value: int, out: bytearray) -> None:
+    """Запись неотрицательного числа varint (7 бит на байт)."""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Чтение varint: (значение, позиция после него)."""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _competitive_impacts(impacts: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Недоминируемые пары (частота, длина документа).
+    
+    BM25 растет с частотой и убывает с длиной, поэтому максимум по
+    блоку достигается на одной из этих пар при любой средней длине.
+    """
+    result = []
+    for tf, length in sorted(impacts, key=lambda impact: (-impact[0], impact[1])):
+        if not result or length < result[-1][1]:
+            result.append((tf, length))
+    return result
+
+
+class IndexSegment:
+    """
+    Неизменяемый сегмент обратного индекса на диске.
+    
+    Файл отображается в память (mmap): при открытии читается только
+    заголовок, а таблицы используются как memoryview без копирования,
+    поэтому индекс на миллион документов открывается за миллисекунды.
+    
+    Формат (порядок байт платформы, секции выровнены по 8 байт):
+    заголовок со смещениями секций; таблица документов, отсортированная
+    по ID (смещения ID, ID в UTF-8, длины в токенах, коды типов);
+    отсортированный словарь терминов (смещения, термины, частоты
+    документов, диапазоны блоков) и списки вхождений. Запись списка
+    вхождений — разница номеров документов (varint), маска полей и varint
+    частоты по каждому полю из маски. Список разбит на блоки по
+    BLOCK_SIZE записей; для блока хранятся смещение, последний номер
+    документа и недоминируемые пары (частота, длина документа) — этого
+    достаточно для перехода к документу без декодирования предыдущих
+    блоков и для точной верхней оценки BM25 блока.
+    """
+    
+    MAGIC = b'SIDX'
+    VERSION = 2
+    BLOCK_SIZE = 128
+    SECTIONS = (
+        ('doc_id_offsets', 'Q'),
+        ('doc_ids', 'B'),
+        ('doc_lengths', 'I'),
+        ('doc_types', 'B'),
+        ('term_offsets', 'Q'),
+        ('terms', 'B'),
+        ('term_doc_freqs', 'I'),
+        ('term_blocks', 'Q'),
+        ('block_offsets', 'Q'),
+        ('block_last', 'I'),
+        ('block_impact_offsets', 'Q'),
+        ('block_impacts', 'I'),
+        ('postings', 'B')
+    )
+    # magic, версия, порядок байт, поколение, документы, термины, сумма длин, (смещение, размер) секций
+    _HEADER = struct.Struct('<4sHHQQQQ' + 'QQ' * len(SECTIONS))
+    _BYTEORDER = 0 if sys.byteorder == 'little' else 1
+    
+    def __init__(
+        self,
+        path: str,
+        mapping: mmap.mmap,
+        generation: int,
+        doc_count: int,
+        term_count: int,
+        total_length: int,
+        sections: Dict[str, memoryview]
+    ):
+        self.path = path
+        self.generation = generation
+        self.doc_count = doc_count
+        self.term_count = term_count
+        self.total_length = total_length
+        self._mapping = mapping
+        self._sections = sections
+        
+        self.doc_id_offsets = sections['doc_id_offsets']
+        self.doc_ids = sections['doc_ids']
+        self.doc_lengths = sections['doc_lengths']
+        self.doc_types = sections['doc_types']
+        self.term_offsets = sections['term_offsets']
+        self.terms = sections['terms']
+        self.term_doc_freqs = sections['term_doc_freqs']
+        self.term_blocks = sections['term_blocks']
+        self.block_offsets = sections['block_offsets']
+        self.block_last = sections['block_last']
+        self.block_impact_offsets = sections['block_impact_offsets']
+        self.block_impacts = sections['block_impacts']
+        self.postings_data = sections['postings']
+    
+    @classmethod
+    def write(
+        cls,
+        path: str,
+        generation: int,
+        documents: List[Tuple[str, DocumentType, int]],
+        postings: Iterable[Tuple[str, List[Tuple[int, Dict[str, int]]]]]
+    ) -> None:
+        """
+        Запись сегмента (атомарно, через временный файл).
+        
+        Args:
+            path: Путь к файлу
+            generation: Номер последнего изменения, вошедшего в сегмент
+            documents: (ID, тип, длина) в порядке номеров, отсортированные по ID
+            postings: (термин, [(номер документа, {поле: частота})]) по возрастанию
+                терминов и номеров
+        """
+        doc_id_offsets = array('Q', [0])
+        doc_ids = bytearray()
+        doc_lengths = array('I')
+        doc_types = array('B')
+        total_length = 0
+        
+        for doc_id, doc_type, length in documents:
+            doc_ids += doc_id.encode('utf-8')
+            doc_id_offsets.append(len(doc_ids))
+            doc_lengths.append(length)
+            doc_types.append(_DOC_TYPE_CODES[doc_type])
+            total_length += length
+        
+        term_offsets = array('Q', [0])
+        terms = bytearray()
+        term_doc_freqs = array('I')
+        term_blocks = array('Q', [0])
+        block_offsets = array('Q', [0])
+        block_last = array('I')
+        block_impact_offsets = array('Q', [0])
+        block_impacts = array('I')
+        data = bytearray()
+        
+        for term, term_postings in postings:
+            if not term_postings:
+                continue
+            
+            terms += term.encode('utf-8')
+            term_offsets.append(len(terms))
+            term_doc_freqs.append(len(term_postings))
+            
+            previous = 0
+            for start in range(0, len(term_postings), cls.BLOCK_SIZE):
+                impacts = []
+                
+                for number, field_counts in term_postings[start:start + cls.BLOCK_SIZE]:
+                    _encode_varint(number - previous, data)
+                    previous = number
+                    
+                    mask = 0
+                    for bit, name in enumerate(_FIELD_NAMES):
+                        if field_counts.get(name):
+                            mask |= 1 << bit
+                    data.append(mask)
+                    for bit, name in enumerate(_FIELD_NAMES):
+                        if mask >> bit & 1:
+                            _encode_varint(field_counts[name], data)
+                    
+                    impacts.append((sum(field_counts.values()), doc_lengths[number]))
+                
+                block_offsets.append(len(data))
+                block_last.append(previous)
+                for impact in _competitive_impacts(impacts):
+                    block_impacts.extend(impact)
+                block_impact_offsets.append(len(block_impacts))
+            
+            term_blocks.append(len(block_last))
+        
+        sections = [
+            doc_id_offsets, doc_ids, doc_lengths, doc_types,
+            term_offsets, terms, term_doc_freqs,
+            term_blocks, block_offsets, block_last, block_impact_offsets, block_impacts, data
+        ]
+        
+        placements = []
+        offset = cls._HEADER.size
+        for section in sections:
+            offset += -offset % 8
+            size = len(section) * (section.itemsize if isinstance(section, array) else 1)
+            placements.extend((offset, size))
+            offset += size
+        
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(cls._HEADER.pack(
+                cls.MAGIC, cls.VERSION, cls._BYTEORDER, generation,
+                len(doc_lengths), len(term_doc_freqs), total_length, *placements
+            ))
+            for section, section_offset in zip(sections, placements[::2]):
+                f.write(b'\0' * (section_offset - f.tell()))
+                f.write(section)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
     
-    def __init__(self):
-        self.index: Dict[str, Dict[str, Dict[str, int]]] = defaultdict(
-            lambda: defaultdict(lambda: defaultdict(int))
+    @classmethod
+    def open(cls, path: str) -> Optional['IndexSegment']:
+        """
+        Открытие сегмента.
+        
+        Args:
+            path: Путь к файлу
+        
+        Returns:
+            Сегмент или None, если файл поврежден или другого формата
+        """
+        mapping = None
+        sections: Dict[str, memoryview] = {}
+        try:
+            with open(path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            
+            header = cls._HEADER.unpack_from(mapping, 0)
+            magic, version, byteorder, generation, doc_count, term_count, total_length = header[:7]
+            if magic != cls.MAGIC or version != cls.VERSION or byteorder != cls._BYTEORDER:
+                logger.warning(f"Unsupported index segment format: {path}")
+                mapping.close()
+                return None
+            
+            with memoryview(mapping) as view:
+                for i, (name, type_code) in enumerate(cls.SECTIONS):
+                    offset, size = header[7 + 2 * i], header[8 + 2 * i]
+                    if offset + size > len(mapping):
+                        raise ValueError(f"section {name} is out of file bounds (file truncated?)")
+                    # TypeError — размер секции не кратен размеру элемента
+                    sections[name] = view[offset:offset + size].cast(type_code)
+            
+            return cls(path, mapping, generation, doc_count, term_count, total_length, sections)
+        
+        except (OSError, ValueError, TypeError, struct.error) as e:
+            logger.error(f"Error opening index segment {path}: {e}")
+            for section in sections.values():
+                section.release()
+            if mapping is not None:
+                mapping.close()
+            return None
+    
+    def close(self) -> None:
+        """Закрытие отображения файла."""
+        for section in self._sections.values():
+            section.release()
+        try:
+            self._mapping.close()
+        except BufferError:
+            # Еще есть ссылки на секции — отображение закроется сборщиком мусора
+            pass
+    
+    def doc_id(self, number: int) -> str:
+        """ID документа по номеру."""
+        return self.doc_ids[self.doc_id_offsets[number]:self.doc_id_offsets[number + 1]].tobytes().decode('utf-8')
+    
+    def _find(self, offsets: memoryview, blob: memoryview, count: int, key: bytes) -> Optional[int]:
+        """Бинарный поиск в отсортированной таблице строк."""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if blob[offsets[middle]:offsets[middle + 1]].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count and blob[offsets[low]:offsets[low + 1]].tobytes() == key:
+            return low
+        return None
+    
+    def find_doc(self, doc_id: str) -> Optional[int]:
+        """Номер документа по ID."""
+        return self._find(self.doc_id_offsets, self.doc_ids, self.doc_count, doc_id.encode('utf-8'))
+    
+    def find_term(self, term: str) -> Optional[int]:
+        """Номер термина в словаре."""
+        return self._find(self.term_offsets, self.terms, self.term_count, term.encode('utf-8'))
+    
+    def term(self, index: int) -> str:
+        """Термин по номеру."""
+        return self.terms[self.term_offsets[index]:self.term_offsets[index + 1]].tobytes().decode('utf-8')
+    
+    def _decode(self, start: int, end: int, number: int) -> Tuple[List[int], List[Dict[str, int]]]:
+        """Декодирование записей списков вхождений в байтах [start, end)."""
+        data = self.postings_data[start:end].tobytes()
+        numbers = []
+        counts = []
+        pos = 0
+        end = len(data)
+        
+        while pos < end:
+            # Короткие varint (один байт) читаются без вызова функции
+            delta = data[pos]
+            if delta < 0x80:
+                pos += 1
+            else:
+                delta, pos = _decode_varint(data, pos)
+            number += delta
+            mask = data[pos]
+            pos += 1
+            
+            field_counts = {}
+            for name in _FIELD_MASK_NAMES[mask]:
+                value = data[pos]
+                if value < 0x80:
+                    field_counts[name] = value
+                    pos += 1
+                else:
+                    field_counts[name], pos = _decode_varint(data, pos)
+            numbers.append(number)
+            counts.append(field_counts)
+        
+        return numbers, counts
+    
+    def decode_block(self, block: int, first_block: int) -> Tuple[List[int], List[Dict[str, int]]]:
+        """
+        Декодирование одного блока списка вхождений.
+        
+        Args:
+            block: Номер блока
+            first_block: Первый блок термина (номера в блоке — разности от
+                последнего номера предыдущего блока)
+        
+        Returns:
+            (номера документов, частоты по полям)
+        """
+        number = self.block_last[block - 1] if block > first_block else 0
+        return self._decode(self.block_offsets[block], self.block_offsets[block + 1], number)
+    
+    def impacts(self, first_block: int, last_block: int) -> List[List[Tuple[int, int]]]:
+        """Пары (частота, длина документа) блоков [first_block, last_block)."""
+        offsets = self.block_impact_offsets[first_block:last_block + 1].tolist()
+        values = self.block_impacts[offsets[0]:offsets[-1]].tolist()
+        base = offsets[0]
+        return [
+            list(zip(values[start - base:end - base:2], values[start - base + 1:end - base:2]))
+            for start, end in zip(offsets, offsets[1:])
+        ]
+    
+    def postings(self, index: int) -> List[Tuple[int, Dict[str, int]]]:
+        """
+        Декодирование списка вхождений термина.
+        
+        Returns:
+            [(номер документа, {поле: частота})] по возрастанию номеров
+        """
+        numbers, counts = self._decode(
+            self.block_offsets[self.term_blocks[index]],
+            self.block_offsets[self.term_blocks[index + 1]],
+            0
         )
-        self.documents: Dict[str, Document] = {}
-        self.doc_lengths: Dict[str, int] = {}  # Длина документа в токенах
-        self.avg_doc_length: float = 0.0
-        self.total_docs: int = 0
+        return list(zip(numbers, counts))
+
+
+# Номер после последнего документа: курсор исчерпан
+_END_OF_POSTINGS = sys.maxsize
+
+
+class _PostingCursor:
+    """
+    Курсор по списку вхождений термина для поиска документ-за-документом.
+    
+    seek() находит блок бинарным поиском по последним номерам блоков.
+    Блок декодируется, только когда нужен его документ (decode()); до
+    этого doc — нижняя граница номеров блока, так что блоки, отброшенные
+    по верхней оценке, не декодируются. Список изменяемой части индекса —
+    последний блок курсора.
+    """
+    
+    def __init__(
+        self,
+        index: 'InvertedIndex',
+        term: Optional[int],
+        delta: Optional[Dict[int, Dict[str, int]]]
+    ):
+        """
+        Инициализация.
+        
+        Args:
+            index: Индекс (курсор действителен, пока индекс не меняется)
+            term: Номер термина в сегменте (None — термина в сегменте нет)
+            delta: Вхождения термина в изменяемой части
+        """
+        self.segment = index.segment
+        self.deleted = index.deleted
+        self.first_block = 0
+        self.block_last: List[int] = []
+        # Недоминируемые пары (частота, длина документа) по блокам
+        self.block_impacts: List[List[Tuple[int, int]]] = []
+        
+        if term is not None:
+            first = self.first_block = self.segment.term_blocks[term]
+            last = self.segment.term_blocks[term + 1]
+            self.block_last = self.segment.block_last[first:last].tolist()
+            self.block_impacts = self.segment.impacts(first, last)
+        self.segment_blocks = len(self.block_last)
+        
+        self.delta_numbers: List[int] = []
+        self.delta_counts: List[Dict[str, int]] = []
+        if delta:
+            self.delta_numbers = list(delta)
+            self.delta_counts = list(delta.values())
+            self.block_last.append(self.delta_numbers[-1])
+            self.block_impacts.append(_competitive_impacts(
+                (sum(counts.values()), index.doc_lengths[number])
+                for number, counts in zip(self.delta_numbers, self.delta_counts)
+            ))
+        
+        # Верхние оценки вклада термина по блокам (заполняет вызывающий код)
+        self.block_bounds: List[float] = []
+        self._load(0)
+    
+    def _load(self, block: int) -> None:
+        """Переход к блоку без декодирования: doc — нижняя граница номеров блока."""
+        self.block = block
+        self.numbers = None
+        if block >= len(self.block_last):
+            self.doc = _END_OF_POSTINGS
+        else:
+            self.doc = self.block_last[block - 1] + 1 if block else 0
+    
+    def _decode_block(self) -> None:
+        if self.block < self.segment_blocks:
+            self.numbers, self.counts = self.segment.decode_block(self.first_block + self.block, self.first_block)
+        else:
+            self.numbers, self.counts = self.delta_numbers, self.delta_counts
+        self.pos = 0
+        self.doc = self.numbers[0]
+    
+    def _advance(self) -> None:
+        self.pos += 1
+        if self.pos < len(self.numbers):
+            self.doc = self.numbers[self.pos]
+        else:
+            self._load(self.block + 1)
+    
+    def _skip_deleted(self) -> None:
+        while self.numbers is not None and self.doc in self.deleted:
+            self._advance()
+    
+    def decode(self) -> None:
+        """Декодирование текущего блока: doc становится номером документа."""
+        while self.numbers is None and self.doc != _END_OF_POSTINGS:
+            self._decode_block()
+            self._skip_deleted()
+    
+    @property
+    def field_counts(self) -> Dict[str, int]:
+        """Частоты по полям в текущем документе."""
+        return self.counts[self.pos]
+    
+    @property
+    def block_bound(self) -> float:
+        """Верхняя оценка вклада термина в текущем блоке."""
+        if self.doc == _END_OF_POSTINGS:
+            return 0.0
+        return self.block_bounds[self.block]
+    
+    @property
+    def block_end(self) -> int:
+        """Последний номер документа текущего блока."""
+        if self.doc == _END_OF_POSTINGS:
+            return _END_OF_POSTINGS
+        return self.block_last[self.block]
+    
+    def next(self) -> None:
+        """Переход к следующему документу."""
+        self._advance()
+        if self.deleted:
+            self._skip_deleted()
+    
+    def seek_block(self, target: int) -> None:
+        """Переход без декодирования к блоку, который может содержать target."""
+        if self.doc < target and self.block_last[self.block] < target:
+            self._load(bisect_left(self.block_last, target, self.block + 1))
+    
+    def seek(self, target: int) -> None:
+        """Переход к первому документу с номером >= target."""
+        while self.doc < target:
+            if self.block_last[self.block] < target:
+                self._load(bisect_left(self.block_last, target, self.block + 1))
+            elif self.numbers is None:
+                self._decode_block()
+            else:
+                self.pos = bisect_left(self.numbers, target, self.pos)
+                self.doc = self.numbers[self.pos]
+        
+        if self.deleted:
+            self._skip_deleted()
+
+
+class InvertedIndex:
+    """
+    Обратный индекс.
+    
+    Состоит из сегмента на диске (IndexSegment, только чтение) и
+    изменяемой части в памяти. Документы сегмента имеют номера 0..N-1,
+    новые документы получают следующие номера, а удаленные и
+    переиндексированные документы сегмента помечаются в deleted, так что
+    списки вхождений обеих частей упорядочены по номеру документа.
+    compact() записывает текущее состояние новым сегментом.
+    """
+    
+    # Сколько документов сегмента держать в памяти после загрузки
+    DOCUMENT_CACHE_SIZE = 10000
+    
+    def __init__(
+        self,
+        segment: Optional[IndexSegment] = None,
+        document_loader: Optional[Callable[[str], Optional[Document]]] = None
+    ):
+        """
+        Инициализация.
+        
+        Args:
+            segment: Сегмент на диске
+            document_loader: Загрузка документа сегмента по ID (для результатов)
+        """
+        self.document_loader = document_loader
         self.lock = threading.RLock()
+        self._reset(segment)
+    
+    def _reset(self, segment: Optional[IndexSegment]) -> None:
+        """Состояние индекса поверх сегмента (изменяемая часть пуста)."""
+        # token -> номер документа -> поле -> частота (изменяемая часть)
+        self.index: Dict[str, Dict[int, Dict[str, int]]] = defaultdict(dict)
+        self.documents: Dict[str, Document] = {}  # Документы изменяемой части
+        self.doc_lengths: Dict[int, int] = {}  # Длина документа в токенах
+        self.segment = segment
+        self.deleted: Set[int] = set()  # Удаленные документы сегмента
+        self._deleted_freqs: Dict[int, int] = {}  # Термин сегмента -> удаленных документов в списке
+        self._doc_numbers: Dict[str, int] = {}
+        self._doc_ids: Dict[int, str] = {}
+        self._document_cache: 'OrderedDict[int, Document]' = OrderedDict()
+        self._segment_docs = segment.doc_count if segment else 0
+        self._next_number = self._segment_docs
+        self.total_docs: int = self._segment_docs
+        self.total_length: int = segment.total_length if segment else 0
+        self.avg_doc_length: float = self.total_length / self.total_docs if self.total_docs else 0.0
+    
+    def _update_stats(self, doc_delta: int, length_delta: int) -> None:
+        self.total_docs += doc_delta
+        self.total_length += length_delta
+        self.avg_doc_length = self.total_length / self.total_docs if self.total_docs else 0.0
+    
+    def get_doc_id(self, number: int) -> str:
+        """ID документа по номеру."""
+        if number < self._segment_docs:
+            return self.segment.doc_id(number)
+        return self._doc_ids[number]
+    
+    def get_doc_length(self, number: int) -> int:
+        """Длина документа в токенах."""
+        if number < self._segment_docs:
+            return self.segment.doc_lengths[number]
+        return self.doc_lengths[number]
+    
+    def get_doc_type(self, number: int) -> DocumentType:
+        """Тип документа."""
+        if number < self._segment_docs:
+            return _DOC_TYPES[self.segment.doc_types[number]]
+        return self.documents[self._doc_ids[number]].doc_type
+    
+    def get_document(self, number: int) -> Optional[Document]:
+        """Документ по номеру (документы сегмента загружаются через document_loader)."""
+        if number >= self._segment_docs:
+            return self.documents.get(self._doc_ids[number])
+        
+        document = self._document_cache.get(number)
+        if document is not None:
+            self._document_cache.move_to_end(number)
+            return document
+        
+        if self.document_loader is None:
+            return None
+        document = self.document_loader(self.segment.doc_id(number))
+        if document is not None:
+            self._document_cache[number] = document
+            if len(self._document_cache) > self.DOCUMENT_CACHE_SIZE:
+                self._document_cache.popitem(last=False)
+        return document
+    
+    def postings(self, token: str) -> List[Tuple[int, Dict[str, int]]]:
+        """
+        Список вхождений токена по обеим частям индекса.
+        
+        Returns:
+            [(номер документа, {поле: частота})] по возрастанию номеров
+        """
+        result = []
+        if self.segment is not None:
+            term = self.segment.find_term(token)
+            if term is not None:
+                result = self.segment.postings(term)
+                if self.deleted:
+                    result = [posting for posting in result if posting[0] not in self.deleted]
+        
+        delta = self.index.get(token)
+        if delta:
+            result.extend(delta.items())
+        return result
+    
+    def _segment_doc_freq(self, term: int) -> int:
+        """
+        Частота документов термина сегмента без удаленных документов.
+        
+        Декодируются только блоки, в которые попадают удаленные номера.
+        """
+        doc_freq = self.segment.term_doc_freqs[term]
+        if not self.deleted:
+            return doc_freq
+        
+        removed = self._deleted_freqs.get(term)
+        if removed is None:
+            first = self.segment.term_blocks[term]
+            block_last = self.segment.block_last[first:self.segment.term_blocks[term + 1]]
+            by_block = defaultdict(list)
+            for number in self.deleted:
+                block = bisect_left(block_last, number)
+                if block < len(block_last):
+                    by_block[block].append(number)
+            
+            removed = 0
+            for block, numbers in by_block.items():
+                block_numbers = set(self.segment.decode_block(first + block, first)[0])
+                removed += sum(1 for number in numbers if number in block_numbers)
+            self._deleted_freqs[term] = removed
+        
+        return doc_freq - removed
     
     def add_document(self, document: Document, tokenizer: TextTokenizer) -> None:
         """
@@ -201,11 +849,7 @@ class InvertedIndex:
             doc_id = document.id
             
             # Удаляем старую версию если существует
-            if doc_id in self.documents:
-                self.remove_document(doc_id)
-            
-            # Сохраняем документ
-            self.documents[doc_id] = document
+            self.remove_document(doc_id)
             
             # Токенизация по полям
             field_tokens = {}
@@ -228,15 +872,22 @@ class InvertedIndex:
                         field_tokens[field.value] = normalized_tokens
                         total_tokens += len(normalized_tokens)
             
+            # Сохраняем документ
+            number = self._next_number
+            self._next_number += 1
+            self.documents[doc_id] = document
+            self._doc_numbers[doc_id] = number
+            self._doc_ids[number] = doc_id
+            
             # Обновляем статистику
-            self.doc_lengths[doc_id] = total_tokens
-            self.total_docs += 1
-            self.avg_doc_length = sum(self.doc_lengths.values()) / self.total_docs
+            self.doc_lengths[number] = total_tokens
+            self._update_stats(1, total_tokens)
             
             # Добавляем токены в индекс
             for field, tokens in field_tokens.items():
                 for token in tokens:
-                    self.index[token][doc_id][field] += 1
+                    field_counts = self.index[token].setdefault(number, {})
+                    field_counts[field] = field_counts.get(field, 0) + 1
     
     def remove_document(self, doc_id: str) -> None:
         """
@@ -246,35 +897,95 @@ class InvertedIndex:
             doc_id: ID документа
         """
         with self.lock:
-            if doc_id not in self.documents:
-                return
-            
-            # Удаляем из индекса
-            tokens_to_remove = []
+            number = self._doc_numbers.pop(doc_id, None)
             
-            for token, doc_data in self.index.items():
-                if doc_id in doc_data:
-                    del doc_data[doc_id]
+            if number is not None:
+                # Удаляем из изменяемой части
+                tokens_to_remove = []
+                
+                for token, doc_data in self.index.items():
+                    if number in doc_data:
+                        del doc_data[number]
+                    
+                    if not doc_data:
+                        tokens_to_remove.append(token)
+                
+                for token in tokens_to_remove:
+                    del self.index[token]
                 
-                if not doc_data:
-                    tokens_to_remove.append(token)
+                del self._doc_ids[number]
+                del self.documents[doc_id]
+                length = self.doc_lengths.pop(number)
+            else:
+                # Документ сегмента только помечается удаленным
+                number = self.segment.find_doc(doc_id) if self.segment is not None else None
+                if number is None or number in self.deleted:
+                    return
+                
+                self.deleted.add(number)
+                self._deleted_freqs.clear()
+                self._document_cache.pop(number, None)
+                length = self.segment.doc_lengths[number]
+            
+            self._update_stats(-1, -length)
+    
+    def compact(self, path: str, generation: int) -> None:
+        """
+        Запись индекса новым сегментом и переход на него.
+        
+        Документы перенумеровываются по порядку ID, изменяемая часть и
+        пометки удаления после этого пусты.
+        
+        Args:
+            path: Путь к файлу сегмента
+            generation: Номер последнего изменения, вошедшего в индекс
+        """
+        with self.lock:
+            live = [
+                (self.segment.doc_id(number), number)
+                for number in range(self._segment_docs)
+                if number not in self.deleted
+            ]
+            live.extend((doc_id, number) for number, doc_id in self._doc_ids.items())
+            live.sort()
+            
+            renumbered = {number: new_number for new_number, (_, number) in enumerate(live)}
+            documents = [
+                (doc_id, self.get_doc_type(number), self.get_doc_length(number))
+                for doc_id, number in live
+            ]
             
-            for token in tokens_to_remove:
-                del self.index[token]
+            segment_terms = (
+                (self.segment.term(i) for i in range(self.segment.term_count))
+                if self.segment is not None else iter(())
+            )
+            terms = (term for term, _ in groupby(heapq.merge(segment_terms, sorted(self.index))))
             
-            # Удаляем из метаданных
-            if doc_id in self.doc_lengths:
-                old_length = self.doc_lengths[doc_id]
-                del self.doc_lengths[doc_id]
-                self.total_docs -= 1
-                
-                if self.total_docs > 0:
-                    self.avg_doc_length = (self.avg_doc_length * (self.total_docs + 1) - old_length) / self.total_docs
-                else:
-                    self.avg_doc_length = 0.0
+            def merged_postings():
+                for term in terms:
+                    term_postings = [
+                        (renumbered[number], field_counts)
+                        for number, field_counts in self.postings(term)
+                    ]
+                    term_postings.sort(key=lambda posting: posting[0])
+                    yield term, term_postings
             
-            if doc_id in self.documents:
-                del self.documents[doc_id]
+            IndexSegment.write(path, generation, documents, merged_postings())
+            
+            segment = IndexSegment.open(path)
+            if segment is None:
+                raise ValueError(f"Written index segment cannot be opened: {path}")
+            
+            previous = self.segment
+            self._reset(segment)
+            if previous is not None:
+                previous.close()
+    
+    def close(self) -> None:
+        """Закрытие сегмента (после этого индекс не используется)."""
+        with self.lock:
+            if self.segment is not None:
+                self.segment.close()
     
     def search(
         self,
@@ -284,11 +995,16 @@ class InvertedIndex:
         doc_type: Optional[DocumentType] = None,
         limit: int = 10,
         offset: int = 0,
-        use_bm25: bool = True
+        use_bm25: bool = True,
+        exhaustive: bool = False
     ) -> List[SearchResult]:
         """
         Поиск по индексу.
         
+        BM25 по умолчанию считается только для лучших offset + limit
+        документов (_search_top_k); результат тот же, что у полного
+        перебора. При равном score выше документ с меньшим номером.
+        
         Args:
             query: Поисковый запрос
             tokenizer: Токенизатор
@@ -297,12 +1013,13 @@ class InvertedIndex:
             limit: Максимальное количество результатов
             offset: Смещение
             use_bm25: Использовать алгоритм BM25
+            exhaustive: Оценивать все документы-кандидаты
             
         Returns:
             Список результатов поиска
         """
         with self.lock:
-            if not query or not self.documents:
+            if not query or not self.total_docs:
                 return []
             
             # Токенизация запроса
@@ -321,62 +1038,25 @@ class InvertedIndex:
             for token in query_tokens:
                 query_term_freq[token] = query_term_freq.get(token, 0) + 1
             
-            # Получаем кандидатов
-            doc_scores = defaultdict(float)
-            doc_matches = defaultdict(set)  # Совпавшие токены для каждого документа
+            if limit <= 0:
+                return []
             
-            for token, token_count in query_term_freq.items():
-                if token not in self.index:
-                    continue
-                
-                # Получаем документы, содержащие токен
-                for doc_id, field_counts in self.index[token].items():
-                    # Фильтр по типу документа
-                    if doc_type and self.documents[doc_id].doc_type != doc_type:
-                        continue
-                    
-                    # Проверяем поля
-                    doc_matches[doc_id].add(token)
-                    
-                    if use_bm25:
-                        # Вычисляем score по BM25
-                        score = self._bm25_score(
-                            token=token,
-                            doc_id=doc_id,
-                            query_token_count=token_count,
-                            field_counts=field_counts,
-                            fields=fields
-                        )
-                        doc_scores[doc_id] += score
-                    else:
-                        # Простой TF-IDF
-                        score = self._tf_idf_score(
-                            token=token,
-                            doc_id=doc_id,
-                            field_counts=field_counts,
-                            fields=fields
-                        )
-                        doc_scores[doc_id] += score * token_count
-            
-            # Сортировка по релевантности
-            sorted_docs = sorted(
-                doc_scores.items(),
-                key=lambda x: x[1],
-                reverse=True
-            )
+            if use_bm25 and not exhaustive:
+                ranked = self._search_top_k(query_term_freq, fields, doc_type, offset + limit)
+            else:
+                ranked = self._search_exhaustive(query_term_freq, fields, doc_type, use_bm25)
             
             # Подготовка результатов
             results = []
-            for i, (doc_id, score) in enumerate(sorted_docs[offset:offset+limit]):
-                if doc_id not in self.documents:
+            for number, score, matched_tokens in ranked[offset:offset+limit]:
+                document = self.get_document(number)
+                if document is None:
                     continue
                 
-                document = self.documents[doc_id]
-                
                 # Генерация подсветки
                 highlights = self._generate_highlights(
                     document=document,
-                    matched_tokens=list(doc_matches[doc_id]),
+                    matched_tokens=matched_tokens,
                     tokenizer=tokenizer,
                     fields=fields
                 )
@@ -393,10 +1073,195 @@ class InvertedIndex:
             
             return results
     
+    def _search_exhaustive(
+        self,
+        query_term_freq: Dict[str, int],
+        fields: Optional[List[SearchField]],
+        doc_type: Optional[DocumentType],
+        use_bm25: bool
+    ) -> List[Tuple[int, float, List[str]]]:
+        """
+        Оценка всех документов, содержащих токены запроса.
+        
+        Returns:
+            [(номер документа, score, совпавшие токены)] по убыванию score
+        """
+        doc_scores = defaultdict(float)
+        doc_matches = defaultdict(list)  # Совпавшие токены для каждого документа
+        
+        for token, token_count in query_term_freq.items():
+            # Получаем документы, содержащие токен
+            postings = self.postings(token)
+            if not postings:
+                continue
+            doc_freq = len(postings)
+            
+            for number, field_counts in postings:
+                # Фильтр по типу документа
+                if doc_type and self.get_doc_type(number) != doc_type:
+                    continue
+                
+                doc_matches[number].append(token)
+                
+                if use_bm25:
+                    # Вычисляем score по BM25
+                    score = self._bm25_score(
+                        doc_freq=doc_freq,
+                        doc_length=self.get_doc_length(number),
+                        query_token_count=token_count,
+                        field_counts=field_counts,
+                        fields=fields
+                    )
+                    doc_scores[number] += score
+                else:
+                    # Простой TF-IDF
+                    score = self._tf_idf_score(
+                        doc_freq=doc_freq,
+                        field_counts=field_counts,
+                        fields=fields
+                    )
+                    doc_scores[number] += score * token_count
+        
+        # Сортировка по релевантности
+        sorted_docs = sorted(doc_scores.items(), key=lambda x: (-x[1], x[0]))
+        return [(number, score, doc_matches[number]) for number, score in sorted_docs]
+    
+    def _search_top_k(
+        self,
+        query_term_freq: Dict[str, int],
+        fields: Optional[List[SearchField]],
+        doc_type: Optional[DocumentType],
+        k: int
+    ) -> List[Tuple[int, float, List[str]]]:
+        """
+        Лучшие k документов по BM25 (документ-за-документом, MaxScore).
+        
+        Термины упорядочены по верхней оценке вклада. Младшие термины,
+        сумма оценок которых не больше порога (score k-го документа в
+        куче), неосновные: кандидаты берутся только из списков основных
+        терминов, а неосновные проверяются, пока кандидат еще может
+        превысить порог. Диапазон до конца ближайшего блока, в котором
+        сумма оценок блоков всех терминов не больше порога, пропускается
+        без декодирования. Score считается через
+        _bm25_score в порядке терминов запроса, поэтому результат
+        совпадает с _search_exhaustive.
+        
+        Returns:
+            [(номер документа, score, совпавшие токены)] по убыванию score
+        """
+        cursors = []
+        for order, (token, token_count) in enumerate(query_term_freq.items()):
+            term = self.segment.find_term(token) if self.segment is not None else None
+            delta = self.index.get(token)
+            doc_freq = self._segment_doc_freq(term) if term is not None else 0
+            doc_freq += len(delta) if delta else 0
+            if not doc_freq:
+                continue
+            
+            cursor = _PostingCursor(self, term, delta)
+            cursor.order = order
+            cursor.token = token
+            cursor.token_count = token_count
+            cursor.doc_freq = doc_freq
+            # Оценка сверху по частоте во всех полях; запас покрывает
+            # ошибки округления при сравнении с порогом
+            cursor.block_bounds = [
+                max(
+                    self._bm25_score(doc_freq, length, token_count, {'all': tf})
+                    for tf, length in impacts
+                ) * (1 + 1e-9) + 1e-12
+                for impacts in cursor.block_impacts
+            ]
+            cursor.bound = max(cursor.block_bounds)
+            cursors.append(cursor)
+        
+        if not cursors:
+            return []
+        
+        cursors.sort(key=lambda cursor: cursor.bound)
+        bound_sums = list(accumulate(cursor.bound for cursor in cursors))
+        
+        heap: List[Tuple[float, int, List[str]]] = []  # (score, -номер, токены)
+        threshold = -1.0
+        essential = 0  # cursors[:essential] — неосновные термины
+        
+        while essential < len(cursors):
+            lists = cursors[essential:]
+            candidate = min(cursor.doc for cursor in lists)
+            if candidate == _END_OF_POSTINGS:
+                break
+            
+            if len(heap) == k:
+                # Оценка по блокам всех терминов, в которые попадает candidate
+                for cursor in cursors[:essential]:
+                    cursor.seek_block(candidate)
+                if sum(cursor.block_bound for cursor in cursors) <= threshold:
+                    # Ни один документ до конца ближайшего блока не превысит порог
+                    target = min(cursor.block_end for cursor in cursors) + 1
+                    for cursor in lists:
+                        cursor.seek(target)
+                    continue
+            
+            undecoded = [cursor for cursor in lists if cursor.doc == candidate and cursor.numbers is None]
+            if undecoded:
+                # candidate — только нижняя граница блока
+                for cursor in undecoded:
+                    cursor.decode()
+                continue
+            
+            if doc_type and self.get_doc_type(candidate) != doc_type:
+                for cursor in lists:
+                    if cursor.doc == candidate:
+                        cursor.next()
+                continue
+            
+            doc_length = self.get_doc_length(candidate)
+            scores = {}
+            partial = 0.0
+            for cursor in lists:
+                if cursor.doc == candidate:
+                    score = self._bm25_score(cursor.doc_freq, doc_length, cursor.token_count, cursor.field_counts, fields)
+                    scores[cursor.order] = (score, cursor.token)
+                    partial += score
+                    cursor.next()
+            
+            for i in range(essential - 1, -1, -1):
+                if partial + bound_sums[i] <= threshold:
+                    break
+                cursor = cursors[i]
+                cursor.seek(candidate)
+                if cursor.doc == candidate:
+                    cursor.decode()
+                if cursor.doc == candidate:
+                    score = self._bm25_score(cursor.doc_freq, doc_length, cursor.token_count, cursor.field_counts, fields)
+                    scores[cursor.order] = (score, cursor.token)
+                    partial += score
+            else:
+                matched = [scores[order] for order in sorted(scores)]
+                total = 0.0
+                for score, _ in matched:
+                    total += score
+                entry = (total, -candidate, [token for _, token in matched])
+                
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+                else:
+                    continue
+                
+                if len(heap) == k:
+                    threshold = heap[0][0]
+                    while essential < len(cursors) and bound_sums[essential] <= threshold:
+                        essential += 1
+        
+        heap.sort(reverse=True)
+        return [(-negative_number, score, tokens) for score, negative_number, tokens in heap]
+    
     def _bm25_score(
         self,
-        token: str,
-        doc_id: str,
+        doc_freq: int,
+        doc_length: int,
         query_token_count: int,
         field_counts: Dict[str, int],
         fields: Optional[List[SearchField]] = None,
@@ -407,8 +1272,8 @@ class InvertedIndex:
         Вычисление релевантности по алгоритму BM25.
         
         Args:
-            token: Токен
-            doc_id: ID документа
+            doc_freq: Количество документов с токеном
+            doc_length: Длина документа в токенах
             query_token_count: Количество токенов в запросе
             field_counts: Частоты токена в полях документа
             fields: Поля для поиска
@@ -419,7 +1284,6 @@ class InvertedIndex:
             Score по BM25
         """
         # IDF (Inverse Document Frequency)
-        doc_freq = len(self.index[token])
         idf = math.log((self.total_docs - doc_freq + 0.5) / (doc_freq + 0.5) + 1.0)
         
         if idf <= 0:
@@ -434,9 +1298,6 @@ class InvertedIndex:
         else:
             total_tf = sum(field_counts.values())
         
-        # Длина документа
-        doc_length = self.doc_lengths.get(doc_id, 0)
-        
         # Вычисление BM25
         tf_norm = total_tf / (1 - b + b * (doc_length / self.avg_doc_length))
         bm25 = idf * (tf_norm * (k1 + 1)) / (tf_norm + k1)
@@ -445,8 +1306,7 @@ class InvertedIndex:
     
     def _tf_idf_score(
         self,
-        token: str,
-        doc_id: str,
+        doc_freq: int,
         field_counts: Dict[str, int],
         fields: Optional[List[SearchField]] = None
     ) -> float:
@@ -454,8 +1314,7 @@ class InvertedIndex:
         Вычисление релевантности по TF-IDF.
         
         Args:
-            token: Токен
-            doc_id: ID документа
+            doc_freq: Количество документов с токеном
             field_counts: Частоты токена в полях документа
             fields: Поля для поиска
             
@@ -475,7 +1334,6 @@ class InvertedIndex:
             return 0.0
         
         # IDF (Inverse Document Frequency)
-        doc_freq = len(self.index[token])
         if doc_freq == 0:
             return 0.0
         
@@ -561,21 +1419,55 @@ class InvertedIndex:
     def get_stats(self) -> Dict[str, Any]:
         """Получение статистики индекса."""
         with self.lock:
+            document_types = Counter(doc.doc_type.value for doc in self.documents.values())
+            total_tokens = len(self.index)
+            
+            if self.segment is not None:
+                type_codes = Counter(self.segment.doc_types)
+                type_codes.subtract(self.segment.doc_types[number] for number in self.deleted)
+                document_types.update({
+                    _DOC_TYPES[code].value: count for code, count in type_codes.items() if count > 0
+                })
+                total_tokens = self.segment.term_count + sum(
+                    1 for token in self.index if self.segment.find_term(token) is None
+                )
+            
             return {
                 'total_documents': self.total_docs,
-                'total_tokens': len(self.index),
+                'total_tokens': total_tokens,
                 'avg_document_length': self.avg_doc_length,
-                'document_types': Counter(
-                    doc.doc_type.value for doc in self.documents.values()
-                )
+                'document_types': document_types
             }
 
 
 class SearchIndexStorage:
-    """Постоянное хранилище индекса."""
+    """
+    Постоянное хранилище индекса.
+    
+    Документы хранятся в SQLite, обратный индекс — сегментом на диске
+    (IndexSegment, по умолчанию рядом с БД). Изменения документов
+    записываются в журнал index_changes; сегмент помнит номер последнего
+    вошедшего в него изменения, и при запуске применяются только более
+    поздние.
     
-    def __init__(self, db_path: str = "search_index.db"):
+    Каждый движок поиска отмечает в index_readers, до какого изменения
+    его индекс актуален; журнал очищается только до наименьшей отметки.
+    """
+    
+    # Через сколько секунд без отметки читатель не удерживает журнал
+    READER_TTL = 24 * 3600
+    
+    def __init__(self, db_path: str = "search_index.db", index_path: Optional[str] = None):
+        """
+        Инициализация.
+        
+        Args:
+            db_path: Путь к БД
+            index_path: Путь к сегменту индекса (None — рядом с БД;
+                для ':memory:' индекс не сохраняется)
+        """
         self.db_path = db_path
+        self.index_path = index_path or (f"{db_path}.idx" if db_path != ":memory:" else None)
         self._init_database()
     
     def _init_database(self):
@@ -612,6 +1504,40 @@ class SearchIndexStorage:
                 )
             """)
             
+            # Журнал изменений документов (для догрузки в сегмент индекса)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS index_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    doc_id TEXT NOT NULL
+                )
+            """)
+            
+            # До какого изменения журнал очищен
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS index_journal (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    pruned_through INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            # Для старой БД журнал мог быть уже очищен до первой записи
+            cursor.execute("""
+                INSERT OR IGNORE INTO index_journal (id, pruned_through)
+                SELECT 1, COALESCE(
+                    (SELECT MIN(seq) - 1 FROM index_changes),
+                    (SELECT seq FROM sqlite_sequence WHERE name = 'index_changes'),
+                    0
+                )
+            """)
+            
+            # Движки поиска и номера изменений, до которых их индексы актуальны
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS index_readers (
+                    reader_id TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            
             # Индексы
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_tokens_token ON tokens(token)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_type ON documents(doc_type)")
@@ -652,6 +1578,7 @@ class SearchIndexStorage:
                     document.created_at,
                     document.updated_at
                 ))
+                self.record_change(cursor, document.id)
                 
                 conn.commit()
                 return True
@@ -660,6 +1587,166 @@ class SearchIndexStorage:
             logger.error(f"Error saving document {document.id}: {e}")
             return False
     
+    @staticmethod
+    def record_change(cursor: sqlite3.Cursor, doc_id: str) -> None:
+        """Запись изменения документа в журнал (в транзакции вызывающего)."""
+        cursor.execute("INSERT INTO index_changes (doc_id) VALUES (?)", (doc_id,))
+    
+    def get_generation(self) -> int:
+        """Номер последнего изменения документов."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'index_changes'")
+                row = cursor.fetchone()
+                return row['seq'] if row else 0
+        
+        except Exception as e:
+            logger.error(f"Error getting index generation: {e}")
+            return 0
+    
+    def get_changes_since(self, generation: int) -> Tuple[List[str], int]:
+        """
+        Документы, измененные после указанного изменения.
+        
+        Args:
+            generation: Номер изменения
+        
+        Returns:
+            (ID документов без повторов в порядке последнего изменения,
+            номер последнего прочитанного изменения)
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT doc_id, MAX(seq) AS seq FROM index_changes
+                    WHERE seq > ?
+                    GROUP BY doc_id
+                    ORDER BY MAX(seq)
+                """, (generation,))
+                rows = cursor.fetchall()
+                return [row['doc_id'] for row in rows], (rows[-1]['seq'] if rows else generation)
+        
+        except Exception as e:
+            logger.error(f"Error loading index changes: {e}")
+            return [], generation
+    
+    def prune_changes(self, generation: int) -> None:
+        """
+        Удаление из журнала изменений, вошедших в сегмент.
+        
+        Изменения, еще нужные другим движкам поиска (их отметка в
+        index_readers меньше generation), остаются в журнале.
+        
+        Args:
+            generation: Номер изменения, вошедшего в записанный сегмент
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                
+                cutoff = time.time() - self.READER_TTL
+                cursor.execute("DELETE FROM index_readers WHERE updated_at < ?", (cutoff,))
+                cursor.execute("SELECT MIN(generation) AS generation FROM index_readers")
+                needed = cursor.fetchone()['generation']
+                if needed is not None:
+                    generation = min(generation, needed)
+                
+                cursor.execute("DELETE FROM index_changes WHERE seq <= ?", (generation,))
+                cursor.execute(
+                    "UPDATE index_journal SET pruned_through = MAX(pruned_through, ?) WHERE id = 1",
+                    (generation,)
+                )
+                conn.commit()
+        
+        except Exception as e:
+            logger.error(f"Error pruning index changes: {e}")
+    
+    def get_pruned_generation(self) -> int:
+        """Номер изменения, до которого включительно журнал очищен."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT pruned_through FROM index_journal WHERE id = 1")
+                row = cursor.fetchone()
+                return row['pruned_through'] if row else 0
+        
+        except Exception as e:
+            logger.error(f"Error getting pruned index generation: {e}")
+            return 0
+    
+    def update_reader(self, reader_id: str, generation: int) -> None:
+        """Отметка изменения, до которого индекс движка поиска актуален."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT OR REPLACE INTO index_readers (reader_id, generation, updated_at)
+                    VALUES (?, ?, ?)
+                """, (reader_id, generation, time.time()))
+                conn.commit()
+        
+        except Exception as e:
+            logger.error(f"Error updating index reader {reader_id}: {e}")
+    
+    def remove_reader(self, reader_id: str) -> None:
+        """Снятие отметки движка поиска (журнал больше не удерживается)."""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM index_readers WHERE reader_id = ?", (reader_id,))
+                conn.commit()
+        
+        except Exception as e:
+            logger.error(f"Error removing index reader {reader_id}: {e}")
+    
+    @staticmethod
+    def _row_to_document(row: sqlite3.Row) -> Document:
+        return Document(
+            id=row['id'],
+            doc_type=DocumentType(row['doc_type']),
+            title=row['title'],
+            content=row['content'],
+            fields=json.loads(row['fields']) if row['fields'] else {},
+            metadata=json.loads(row['metadata']) if row['metadata'] else {},
+            language=row['language'],
+            boost=row['boost'],
+            created_at=row['created_at'],
+            updated_at=row['updated_at']
+        )
+    
+    def load_documents(self, doc_ids: Optional[List[str]] = None) -> Iterator[Document]:
+        """
+        Потоковая загрузка документов одним запросом (на пачку ID).
+        
+        Args:
+            doc_ids: ID документов (None — все документы)
+        
+        Returns:
+            Итератор документов
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if doc_ids is None:
+                    cursor.execute("SELECT * FROM documents")
+                    for row in cursor:
+                        yield self._row_to_document(row)
+                    return
+                
+                for start in range(0, len(doc_ids), 500):
+                    chunk = doc_ids[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    cursor.execute(f"SELECT * FROM documents WHERE id IN ({placeholders})", chunk)
+                    for row in cursor.fetchall():
+                        yield self._row_to_document(row)
+        
+        except Exception as e:
+            logger.error(f"Error loading documents: {e}")
+    
     def load_document(self, doc_id: str) -> Optional[Document]:
         """Загрузка документа."""
         try:
@@ -672,18 +1759,7 @@ class SearchIndexStorage:
                 
                 row = cursor.fetchone()
                 if row:
-                    return Document(
-                        id=row['id'],
-                        doc_type=DocumentType(row['doc_type']),
-                        title=row['title'],
-                        content=row['content'],
-                        fields=json.loads(row['fields']) if row['fields'] else {},
-                        metadata=json.loads(row['metadata']) if row['metadata'] else {},
-                        language=row['language'],
-                        boost=row['boost'],
-                        created_at=row['created_at'],
-                        updated_at=row['updated_at']
-                    )
+                    return self._row_to_document(row)
                 
                 return None
                 
@@ -753,44 +1829,94 @@ class SearchEngine:
     
     def __init__(self, storage: Optional[SearchIndexStorage] = None):
         self.storage = storage or SearchIndexStorage()
-        self.in_memory_index = InvertedIndex()
+        self.in_memory_index = InvertedIndex(document_loader=self.storage.load_document)
         self.tokenizers: Dict[str, TextTokenizer] = {}
         self._index_loaded = False
+        # Номер последнего изменения, до которого включительно все
+        # изменения документов отражены в in_memory_index
+        self._applied_generation = 0
+        self._reader_id = uuid.uuid4().hex
         self.lock = threading.RLock()
         
         # Загрузка индекса в память
         self._load_index_to_memory()
     
     def _load_index_to_memory(self):
-        """Загрузка индекса из хранилища в память."""
+        """
+        Загрузка индекса.
+        
+        Сегмент на диске отображается в память, поверх него применяются
+        изменения документов, сделанные после его записи. Если сегмента
+        нет (или он не соответствует БД), индекс строится заново и
+        сохраняется.
+        """
         if self._index_loaded:
             return
         
         try:
-            with self.storage._get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Загружаем документы
-                cursor.execute("SELECT id FROM documents")
-                doc_ids = [row['id'] for row in cursor.fetchall()]
-                
-                logger.info(f"Loading {len(doc_ids)} documents to memory...")
+            index_path = self.storage.index_path
+            segment = None
+            if index_path and os.path.exists(index_path):
+                segment = IndexSegment.open(index_path)
+                if segment is not None and segment.generation > self.storage.get_generation():
+                    logger.warning(f"Index segment is newer than the database, rebuilding: {index_path}")
+                    segment.close()
+                    segment = None
                 
-                for i, doc_id in enumerate(doc_ids):
-                    if i % 1000 == 0:
-                        logger.debug(f"Loaded {i} documents...")
-                    
-                    document = self.storage.load_document(doc_id)
-                    if document:
-                        tokenizer = self._get_tokenizer(document.language)
-                        self.in_memory_index.add_document(document, tokenizer)
-                
-                self._index_loaded = True
-                logger.info(f"Index loaded to memory: {len(doc_ids)} documents")
+                if segment is not None:
+                    # Отметка до чтения журнала: другие движки не очистят
+                    # изменения, которые еще нужно применить к сегменту
+                    self._set_applied_generation(segment.generation)
+                    if self.storage.get_pruned_generation() > segment.generation:
+                        logger.warning(f"Index segment is older than the change journal, rebuilding: {index_path}")
+                        segment.close()
+                        segment = None
+            
+            if segment is None:
+                self.rebuild_index()
+                return
+            
+            index = InvertedIndex(segment, self.storage.load_document)
+            applied = self._apply_changes(index, segment.generation)
+            
+            self.in_memory_index = index
+            self._index_loaded = True
+            logger.info(f"Index loaded: {index.total_docs} documents, {applied} changes applied")
                 
         except Exception as e:
             logger.error(f"Error loading index to memory: {e}")
     
+    def _apply_changes(self, index: InvertedIndex, generation: int) -> int:
+        """
+        Применение к индексу изменений документов после generation.
+        
+        Документы перечитываются из БД, поэтому повторное применение
+        изменения (например, сделанного этим же процессом) безвредно.
+        
+        Args:
+            index: Индекс
+            generation: Номер изменения, до которого индекс актуален
+        
+        Returns:
+            Количество примененных изменений
+        """
+        changed, last_seq = self.storage.get_changes_since(generation)
+        documents = {document.id: document for document in self.storage.load_documents(changed)} if changed else {}
+        
+        for doc_id in changed:
+            index.remove_document(doc_id)
+            document = documents.get(doc_id)
+            if document:
+                index.add_document(document, self._get_tokenizer(document.language))
+        
+        self._set_applied_generation(last_seq)
+        return len(changed)
+    
+    def _set_applied_generation(self, generation: int) -> None:
+        """Запоминание (и отметка в БД) изменения, до которого индекс актуален."""
+        self._applied_generation = generation
+        self.storage.update_reader(self._reader_id, generation)
+    
     def _get_tokenizer(self, language: str) -> TextTokenizer:
         """
         Получение токенизатора для языка.
@@ -935,6 +2061,8 @@ class SearchEngine:
                         (doc_id,)
                     )
                     
+                    self.storage.record_change(cursor, doc_id)
+                    
                     conn.commit()
                 
                 logger.info(f"Document deleted from index: {doc_id}")
@@ -1010,36 +2138,84 @@ class SearchEngine:
         """
         Перестроение индекса.
         
+        Документы читаются одним запросом, индекс сохраняется сегментом.
+        
         Returns:
             True если успешно
         """
         with self.lock:
             try:
                 logger.info("Starting index rebuild...")
+                generation = self.storage.get_generation()
                 
                 # Создаем новый memory index
-                new_index = InvertedIndex()
+                new_index = InvertedIndex(document_loader=self.storage.load_document)
                 
                 # Загружаем все документы из хранилища
-                with self.storage._get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT id FROM documents")
-                    
-                    doc_ids = [row['id'] for row in cursor.fetchall()]
-                    
-                    for doc_id in doc_ids:
-                        document = self.storage.load_document(doc_id)
-                        if document:
-                            tokenizer = self._get_tokenizer(document.language)
-                            new_index.add_document(document, tokenizer)
+                for document in self.storage.load_documents():
+                    tokenizer = self._get_tokenizer(document.language)
+                    new_index.add_document(document, tokenizer)
+                
+                if self.storage.index_path:
+                    new_index.compact(self.storage.index_path, generation)
+                    self.storage.prune_changes(generation)
                 
                 # Заменяем старый индекс
+                previous = self.in_memory_index
                 self.in_memory_index = new_index
+                self._set_applied_generation(generation)
                 self._index_loaded = True
+                previous.close()
                 
-                logger.info(f"Index rebuilt: {len(doc_ids)} documents")
+                logger.info(f"Index rebuilt: {new_index.total_docs} documents")
                 return True
                 
             except Exception as e:
                 logger.error(f"Error rebuilding index: {e}")
-                return False
\ No newline at end of file
+                return False
+    
+    def save_index(self) -> bool:
+        """
+        Сохранение индекса сегментом на диске.
+        
+        Изменения, накопленные в памяти после загрузки, переносятся в
+        новый сегмент, и при следующем запуске их не нужно применять.
+        Изменения других процессов, еще не попавшие в индекс, сначала
+        догружаются из журнала; сегмент помечается и журнал очищается
+        только до последнего реально примененного изменения. Если журнал
+        уже очищен дальше (движок долго не отмечался), индекс сначала
+        перечитывается с сегмента на диске.
+        
+        Returns:
+            True если успешно
+        """
+        if not self.storage.index_path:
+            return False
+        
+        with self.lock:
+            try:
+                if self.storage.get_pruned_generation() > self._applied_generation:
+                    logger.warning("Change journal no longer covers the in-memory index, reloading it")
+                    previous = self.in_memory_index
+                    self._index_loaded = False
+                    self._load_index_to_memory()
+                    if not self._index_loaded:
+                        return False
+                    if self.in_memory_index is not previous:
+                        previous.close()
+                
+                self._apply_changes(self.in_memory_index, self._applied_generation)
+                generation = self._applied_generation
+                self.in_memory_index.compact(self.storage.index_path, generation)
+                self.storage.prune_changes(generation)
+                return True
+            
+            except Exception as e:
+                logger.error(f"Error saving index: {e}")
+                return False
+    
+    def close(self) -> None:
+        """Закрытие движка: отметка в журнале снимается, сегмент закрывается."""
+        with self.lock:
+            self.storage.remove_reader(self._reader_id)
+            self.in_memory_index.close()
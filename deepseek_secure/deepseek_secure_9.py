@@ -5,11 +5,13 @@ from typing import Any, Dict, List, Optional, Union, Callable
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from enum import Enum
+from array import array
 import json
+import re
 import sqlite3
 from contextlib import contextmanager
 import logging
-from collections import deque, defaultdict
+from collections import defaultdict
 import psutil
 import asyncio
 
@@ -99,8 +101,82 @@ class AggregatedMetric:
         }
 
 
+@dataclass(frozen=True)
+class MetricSeries:
+    """Описание временного ряда: всё, что не меняется от семпла к семплу."""
+    series_id: int
+    name: str
+    type: MetricType
+    tags: Dict[str, str]
+    description: Optional[str] = None
+
+
+class MetricBatch:
+    """
+    Пачка семплов, извлеченная из буфера.
+    
+    Колонки отдаются как memoryview поверх массивов буфера без копирования;
+    при наличии NumPy их можно обернуть через numpy.frombuffer.
+    """
+    
+    def __init__(
+        self,
+        buffer: 'MetricBuffer',
+        columns: tuple,
+        count: int,
+        series: List[MetricSeries]
+    ):
+        self._buffer = buffer
+        self._columns = columns
+        self._count = count
+        self.series = series
+        series_ids, timestamps, values = columns
+        self.series_ids = memoryview(series_ids)[:count]
+        self.timestamps = memoryview(timestamps)[:count]
+        self.values = memoryview(values)[:count]
+    
+    def __len__(self) -> int:
+        return self._count
+    
+    def rows(self):
+        """Итератор по кортежам (series, timestamp, value)."""
+        series = self.series
+        for series_id, ts, value in zip(self.series_ids, self.timestamps, self.values):
+            yield series[series_id], ts, value
+    
+    def to_metrics(self) -> List[Metric]:
+        """Материализация пачки в объекты Metric (для совместимости)."""
+        return [
+            Metric(
+                name=s.name,
+                type=s.type,
+                value=value,
+                timestamp=datetime.fromtimestamp(ts),
+                tags=dict(s.tags),
+                description=s.description
+            )
+            for s, ts, value in self.rows()
+        ]
+    
+    def release(self) -> None:
+        """Возврат массивов в буфер для повторного использования."""
+        if self._columns is None:
+            return
+        self.series_ids.release()
+        self.timestamps.release()
+        self.values.release()
+        self._buffer._recycle(self._columns)
+        self._columns = None
+
+
 class MetricBuffer:
-    """Буфер для временного хранения метрик."""
+    """
+    Кольцевой буфер семплов метрик фиксированной емкости.
+    
+    Семплы хранятся в параллельных типизированных массивах
+    (series_id, timestamp float64, value float64), а имя, тип, теги
+    и описание вынесены в реестр рядов и хранятся один раз на ряд.
+    """
     
     def __init__(self, max_size: int = 10000):
         """
@@ -110,62 +186,197 @@ class MetricBuffer:
             max_size: Максимальное количество метрик в буфере
         """
         self.max_size = max_size
-        self.buffer: deque[Metric] = deque(maxlen=max_size)
-        self.lock = threading.RLock()
+        self._columns = self._allocate()
+        self._spare: Optional[tuple] = None
+        self._count = 0
+        # Короткая блокировка только на резервирование слота и запись трех чисел
+        self.lock = threading.Lock()
+        self._series_lock = threading.Lock()
+        self._series_index: Dict[tuple, int] = {}
+        self._series: List[MetricSeries] = []
         self._dropped_metrics = 0
     
-    def add(self, metric: Metric) -> bool:
+    def _allocate(self) -> tuple:
+        """Выделение набора колонок заданной емкости."""
+        return (
+            array('q', bytes(8 * self.max_size)),
+            array('d', bytes(8 * self.max_size)),
+            array('d', bytes(8 * self.max_size))
+        )
+    
+    def _recycle(self, columns: tuple) -> None:
+        """Прием колонок из освобожденной пачки."""
+        with self.lock:
+            if self._spare is None:
+                self._spare = columns
+    
+    def register_series(
+        self,
+        name: str,
+        type: MetricType,
+        tags: Optional[Dict[str, str]] = None,
+        description: Optional[str] = None
+    ) -> int:
         """
-        Добавление метрики в буфер.
+        Получение идентификатора ряда (с регистрацией при первом обращении).
+        
+        Returns:
+            series_id для быстрого добавления через append
+        """
+        key = (name, type, tuple(sorted(tags.items())) if tags else ())
+        series_id = self._series_index.get(key)
+        if series_id is not None:
+            return series_id
+        
+        with self._series_lock:
+            series_id = self._series_index.get(key)
+            if series_id is None:
+                series_id = len(self._series)
+                self._series.append(MetricSeries(
+                    series_id=series_id,
+                    name=name,
+                    type=type,
+                    tags=dict(tags) if tags else {},
+                    description=description
+                ))
+                self._series_index[key] = series_id
+            return series_id
+    
+    def get_series(self, series_id: int) -> MetricSeries:
+        """Описание ряда по идентификатору."""
+        return self._series[series_id]
+    
+    def append(self, series_id: int, value: float, timestamp: Optional[float] = None) -> bool:
+        """
+        Добавление семпла в уже зарегистрированный ряд.
         
         Args:
-            metric: Метрика для добавления
+            series_id: Идентификатор ряда
+            value: Значение
+            timestamp: Unix-время семпла (по умолчанию текущее)
             
         Returns:
             True если успешно добавлено
         """
+        if timestamp is None:
+            timestamp = time.time()
+        
         with self.lock:
-            if len(self.buffer) >= self.max_size:
+            index = self._count
+            if index >= self.max_size:
                 self._dropped_metrics += 1
-                logger.warning(f"Metric buffer full, dropped {self._dropped_metrics} metrics")
-                return False
+                dropped = self._dropped_metrics
+            else:
+                series_ids, timestamps, values = self._columns
+                series_ids[index] = series_id
+                timestamps[index] = timestamp
+                values[index] = value
+                self._count = index + 1
+                return True
+        
+        logger.warning(f"Metric buffer full, dropped {dropped} metrics")
+        return False
+    
+    def add(self, metric: Metric) -> bool:
+        """
+        Добавление метрики в буфер.
+        
+        Args:
+            metric: Метрика для добавления
             
-            self.buffer.append(metric)
-            return True
+        Returns:
+            True если успешно добавлено
+        """
+        series_id = self.register_series(
+            metric.name, metric.type, metric.tags, metric.description
+        )
+        return self.append(series_id, metric.value, metric.timestamp.timestamp())
     
-    def take_all(self) -> List[Metric]:
+    def take_all(self) -> MetricBatch:
         """
         Извлечение всех метрик из буфера.
         
+        Заполненные массивы передаются в пачку без копирования, а запись
+        продолжается в запасной набор колонок. После сохранения пачку
+        следует освободить через release().
+        
         Returns:
-            Список всех метрик в буфере
+            Пачка всех семплов в буфере
         """
         with self.lock:
-            metrics = list(self.buffer)
-            self.buffer.clear()
-            return metrics
+            columns, count = self._columns, self._count
+            self._columns = self._spare or self._allocate()
+            self._spare = None
+            self._count = 0
+        
+        return MetricBatch(self, columns, count, self._series)
     
     def size(self) -> int:
         """Текущий размер буфера."""
-        with self.lock:
-            return len(self.buffer)
+        return self._count
     
     def get_stats(self) -> Dict[str, Any]:
         """Статистика буфера."""
-        with self.lock:
-            return {
-                'current_size': len(self.buffer),
-                'max_size': self.max_size,
-                'dropped_metrics': self._dropped_metrics,
-                'usage_percent': (len(self.buffer) / self.max_size) * 100
-            }
+        count = self._count
+        return {
+            'current_size': count,
+            'max_size': self.max_size,
+            'series_count': len(self._series),
+            'dropped_metrics': self._dropped_metrics,
+            'usage_percent': (count / self.max_size) * 100
+        }
+
+
+@dataclass(frozen=True)
+class RollupTier:
+    """Уровень даунсэмплинга: ширина бакета и срок хранения."""
+    name: str
+    seconds: int
+    retention_days: int
+    
+    @property
+    def table(self) -> str:
+        return f"rollup_{self.name}"
+
+
+# Уровни от мелкого к крупному
+ROLLUP_TIERS = (
+    RollupTier(name="1m", seconds=60, retention_days=7),
+    RollupTier(name="1h", seconds=3600, retention_days=90),
+    RollupTier(name="1d", seconds=86400, retention_days=730),
+)
+
+# Агрегации, которые можно получить из бакетов (count, sum, min, max, last)
+ROLLUP_AGGREGATIONS = {
+    AggregationMethod.SUM,
+    AggregationMethod.AVG,
+    AggregationMethod.MIN,
+    AggregationMethod.MAX,
+    AggregationMethod.COUNT,
+    AggregationMethod.LAST,
+}
 
 
 class MetricStorage:
     """Постоянное хранилище метрик."""
     
-    def __init__(self, db_path: str = "metrics.db"):
+    def __init__(
+        self,
+        db_path: str = "metrics.db",
+        tiers: tuple = ROLLUP_TIERS,
+        max_points: int = 720
+    ):
+        """
+        Инициализация хранилища.
+        
+        Args:
+            db_path: Путь к файлу БД
+            tiers: Уровни даунсэмплинга от мелкого к крупному
+            max_points: Число точек на график, если шаг не задан явно
+        """
         self.db_path = db_path
+        self.tiers = tiers
+        self.max_points = max_points
         self._init_database()
     
     def _init_database(self):
@@ -206,6 +417,35 @@ class MetricStorage:
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_metrics_timestamp ON raw_metrics(timestamp)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_agg_metrics ON aggregated_metrics(name, aggregation, timestamp)")
             
+            # Таблицы даунсэмплинга: один бакет на (имя, теги, начало интервала)
+            for tier in self.tiers:
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {tier.table} (
+                        name TEXT NOT NULL,
+                        tags TEXT NOT NULL,
+                        type TEXT NOT NULL,
+                        bucket INTEGER NOT NULL,
+                        count INTEGER NOT NULL,
+                        sum REAL NOT NULL,
+                        min REAL NOT NULL,
+                        max REAL NOT NULL,
+                        last REAL NOT NULL,
+                        last_ts REAL NOT NULL,
+                        PRIMARY KEY (name, tags, bucket)
+                    ) WITHOUT ROWID
+                """)
+                cursor.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{tier.table}_bucket ON {tier.table}(bucket)"
+                )
+            
+            # Пустые (новые) уровни заполняются из уже накопленных сырых метрик
+            empty_tiers = tuple(
+                tier for tier in self.tiers
+                if cursor.execute(f"SELECT 1 FROM {tier.table} LIMIT 1").fetchone() is None
+            )
+            if empty_tiers:
+                self._backfill_rollups(conn, empty_tiers)
+            
             # Таблица для конфигурации метрик
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS metric_configs (
@@ -262,6 +502,17 @@ class MetricStorage:
                         metric.description
                     ))
                 
+                self._update_rollups(conn, (
+                    (
+                        metric.name,
+                        metric.type.value,
+                        json.dumps(metric.tags, sort_keys=True),
+                        metric.timestamp.timestamp(),
+                        metric.value
+                    )
+                    for metric in metrics
+                ))
+                
                 conn.commit()
                 return len(metrics)
                 
@@ -269,6 +520,227 @@ class MetricStorage:
             logger.error(f"Error saving metrics: {e}")
             return 0
     
+    def save_batch(self, batch: MetricBatch) -> int:
+        """
+        Сохранение пачки семплов из буфера одной транзакцией.
+        
+        Args:
+            batch: Пачка, полученная из MetricBuffer.take_all
+            
+        Returns:
+            Количество сохраненных метрик
+        """
+        if not len(batch):
+            return 0
+        
+        # Теги сериализуются один раз на ряд, а не на каждый семпл
+        tags_json: Dict[int, Optional[str]] = {}
+        rollup_tags: Dict[int, str] = {}
+        
+        def rows():
+            for series, ts, value in batch.rows():
+                if series.series_id not in tags_json:
+                    tags_json[series.series_id] = json.dumps(series.tags) if series.tags else None
+                yield (
+                    series.name,
+                    series.type.value,
+                    value,
+                    datetime.fromtimestamp(ts),
+                    tags_json[series.series_id],
+                    series.description
+                )
+        
+        def samples():
+            for series, ts, value in batch.rows():
+                if series.series_id not in rollup_tags:
+                    rollup_tags[series.series_id] = json.dumps(series.tags, sort_keys=True)
+                yield series.name, series.type.value, rollup_tags[series.series_id], ts, value
+        
+        try:
+            with self._get_connection() as conn:
+                conn.executemany("""
+                    INSERT INTO raw_metrics 
+                    (name, type, value, timestamp, tags, description)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, rows())
+                self._update_rollups(conn, samples())
+                conn.commit()
+                return len(batch)
+                
+        except Exception as e:
+            logger.error(f"Error saving metrics batch: {e}")
+            return 0
+    
+    def _backfill_rollups(self, conn: sqlite3.Connection, tiers: tuple, chunk_size: int = 50000) -> int:
+        """
+        Заполнение уровней даунсэмплинга из таблицы raw_metrics.
+        
+        Args:
+            conn: Открытое соединение (коммит делает вызывающий)
+            tiers: Заполняемые уровни
+            chunk_size: Сколько сырых строк сворачивать за один проход
+        
+        Returns:
+            Количество обработанных сырых метрик
+        """
+        cursor = conn.execute("SELECT name, type, tags, timestamp, value FROM raw_metrics ORDER BY id")
+        total = 0
+        
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            
+            self._update_rollups(conn, (
+                (
+                    row['name'],
+                    row['type'],
+                    json.dumps(json.loads(row['tags']) if row['tags'] else {}, sort_keys=True),
+                    datetime.fromisoformat(row['timestamp']).timestamp(),
+                    row['value']
+                )
+                for row in rows
+            ), tiers)
+            total += len(rows)
+        
+        if total:
+            logger.info(f"Backfilled {total} raw metrics into rollup tiers {[tier.name for tier in tiers]}")
+        return total
+    
+    def _update_rollups(self, conn: sqlite3.Connection, samples, tiers: Optional[tuple] = None) -> None:
+        """
+        Даунсэмплинг семплов во все уровни в рамках текущей транзакции.
+        
+        Args:
+            conn: Открытое соединение (коммит делает вызывающий)
+            samples: Итератор кортежей (name, type, tags_json, unix_ts, value)
+            tiers: Обновляемые уровни (None — все)
+        """
+        tiers = self.tiers if tiers is None else tiers
+        
+        # Сначала сворачиваем пачку в памяти, чтобы на каждый бакет был один UPSERT
+        partials: Dict[tuple, list] = {}
+        for name, metric_type, tags, ts, value in samples:
+            for tier in tiers:
+                bucket = int(ts // tier.seconds) * tier.seconds
+                key = (tier.table, name, tags, bucket)
+                acc = partials.get(key)
+                if acc is None:
+                    partials[key] = [metric_type, 1, value, value, value, value, ts]
+                else:
+                    acc[1] += 1
+                    acc[2] += value
+                    if value < acc[3]:
+                        acc[3] = value
+                    if value > acc[4]:
+                        acc[4] = value
+                    if ts >= acc[6]:
+                        acc[5] = value
+                        acc[6] = ts
+        
+        by_table: Dict[str, List[tuple]] = defaultdict(list)
+        for (table, name, tags, bucket), acc in partials.items():
+            by_table[table].append((name, tags, acc[0], bucket, *acc[1:]))
+        
+        for table, rows in by_table.items():
+            conn.executemany(f"""
+                INSERT INTO {table}
+                (name, tags, type, bucket, count, sum, min, max, last, last_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(name, tags, bucket) DO UPDATE SET
+                    count = count + excluded.count,
+                    sum = sum + excluded.sum,
+                    min = MIN(min, excluded.min),
+                    max = MAX(max, excluded.max),
+                    last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last ELSE last END,
+                    last_ts = MAX(last_ts, excluded.last_ts)
+            """, rows)
+    
+    def select_tier(self, start_time: datetime, step_seconds: Optional[int]) -> Optional[RollupTier]:
+        """
+        Выбор самого крупного уровня, который удовлетворяет шагу и диапазону.
+        
+        Уровень подходит, если его бакет не шире запрошенного шага и
+        данные за начало диапазона еще не удалены по сроку хранения.
+        
+        Args:
+            start_time: Начало временного диапазона
+            step_seconds: Требуемый шаг (None — сырые данные)
+            
+        Returns:
+            Уровень даунсэмплинга или None, если нужны сырые метрики
+        """
+        if not step_seconds:
+            return None
+        
+        candidates = [tier for tier in self.tiers if tier.seconds <= step_seconds]
+        if not candidates:
+            return None
+        
+        now = datetime.now()
+        for tier in reversed(candidates):
+            if start_time >= now - timedelta(days=tier.retention_days):
+                return tier
+        
+        # Подходящие по шагу уровни уже не покрывают диапазон:
+        # берем самый мелкий из тех, где данные еще хранятся
+        for tier in self.tiers:
+            if start_time >= now - timedelta(days=tier.retention_days):
+                return tier
+        return self.tiers[-1]
+    
+    def _query_rollup(
+        self,
+        tier: RollupTier,
+        name: str,
+        start_time: datetime,
+        end_time: datetime,
+        step_seconds: int,
+        tags_filter: Optional[Dict[str, str]] = None,
+        limit: Optional[int] = None
+    ) -> List[sqlite3.Row]:
+        """Чтение бакетов уровня с перегруппировкой под запрошенный шаг."""
+        # Шаг выравниваем на ширину бакета, чтобы бакеты не делились между точками
+        step = max(tier.seconds, step_seconds // tier.seconds * tier.seconds)
+        
+        conditions = ["name = ?", "bucket BETWEEN ? AND ?"]
+        params: List[Any] = [
+            step, step, step, name,
+            int(start_time.timestamp()) // tier.seconds * tier.seconds,
+            int(end_time.timestamp())
+        ]
+        
+        if tags_filter:
+            for tag_key, tag_value in tags_filter.items():
+                conditions.append("json_extract(tags, ?) = ?")
+                params.extend([f'$."{tag_key}"', tag_value])
+        
+        # last точки — значение бакета с наибольшим last_ts; берется оконной
+        # функцией, т.к. bare-колонка рядом с MIN/MAX в SQLite не определена
+        query = f"""
+            SELECT point, tags, MAX(type) AS type,
+                   SUM(count) AS count, SUM(sum) AS sum,
+                   MIN(min) AS min, MAX(max) AS max,
+                   MAX(point_last) AS last, MAX(last_ts) AS last_ts
+            FROM (
+                SELECT (bucket / ?) * ? AS point, tags, type,
+                       count, sum, min, max, last_ts,
+                       FIRST_VALUE(last) OVER (
+                           PARTITION BY tags, bucket / ?
+                           ORDER BY last_ts DESC, bucket DESC
+                       ) AS point_last
+                FROM {tier.table}
+                WHERE {" AND ".join(conditions)}
+            )
+            GROUP BY tags, point ORDER BY point ASC
+        """
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        with self._get_connection() as conn:
+            return conn.execute(query, params).fetchall()
+    
     def save_aggregated_metric(self, metric: AggregatedMetric) -> bool:
         """Сохранение агрегированной метрики."""
         try:
@@ -303,21 +775,52 @@ class MetricStorage:
         start_time: datetime,
         end_time: datetime,
         tags_filter: Optional[Dict[str, str]] = None,
-        limit: int = 1000
+        limit: int = 1000,
+        step_seconds: Optional[int] = None
     ) -> List[Metric]:
         """
         Получение метрик по имени и временному диапазону.
         
+        Если задан шаг, данные читаются из самого крупного подходящего
+        уровня даунсэмплинга: счетчики суммируются, остальные усредняются.
+        
         Args:
             name: Имя метрики
             start_time: Начало временного диапазона
             end_time: Конец временного диапазона
             tags_filter: Фильтр по тегам
             limit: Максимальное количество записей
+            step_seconds: Шаг между точками (None — сырые данные)
             
         Returns:
             Список метрик
         """
+        tier = self.select_tier(start_time, step_seconds)
+        if tier is not None:
+            try:
+                rows = self._query_rollup(
+                    tier, name, start_time, end_time, step_seconds, tags_filter, limit
+                )
+                metrics = []
+                for row in rows:
+                    metric_type = MetricType(row['type'])
+                    if metric_type == MetricType.COUNTER:
+                        value = row['sum']
+                    else:
+                        value = row['sum'] / row['count']
+                    metrics.append(Metric(
+                        name=name,
+                        type=metric_type,
+                        value=value,
+                        timestamp=datetime.fromtimestamp(row['point']),
+                        tags=json.loads(row['tags'])
+                    ))
+                return metrics
+                
+            except Exception as e:
+                logger.error(f"Error getting metrics from {tier.table}: {e}")
+                return []
+        
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
@@ -373,6 +876,11 @@ class MetricStorage:
         """
         Получение агрегированных метрик.
         
+        SUM/AVG/MIN/MAX/COUNT/LAST считаются по самому крупному уровню
+        даунсэмплинга, который удовлетворяет периоду и диапазону; если период
+        не задан, он подбирается под max_points точек. Процентили читаются
+        из таблицы aggregated_metrics.
+        
         Args:
             name: Имя метрики
             aggregation: Метод агрегации
@@ -383,6 +891,16 @@ class MetricStorage:
         Returns:
             Список агрегированных метрик
         """
+        if aggregation in ROLLUP_AGGREGATIONS:
+            step = period_seconds or max(
+                1, int((end_time - start_time).total_seconds()) // self.max_points
+            )
+            tier = self.select_tier(start_time, step)
+            if tier is not None:
+                return self._get_rollup_aggregates(
+                    tier, name, aggregation, start_time, end_time, step
+                )
+        
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
@@ -423,10 +941,58 @@ class MetricStorage:
             logger.error(f"Error getting aggregated metrics: {e}")
             return []
     
+    def _get_rollup_aggregates(
+        self,
+        tier: RollupTier,
+        name: str,
+        aggregation: AggregationMethod,
+        start_time: datetime,
+        end_time: datetime,
+        step_seconds: int
+    ) -> List[AggregatedMetric]:
+        """Расчет агрегата по бакетам уровня даунсэмплинга."""
+        try:
+            rows = self._query_rollup(tier, name, start_time, end_time, step_seconds)
+            
+            metrics = []
+            for row in rows:
+                if aggregation == AggregationMethod.SUM:
+                    value = row['sum']
+                elif aggregation == AggregationMethod.AVG:
+                    value = row['sum'] / row['count']
+                elif aggregation == AggregationMethod.MIN:
+                    value = row['min']
+                elif aggregation == AggregationMethod.MAX:
+                    value = row['max']
+                elif aggregation == AggregationMethod.COUNT:
+                    value = row['count']
+                else:
+                    value = row['last']
+                
+                metrics.append(AggregatedMetric(
+                    name=name,
+                    type=MetricType(row['type']),
+                    aggregation=aggregation,
+                    value=value,
+                    timestamp=datetime.fromtimestamp(row['point']),
+                    period_seconds=max(tier.seconds, step_seconds // tier.seconds * tier.seconds),
+                    tags=json.loads(row['tags']),
+                    sample_count=row['count']
+                ))
+            
+            return metrics
+            
+        except Exception as e:
+            logger.error(f"Error getting aggregated metrics from {tier.table}: {e}")
+            return []
+    
     def cleanup_old_metrics(self, retention_days: int = 30) -> int:
         """
         Очистка старых метрик.
         
+        Сырые и агрегированные метрики удаляются по retention_days,
+        уровни даунсэмплинга — каждый по своему сроку хранения.
+        
         Args:
             retention_days: Количество дней хранения
             
@@ -453,11 +1019,24 @@ class MetricStorage:
                 )
                 agg_deleted = cursor.rowcount
                 
+                # Каждый уровень даунсэмплинга живет по своему сроку
+                rollup_deleted = 0
+                for tier in self.tiers:
+                    tier_cutoff = datetime.now() - timedelta(days=tier.retention_days)
+                    cursor.execute(
+                        f"DELETE FROM {tier.table} WHERE bucket < ?",
+                        (int(tier_cutoff.timestamp()),)
+                    )
+                    rollup_deleted += cursor.rowcount
+                
                 conn.commit()
                 
-                total_deleted = raw_deleted + agg_deleted
+                total_deleted = raw_deleted + agg_deleted + rollup_deleted
                 if total_deleted > 0:
-                    logger.info(f"Cleaned up {total_deleted} old metrics (raw: {raw_deleted}, agg: {agg_deleted})")
+                    logger.info(
+                        f"Cleaned up {total_deleted} old metrics "
+                        f"(raw: {raw_deleted}, agg: {agg_deleted}, rollup: {rollup_deleted})"
+                    )
                 
                 return total_deleted
                 
@@ -488,23 +1067,57 @@ class MetricAggregator:
             return []
         
         # Группируем метрики по имени и тегам
-        grouped_metrics: Dict[tuple, List[Metric]] = defaultdict(list)
+        grouped_values: Dict[tuple, List[float]] = defaultdict(list)
+        group_types: Dict[tuple, MetricType] = {}
         
         for metric in metrics:
             # Создаем ключ группировки: (name, json(tags))
             tags_key = json.dumps(metric.tags, sort_keys=True)
             group_key = (metric.name, tags_key)
-            grouped_metrics[group_key].append(metric)
+            grouped_values[group_key].append(metric.value)
+            group_types.setdefault(group_key, metric.type)
+        
+        groups = [
+            (name, json.loads(tags_key), group_types[(name, tags_key)], values)
+            for (name, tags_key), values in grouped_values.items()
+        ]
+        return self._aggregate_groups(groups, period_seconds)
+    
+    def aggregate_batch(self, batch: MetricBatch, period_seconds: int) -> List[AggregatedMetric]:
+        """
+        Агрегация пачки семплов из буфера за период.
+        
+        Группировка идет по series_id, без построения объектов Metric.
         
+        Args:
+            batch: Пачка, полученная из MetricBuffer.take_all
+            period_seconds: Период агрегации в секундах
+            
+        Returns:
+            Список агрегированных метрик
+        """
+        if not len(batch):
+            return []
+        
+        grouped_values: Dict[int, List[float]] = defaultdict(list)
+        for series_id, value in zip(batch.series_ids, batch.values):
+            grouped_values[series_id].append(value)
+        
+        groups = []
+        for series_id, values in grouped_values.items():
+            series = batch.series[series_id]
+            groups.append((series.name, series.tags, series.type, values))
+        
+        return self._aggregate_groups(groups, period_seconds)
+    
+    def _aggregate_groups(self, groups, period_seconds: int) -> List[AggregatedMetric]:
+        """Расчет агрегатов для групп (name, tags, type, values)."""
         aggregated = []
         now = datetime.now()
         
-        for (name, tags_key), metric_list in grouped_metrics.items():
-            tags = json.loads(tags_key)
-            values = [m.value for m in metric_list]
-            
+        for name, tags, metric_type, values in groups:
             # Разные агрегации для разных типов метрик
-            if metric_list[0].type == MetricType.COUNTER:
+            if metric_type == MetricType.COUNTER:
                 # Для счетчиков считаем сумму
                 agg_value = sum(values)
                 aggregated.append(AggregatedMetric(
@@ -518,7 +1131,7 @@ class MetricAggregator:
                     sample_count=len(values)
                 ))
             
-            elif metric_list[0].type == MetricType.GAUGE:
+            elif metric_type == MetricType.GAUGE:
                 # Для gauge считаем среднее
                 agg_value = statistics.mean(values) if values else 0
                 aggregated.append(AggregatedMetric(
@@ -555,12 +1168,12 @@ class MetricAggregator:
                     sample_count=len(values)
                 ))
             
-            elif metric_list[0].type in [MetricType.HISTOGRAM, MetricType.SUMMARY]:
+            elif metric_type in [MetricType.HISTOGRAM, MetricType.SUMMARY]:
                 # Для гистограмм и summary считаем процентили
                 if len(values) >= 5:  # Минимум 5 значений для процентилей
                     aggregated.append(AggregatedMetric(
                         name=name,
-                        type=metric_list[0].type,
+                        type=metric_type,
                         aggregation=AggregationMethod.P50,
                         value=statistics.quantiles(values, n=100)[49] if len(values) >= 100 else statistics.median(values),
                         timestamp=now,
@@ -571,7 +1184,7 @@ class MetricAggregator:
                     
                     aggregated.append(AggregatedMetric(
                         name=name,
-                        type=metric_list[0].type,
+                        type=metric_type,
                         aggregation=AggregationMethod.P95,
                         value=statistics.quantiles(values, n=100)[94] if len(values) >= 100 else max(values),
                         timestamp=now,
@@ -582,7 +1195,7 @@ class MetricAggregator:
                     
                     aggregated.append(AggregatedMetric(
                         name=name,
-                        type=metric_list[0].type,
+                        type=metric_type,
                         aggregation=AggregationMethod.P99,
                         value=statistics.quantiles(values, n=100)[98] if len(values) >= 100 else max(values),
                         timestamp=now,
@@ -594,7 +1207,7 @@ class MetricAggregator:
                 # Также считаем среднее
                 aggregated.append(AggregatedMetric(
                     name=name,
-                    type=metric_list[0].type,
+                    type=metric_type,
                     aggregation=AggregationMethod.AVG,
                     value=statistics.mean(values) if values else 0,
                     timestamp=now,
@@ -743,6 +1356,20 @@ class SystemMetricsCollector:
         return metrics
 
 
+# Границы бакетов гистограмм по умолчанию (миллисекунды, как в timeit)
+DEFAULT_HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+@dataclass(frozen=True)
+class MetricsSnapshot:
+    """Неизменяемый снимок предагрегированных рядов сборщика."""
+    series: Dict[tuple, tuple]
+    types: Dict[str, MetricType]
+    descriptions: Dict[str, str]
+    histogram_buckets: tuple
+    timestamp: float
+
+
 class MetricsCollector:
     """Основной класс сбора метрик."""
     
@@ -770,12 +1397,84 @@ class MetricsCollector:
         self._flush_thread: Optional[threading.Thread] = None
         self._system_collect_thread: Optional[threading.Thread] = None
         
-        # Регистры для счетчиков
-        self._counters: Dict[str, float] = {}
-        self._gauges: Dict[str, float] = {}
-        self._histograms: Dict[str, List[float]] = defaultdict(list)
+        # Текущее состояние рядов для экспозиции: (name, tags) -> неизменяемый кортеж.
+        # Словарь копируется при записи, если на него ссылается выданный снимок.
+        self._series_state: Dict[tuple, tuple] = {}
+        self._series_types: Dict[str, MetricType] = {}
+        self._descriptions: Dict[str, str] = {}
+        self._type_conflicts: set = set()
+        self._snapshot_shared = False
+        self.histogram_buckets = DEFAULT_HISTOGRAM_BUCKETS
         self._lock = threading.RLock()
     
+    def _record(
+        self,
+        name: str,
+        metric_type: MetricType,
+        value: float,
+        tags: Optional[Dict[str, str]],
+        description: Optional[str]
+    ) -> None:
+        """Обновление предагрегированного состояния ряда."""
+        key = (name, tuple(sorted(tags.items())) if tags else ())
+        
+        with self._lock:
+            # Тип ряда в экспозиции — первый записанный; семплы другого типа
+            # под тем же именем сохраняются в буфер, но не в состояние ряда
+            registered_type = self._series_types.get(name)
+            if registered_type is not None and registered_type != metric_type:
+                if (name, metric_type) not in self._type_conflicts:
+                    self._type_conflicts.add((name, metric_type))
+                    logger.warning(
+                        f"Metric {name} is exposed as {registered_type.value}, "
+                        f"ignoring {metric_type.value} samples in exposition"
+                    )
+                return
+            
+            if self._snapshot_shared:
+                self._series_state = dict(self._series_state)
+                self._snapshot_shared = False
+            
+            state = self._series_state.get(key)
+            if metric_type == MetricType.COUNTER:
+                total = state[0] if state else 0.0
+                self._series_state[key] = (total + value,)
+            elif metric_type == MetricType.GAUGE:
+                self._series_state[key] = (value,)
+            else:
+                if state:
+                    bucket_counts, total, count = state
+                else:
+                    bucket_counts, total, count = (0,) * len(self.histogram_buckets), 0.0, 0
+                # Счетчики бакетов кумулятивные, как в формате экспозиции
+                bucket_counts = tuple(
+                    c + 1 if value <= bound else c
+                    for c, bound in zip(bucket_counts, self.histogram_buckets)
+                )
+                self._series_state[key] = (bucket_counts, total + value, count + 1)
+            
+            if name not in self._series_types:
+                self._series_types[name] = metric_type
+            if description and name not in self._descriptions:
+                self._descriptions[name] = description
+    
+    def snapshot(self) -> 'MetricsSnapshot':
+        """
+        Снимок текущего состояния рядов.
+        
+        Под блокировкой берется только ссылка на словарь состояний;
+        следующая запись скопирует его, поэтому снимок не меняется.
+        """
+        with self._lock:
+            self._snapshot_shared = True
+            return MetricsSnapshot(
+                series=self._series_state,
+                types=dict(self._series_types),
+                descriptions=dict(self._descriptions),
+                histogram_buckets=self.histogram_buckets,
+                timestamp=time.time()
+            )
+    
     def counter(self, name: str, value: float = 1, tags: Optional[Dict[str, str]] = None,
                 description: Optional[str] = None) -> None:
         """
@@ -787,14 +1486,9 @@ class MetricsCollector:
             tags: Теги метрики
             description: Описание метрики
         """
-        metric = Metric(
-            name=name,
-            type=MetricType.COUNTER,
-            value=value,
-            tags=tags or {},
-            description=description
-        )
-        self.buffer.add(metric)
+        series_id = self.buffer.register_series(name, MetricType.COUNTER, tags, description)
+        self.buffer.append(series_id, value)
+        self._record(name, MetricType.COUNTER, value, tags, description)
     
     def gauge(self, name: str, value: float, tags: Optional[Dict[str, str]] = None,
               description: Optional[str] = None) -> None:
@@ -807,14 +1501,9 @@ class MetricsCollector:
             tags: Теги метрики
             description: Описание метрики
         """
-        metric = Metric(
-            name=name,
-            type=MetricType.GAUGE,
-            value=value,
-            tags=tags or {},
-            description=description
-        )
-        self.buffer.add(metric)
+        series_id = self.buffer.register_series(name, MetricType.GAUGE, tags, description)
+        self.buffer.append(series_id, value)
+        self._record(name, MetricType.GAUGE, value, tags, description)
     
     def histogram(self, name: str, value: float, tags: Optional[Dict[str, str]] = None,
                   description: Optional[str] = None) -> None:
@@ -827,14 +1516,9 @@ class MetricsCollector:
             tags: Теги метрики
             description: Описание метрики
         """
-        metric = Metric(
-            name=name,
-            type=MetricType.HISTOGRAM,
-            value=value,
-            tags=tags or {},
-            description=description
-        )
-        self.buffer.add(metric)
+        series_id = self.buffer.register_series(name, MetricType.HISTOGRAM, tags, description)
+        self.buffer.append(series_id, value)
+        self._record(name, MetricType.HISTOGRAM, value, tags, description)
     
     def timeit(self, name: str, tags: Optional[Dict[str, str]] = None):
         """
@@ -868,19 +1552,20 @@ class MetricsCollector:
     
     def _flush_buffer(self):
         """Сброс буфера в хранилище."""
-        metrics = self.buffer.take_all()
-        if not metrics:
+        batch = self.buffer.take_all()
+        if not len(batch):
+            batch.release()
             return
         
         try:
             # Сохраняем сырые метрики
-            saved = self.storage.save_metrics(metrics)
+            saved = self.storage.save_batch(batch)
             if saved > 0:
                 logger.debug(f"Flushed {saved} metrics to storage")
             
             # Агрегируем метрики для разных периодов
             for period in self.aggregator.aggregation_periods:
-                aggregated = self.aggregator.aggregate_metrics(metrics, period)
+                aggregated = self.aggregator.aggregate_batch(batch, period)
                 
                 for agg_metric in aggregated:
                     self.storage.save_aggregated_metric(agg_metric)
@@ -890,6 +1575,8 @@ class MetricsCollector:
                     
         except Exception as e:
             logger.error(f"Error flushing metrics buffer: {e}")
+        finally:
+            batch.release()
     
     def _flush_loop(self):
         """Цикл сброса буфера."""
@@ -913,6 +1600,9 @@ class MetricsCollector:
                 system_metrics = self.system_collector.collect()
                 for metric in system_metrics:
                     self.buffer.add(metric)
+                    self._record(
+                        metric.name, metric.type, metric.value, metric.tags, metric.description
+                    )
                 
                 time.sleep(10)  # Собираем системные метрики каждые 10 секунд
                 
@@ -963,7 +1653,8 @@ class MetricsCollector:
         name: str,
         start_time: datetime,
         end_time: datetime,
-        tags_filter: Optional[Dict[str, str]] = None
+        tags_filter: Optional[Dict[str, str]] = None,
+        step_seconds: Optional[int] = None
     ) -> List[Metric]:
         """
         Получение метрик из хранилища.
@@ -973,11 +1664,14 @@ class MetricsCollector:
             start_time: Начало периода
             end_time: Конец периода
             tags_filter: Фильтр по тегам
+            step_seconds: Шаг между точками (None — сырые данные)
             
         Returns:
             Список метрик
         """
-        return self.storage.get_metrics(name, start_time, end_time, tags_filter)
+        return self.storage.get_metrics(
+            name, start_time, end_time, tags_filter, step_seconds=step_seconds
+        )
     
     def get_aggregated_metrics(
         self,
@@ -1019,6 +1713,148 @@ class MetricsCollector:
         }
 
 
+class OpenMetricsExporter:
+    """Экспозиция текущих рядов сборщика в текстовом формате OpenMetrics."""
+    
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+    # Предел кэшей отрисованных имен и меток (при переполнении кэш сбрасывается)
+    CACHE_SIZE = 10000
+    
+    def __init__(self, collector: MetricsCollector):
+        self.collector = collector
+        # Отрисованные имена и метки кэшируются: набор рядов меняется редко
+        self._name_cache: Dict[str, str] = {}
+        self._labels_cache: Dict[tuple, str] = {}
+        self._server = None
+        self._server_thread: Optional[threading.Thread] = None
+    
+    def _metric_name(self, name: str) -> str:
+        """Приведение имени к [a-zA-Z_:][a-zA-Z0-9_:]*."""
+        cached = self._name_cache.get(name)
+        if cached is None:
+            cached = re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+            if not cached or cached[0].isdigit():
+                cached = '_' + cached
+            if len(self._name_cache) >= self.CACHE_SIZE:
+                self._name_cache.clear()
+            self._name_cache[name] = cached
+        return cached
+    
+    def _labels(self, tags: tuple) -> str:
+        """Отрисовка набора меток без фигурных скобок."""
+        cached = self._labels_cache.get(tags)
+        if cached is None:
+            cached = ','.join(
+                f'{self._metric_name(key)}="{_escape_label_value(str(value))}"'
+                for key, value in tags
+            )
+            if len(self._labels_cache) >= self.CACHE_SIZE:
+                self._labels_cache.clear()
+            self._labels_cache[tags] = cached
+        return cached
+    
+    def render(self, snapshot: Optional[MetricsSnapshot] = None) -> str:
+        """
+        Отрисовка снимка в формате OpenMetrics.
+        
+        Args:
+            snapshot: Снимок (по умолчанию берется новый у сборщика)
+            
+        Returns:
+            Текст экспозиции, заканчивающийся маркером # EOF
+        """
+        snapshot = snapshot or self.collector.snapshot()
+        
+        families: Dict[str, List[tuple]] = defaultdict(list)
+        for (name, tags), state in snapshot.series.items():
+            families[name].append((tags, state))
+        
+        bucket_bounds = [f'"{float(bound)}"' for bound in snapshot.histogram_buckets]
+        lines: List[str] = []
+        
+        for name in sorted(families):
+            metric_type = snapshot.types[name]
+            family = self._metric_name(name)
+            if metric_type == MetricType.COUNTER and family.endswith('_total'):
+                family = family[:-len('_total')]
+            # SUMMARY копится в те же бакеты, что и HISTOGRAM
+            exposed_type = 'histogram' if metric_type == MetricType.SUMMARY else metric_type.value
+            
+            lines.append(f"# TYPE {family} {exposed_type}")
+            description = snapshot.descriptions.get(name)
+            if description:
+                lines.append(f"# HELP {family} {_escape_help(description)}")
+            
+            for tags, state in families[name]:
+                if len(state) != (1 if metric_type in (MetricType.COUNTER, MetricType.GAUGE) else 3):
+                    # Снимок собран не этим сборщиком или с другим типом ряда
+                    continue
+                labels = self._labels(tags)
+                label_set = f"{{{labels}}}" if labels else ""
+                if metric_type == MetricType.COUNTER:
+                    lines.append(f"{family}_total{label_set} {state[0]!r}")
+                elif metric_type == MetricType.GAUGE:
+                    lines.append(f"{family}{label_set} {state[0]!r}")
+                else:
+                    bucket_counts, total, count = state
+                    prefix = f"{family}_bucket{{{labels},le=" if labels else f"{family}_bucket{{le="
+                    for bound, bucket_count in zip(bucket_bounds, bucket_counts):
+                        lines.append(f"{prefix}{bound}}} {bucket_count}")
+                    lines.append(f'{prefix}"+Inf"}} {count}')
+                    lines.append(f"{family}_sum{label_set} {total!r}")
+                    lines.append(f"{family}_count{label_set} {count}")
+        
+        lines.append("# EOF\n")
+        return "\n".join(lines)
+    
+    def start_server(self, host: str = "127.0.0.1", port: int = 9464) -> None:
+        """Запуск HTTP-эндпоинта /metrics в фоновом потоке."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        
+        exporter = self
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', exporter.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                logger.debug("Metrics scrape: " + format % args)
+        
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever,
+            name="OpenMetricsExporterThread",
+            daemon=True
+        )
+        self._server_thread.start()
+        logger.info(f"OpenMetrics endpoint listening on http://{host}:{port}/metrics")
+    
+    def stop_server(self) -> None:
+        """Остановка HTTP-эндпоинта."""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _escape_label_value(value: str) -> str:
+    """Экранирование значения метки по правилам OpenMetrics."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _escape_help(text: str) -> str:
+    """Экранирование текста HELP."""
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
 # --- Пример использования ---
 def example_application_logic(collector: MetricsCollector):
     """Пример использования метрик в приложении."""
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+pytest.importorskip("jieba")
+
+from deepseek_secure_15 import (  # noqa: E402
+    Document,
+    DocumentType,
+    IndexSegment,
+    SearchEngine,
+    SearchIndexStorage,
+)
+
+
+def _build_segment(tmp_path):
+    storage = SearchIndexStorage(str(tmp_path / "search.db"))
+    engine = SearchEngine(storage)
+    for i in range(20):
+        engine.index_document(Document(
+            id=f"doc{i}",
+            doc_type=DocumentType.ARTICLE,
+            title=f"Article {i}",
+            content=f"searchable content number {i}"
+        ))
+    engine.index_document(Document(
+        id="rare",
+        doc_type=DocumentType.ARTICLE,
+        title="Unique",
+        content="a document with a distinctive word"
+    ))
+    assert engine.save_index()
+    engine.close()
+    return storage
+
+
+@pytest.mark.parametrize("keep", [0.25, 0.5, 0.9])
+def test_truncated_segment_is_rejected(tmp_path, keep):
+    storage = _build_segment(tmp_path)
+    size = os.path.getsize(storage.index_path)
+
+    # Обрезка до нечетной длины: секции выходят за конец файла или их
+    # размер не кратен размеру элемента
+    with open(storage.index_path, "r+b") as f:
+        f.truncate(int(size * keep) | 1)
+
+    assert IndexSegment.open(storage.index_path) is None
+
+
+def test_truncated_segment_triggers_rebuild(tmp_path):
+    storage = _build_segment(tmp_path)
+    size = os.path.getsize(storage.index_path)
+    with open(storage.index_path, "r+b") as f:
+        f.truncate(size // 2 + 1)
+
+    engine = SearchEngine(storage)
+    try:
+        assert engine.in_memory_index.total_docs == 21
+        assert [result.document.id for result in engine.search("distinctive")] == ["rare"]
+        assert IndexSegment.open(storage.index_path) is not None
+    finally:
+        engine.close()